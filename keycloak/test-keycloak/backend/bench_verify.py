@@ -0,0 +1,223 @@
+"""
+Keycloak API 測試後端 - 簽名驗證微基準測試
+
+比較各驗證後端（VERIFY_BACKEND）在不同簽名算法與金鑰長度下的單次驗證耗時，
+用於依 realm 實際使用的金鑰挑選最快的後端。
+加上 --pools 時，另外比較簽名驗證直接在事件迴圈執行、交給執行緒池與交給程序池（VERIFY_POOL）的吞吐量。
+
+用法：
+    uv run python bench_verify.py                         # 全部算法 / 金鑰長度
+    uv run python bench_verify.py -n 5000                 # 每個組合驗證 5000 次
+    uv run python bench_verify.py --cases RS256-2048 ES256
+    uv run python bench_verify.py --pools --pool-size 4   # 一併比較工作池
+    uv run python bench_verify.py --output verify.json    # 保存結果
+
+不需要啟動 Keycloak 或後端服務，只使用 main.py 中的驗證後端。
+"""
+
+import argparse
+import asyncio
+import base64
+import concurrent.futures
+import json
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519, padding, rsa
+from cryptography.hazmat.primitives.asymmetric.utils import decode_dss_signature
+
+import main as backend
+
+# 測試組合：名稱 → (算法, RSA 金鑰長度)
+CASES = {
+    "RS256-2048": ("RS256", 2048),
+    "RS256-3072": ("RS256", 3072),
+    "RS256-4096": ("RS256", 4096),
+    "PS256-2048": ("PS256", 2048),
+    "PS256-4096": ("PS256", 4096),
+    "ES256": ("ES256", None),
+    "EdDSA": ("EdDSA", None),
+}
+
+# ============================================================================
+# 金鑰與簽名
+# ============================================================================
+
+def _b64url(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+def _b64_uint(value: int) -> str:
+    return _b64url(value.to_bytes((value.bit_length() + 7) // 8, "big"))
+
+def make_signed_token(alg: str, key_size: Optional[int]) -> Tuple[Dict[str, Any], "backend.ParsedToken"]:
+    """
+    產生金鑰與一個以該金鑰簽名的 Token（內容與 Keycloak 的 Access Token 大小相近）
+
+    Returns:
+        Tuple[dict, ParsedToken]: 公鑰 JWK，以及解析後的 Token
+    """
+    header = {"alg": alg, "typ": "JWT", "kid": "bench-key"}
+    now = int(time.time())
+    payload = {
+        "exp": now + 3600, "iat": now, "iss": "http://localhost:8080/realms/sam-test", "aud": "account",
+        "sub": "bench-user", "typ": "Bearer", "azp": "myclient", "preferred_username": "bench-user",
+        "email": "bench-user@example.com", "realm_access": {"roles": ["user", "offline_access"]},
+        "scope": "openid email profile",
+    }
+    signing_input = f"{_b64url(json.dumps(header).encode())}.{_b64url(json.dumps(payload).encode())}".encode()
+
+    if alg in ("RS256", "PS256"):
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=key_size)
+        numbers = private_key.public_key().public_numbers()
+        jwk = {"kty": "RSA", "alg": alg, "n": _b64_uint(numbers.n), "e": _b64_uint(numbers.e)}
+        if alg == "RS256":
+            pad = padding.PKCS1v15()
+        else:
+            pad = padding.PSS(mgf=padding.MGF1(hashes.SHA256()), salt_length=hashes.SHA256.digest_size)
+        signature = private_key.sign(signing_input, pad, hashes.SHA256())
+    elif alg == "ES256":
+        private_key = ec.generate_private_key(ec.SECP256R1())
+        numbers = private_key.public_key().public_numbers()
+        jwk = {"kty": "EC", "alg": alg, "crv": "P-256",
+               "x": _b64url(numbers.x.to_bytes(32, "big")), "y": _b64url(numbers.y.to_bytes(32, "big"))}
+        r, s = decode_dss_signature(private_key.sign(signing_input, ec.ECDSA(hashes.SHA256())))
+        signature = r.to_bytes(32, "big") + s.to_bytes(32, "big")
+    else:
+        private_key = ed25519.Ed25519PrivateKey.generate()
+        from cryptography.hazmat.primitives import serialization
+        public_bytes = private_key.public_key().public_bytes(serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+        jwk = {"kty": "OKP", "alg": alg, "crv": "Ed25519", "x": _b64url(public_bytes)}
+        signature = private_key.sign(signing_input)
+
+    jwk.update({"use": "sig", "kid": "bench-key"})
+    token = f"{signing_input.decode()}.{_b64url(signature)}"
+    return jwk, backend.parse_token(token)
+
+# ============================================================================
+# 量測
+# ============================================================================
+
+def bench_backend(backend_name: str, jwk: Dict[str, Any], parsed, iterations: int) -> Optional[Dict[str, float]]:
+    """量測單一後端的驗證耗時（不支援該算法時回傳 None）"""
+    verification_backend = backend.VERIFICATION_BACKENDS[backend_name]
+    if backend._jwk_algorithm(jwk) not in verification_backend.algorithms:
+        return None
+
+    started = time.perf_counter()
+    key = verification_backend.load_key(jwk)
+    load_us = (time.perf_counter() - started) * 1e6
+    if not key.verify(parsed.signing_input, parsed.signature):
+        raise RuntimeError(f"{backend_name} 驗證失敗: {jwk['alg']}")
+
+    verify = key.verify
+    signing_input, signature = parsed.signing_input, parsed.signature
+    for _ in range(min(iterations // 10, 100)):                # 預熱
+        verify(signing_input, signature)
+    started = time.perf_counter()
+    for _ in range(iterations):
+        verify(signing_input, signature)
+    elapsed = time.perf_counter() - started
+    return {"us_per_op": elapsed / iterations * 1e6, "ops": iterations / elapsed, "load_us": load_us}
+
+async def bench_pool(pool: str, pool_size: int, key, parsed, iterations: int, concurrency: int) -> Dict[str, float]:
+    """量測簽名驗證在事件迴圈 / 執行緒池 / 程序池執行時的吞吐量"""
+    executor: Optional[concurrent.futures.Executor] = None
+    if pool == "thread":
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=pool_size)
+    elif pool == "process":
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=pool_size)
+    loop = asyncio.get_running_loop()
+    algorithms = (key.alg,)
+
+    async def verify_one():
+        if executor is None:
+            backend._verify_signature(parsed, key, algorithms)
+        else:
+            await loop.run_in_executor(executor, backend._verify_signature, parsed, key, algorithms)
+
+    async def worker(count: int):
+        for _ in range(count):
+            await verify_one()
+
+    try:
+        await asyncio.gather(*(worker(2) for _ in range(pool_size)))  # 預熱（程序池啟動工作程序）
+        per_worker, remainder = divmod(iterations, concurrency)
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(per_worker + (i < remainder)) for i in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return {"us_per_op": elapsed / iterations * 1e6, "ops": iterations / elapsed}
+
+# ============================================================================
+# 報告
+# ============================================================================
+
+def print_backend_report(results: Dict[str, Dict[str, Optional[Dict[str, float]]]]):
+    """輸出各後端 × 算法的結果表格（標示每個算法最快的後端）"""
+    header = f"{'算法 / 金鑰':<14}{'後端':<14}{'µs/次':>10}{'次/秒':>12}{'載入 µs':>10}  相對最快"
+    print(header)
+    print("-" * (len(header) + 8))
+    for case, by_backend in results.items():
+        supported = {name: result for name, result in by_backend.items() if result is not None}
+        fastest = min((result["us_per_op"] for result in supported.values()), default=None)
+        for name, result in by_backend.items():
+            if result is None:
+                print(f"{case:<14}{name:<14}{'不支援':>10}")
+                continue
+            ratio = result["us_per_op"] / fastest
+            mark = "  ← 最快" if ratio == 1 else f"  {ratio:.2f}x"
+            print(f"{case:<14}{name:<14}{result['us_per_op']:>10.1f}{result['ops']:>12.0f}{result['load_us']:>10.0f}{mark}")
+
+def print_pool_report(case: str, results: Dict[str, Dict[str, float]]):
+    print(f"\n工作池比較（{case}）")
+    header = f"{'VERIFY_POOL':<14}{'µs/次':>10}{'次/秒':>12}"
+    print(header)
+    print("-" * len(header))
+    for pool, result in results.items():
+        print(f"{pool:<14}{result['us_per_op']:>10.1f}{result['ops']:>12.0f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="簽名驗證後端微基準測試")
+    parser.add_argument("-n", "--iterations", type=int, default=2000, help="每個組合的驗證次數（預設 2000）")
+    parser.add_argument("--cases", nargs="+", choices=list(CASES), default=list(CASES), help="要測試的算法 / 金鑰長度")
+    parser.add_argument("--backends", nargs="+", choices=list(backend.VERIFICATION_BACKENDS),
+                        default=list(backend.VERIFICATION_BACKENDS), help="要比較的驗證後端")
+    parser.add_argument("--pools", action="store_true", help="一併比較事件迴圈 / 執行緒池 / 程序池")
+    parser.add_argument("--pool-case", choices=list(CASES), default="RS256-2048", help="工作池比較使用的組合")
+    parser.add_argument("--pool-size", type=int, default=4, help="工作池大小（預設 4）")
+    parser.add_argument("--concurrency", type=int, default=50, help="工作池比較的並行驗證數（預設 50）")
+    parser.add_argument("--output", help="將結果寫入 JSON 檔案")
+    args = parser.parse_args()
+
+    tokens = {case: make_signed_token(*CASES[case]) for case in dict.fromkeys([*args.cases, args.pool_case])}
+
+    results = {
+        case: {name: bench_backend(name, *tokens[case], args.iterations) for name in args.backends}
+        for case in args.cases
+    }
+    print_backend_report(results)
+
+    pool_results = {}
+    if args.pools:
+        jwk, parsed = tokens[args.pool_case]
+        key = backend.verification_backend.load_key(jwk)
+        for pool in ("none", "thread", "process"):
+            pool_results[pool] = asyncio.run(
+                bench_pool(pool, args.pool_size, key, parsed, args.iterations, args.concurrency))
+        print_pool_report(args.pool_case, pool_results)
+
+    if args.output:
+        report = {
+            "config": {"iterations": args.iterations, "pool_size": args.pool_size, "concurrency": args.concurrency},
+            "results": results,
+            "pools": pool_results,
+        }
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"結果已寫入 {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,450 @@
+"""
+Keycloak API 測試後端 - 效能基準測試
+
+在本機啟動一個模擬的 Keycloak（提供 JWKS、OpenID Discovery、Realm、Token、Admin API 使用者端點），
+以產生的 RSA 金鑰簽發 Token，並在受控的並行度下壓測後端 API，
+輸出每個情境的 RPS、p50 / p99 延遲、後端每個請求的 CPU 時間以及對 Keycloak 的對外請求次數。
+
+用法：
+    uv run python benchmark.py                              # 預設情境
+    uv run python benchmark.py -c 100 -n 5000               # 並行 100、每個情境 5000 個請求
+    uv run python benchmark.py --kc-latency-ms 50           # 模擬較慢的 Keycloak
+    uv run python benchmark.py --kc-failure-rate 0.2        # 20% 的 Keycloak 請求回應 503
+    uv run python benchmark.py --output baseline.json       # 保存結果作為基準
+    uv run python benchmark.py --baseline baseline.json     # 與基準比較
+
+後端以子程序啟動，環境變數（例如 TOKEN_CACHE_ENABLED）會傳遞給後端。
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import secrets
+import socket
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+import uvicorn
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from fastapi import FastAPI, Query, Request, Response
+from jose import JWTError, jwt
+
+REALM = "sam-test"
+CLIENT_ID = "myclient"
+KEY_ID = "bench-key"
+
+# 可壓測的情境：名稱 → (HTTP 方法, 路徑)
+SCENARIOS = {
+    "protected": ("GET", "/api/protected"),
+    "test-basic": ("GET", "/api/test-basic"),
+    "user-info": ("GET", "/api/user-info"),
+    "token-info": ("GET", "/api/token-info"),
+    "refresh-token": ("POST", "/api/refresh-token"),
+}
+
+# ============================================================================
+# 模擬 Keycloak
+# ============================================================================
+
+def _b64_uint(value: int) -> str:
+    return base64.urlsafe_b64encode(value.to_bytes((value.bit_length() + 7) // 8, "big")).decode().rstrip("=")
+
+class FakeKeycloak:
+    """模擬的 Keycloak 服務
+
+    提供後端會呼叫的端點，並支援延遲注入與失敗注入：
+    - /realms/{realm}/protocol/openid-connect/certs      JWKS
+    - /realms/{realm}/.well-known/openid-configuration   OpenID Discovery
+    - /realms/{realm}                                    Realm 資訊（PEM 公鑰）
+    - /realms/{realm}/protocol/openid-connect/token      Token 刷新 / client_credentials
+    - /realms/{realm}/protocol/openid-connect/token/introspect  Introspection（本服務簽發的 JWT 與不透明 Token）
+    - /admin/realms/{realm}/users                        Admin API 使用者列表（first / max 分頁、search）
+    """
+
+    def __init__(self, latency: float = 0.0, failure_rate: float = 0.0, key_size: int = 2048,
+                 user_count: int = 0):
+        self.latency = latency                              # 每個請求額外延遲（秒）
+        self.failure_rate = failure_rate                    # 回應 503 的比例
+        self.calls: Counter = Counter()                     # 端點 → 呼叫次數
+        self.url = ""
+        self.users = [                                      # Admin API 的使用者（依 username 排序）
+            {"id": f"id-{index:05d}", "username": f"user{index:05d}",
+             "email": f"user{index:05d}@example.com", "enabled": True}
+            for index in range(user_count)
+        ]
+        self.admin_tokens: set = set()                      # client_credentials 簽發、Admin API 接受的 Token
+        self.user_pages: List[Tuple[int, int]] = []         # Admin API 收到的 (first, max)
+        self.opaque_tokens: Dict[str, Dict[str, Any]] = {}  # 不透明 Token → payload
+        self.introspected: List[str] = []                   # 收到 introspection 的 realm
+        self.introspect_body: Optional[bytes] = None        # 設定時 introspection 直接回應這段內容（模擬代理錯誤頁）
+        self.in_flight = 0                                  # 處理中的請求數
+        self._last_request = 0.0                            # 最後一個請求到達的時間（time.monotonic()）
+
+        self._private_key = rsa.generate_private_key(public_exponent=65537, key_size=key_size)
+        self.private_pem = self._private_key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        )
+        public_key = self._private_key.public_key()
+        public_numbers = public_key.public_numbers()
+        self.jwk = {
+            "kty": "RSA",
+            "use": "sig",
+            "alg": "RS256",
+            "kid": KEY_ID,
+            "n": _b64_uint(public_numbers.n),
+            "e": _b64_uint(public_numbers.e),
+        }
+        self.public_key_b64 = base64.b64encode(
+            public_key.public_bytes(serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo)
+        ).decode()
+        self.app = self._build_app()
+
+    @property
+    def issuer(self) -> str:
+        return f"{self.url}/realms/{REALM}"
+
+    def _payload(self, subject: str, lifetime: int, claims: Dict[str, Any]) -> Dict[str, Any]:
+        now = int(time.time())
+        payload = {
+            "exp": now + lifetime,
+            "iat": now,
+            "iss": self.issuer,
+            "aud": "account",
+            "sub": subject,
+            "typ": "Bearer",
+            "azp": CLIENT_ID,
+            "preferred_username": subject,
+            "email": f"{subject}@example.com",
+            "realm_access": {"roles": ["user"]},
+        }
+        payload.update(claims)
+        return payload
+
+    def mint_token(self, subject: str, lifetime: int = 300, **claims) -> str:
+        """簽發一個 Keycloak 格式的 Access Token"""
+        payload = self._payload(subject, lifetime, claims)
+        return jwt.encode(payload, self.private_pem, algorithm="RS256", headers={"kid": KEY_ID})
+
+    def mint_opaque_token(self, subject: str, lifetime: int = 300, **claims) -> str:
+        """簽發一個不透明 Token（只能透過 introspection 驗證）"""
+        token = secrets.token_urlsafe(32)
+        self.opaque_tokens[token] = self._payload(subject, lifetime, claims)
+        return token
+
+    def wait_idle(self, quiet: float = 0.05, timeout: float = 5.0):
+        """等待處理中的請求結束且 quiet 秒內沒有新請求（測試用來隔離前一個測試殘留的請求）"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.in_flight == 0 and time.monotonic() - self._last_request >= quiet:
+                return
+            time.sleep(0.01)
+
+    def _build_app(self) -> FastAPI:
+        app = FastAPI()
+
+        @app.middleware("http")
+        async def track(request: Request, call_next):
+            self.in_flight += 1
+            self._last_request = time.monotonic()
+            try:
+                return await call_next(request)
+            finally:
+                self.in_flight -= 1
+
+        async def inject(name: str) -> Optional[Response]:
+            self.calls[name] += 1
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            if self.failure_rate and random.random() < self.failure_rate:
+                return Response(status_code=503)
+            return None
+
+        @app.get("/realms/{realm}/protocol/openid-connect/certs")
+        async def certs(realm: str):
+            failure = await inject("certs")
+            if failure:
+                return failure
+            return Response(json.dumps({"keys": [self.jwk]}), media_type="application/json",
+                            headers={"Cache-Control": "no-cache"})
+
+        @app.get("/realms/{realm}/.well-known/{name}")
+        async def discovery(realm: str, name: str):
+            failure = await inject("discovery")
+            if failure:
+                return failure
+            base = f"{self.url}/realms/{realm}/protocol/openid-connect"
+            return {
+                "issuer": f"{self.url}/realms/{realm}",
+                "jwks_uri": f"{base}/certs",
+                "token_endpoint": f"{base}/token",
+                "introspection_endpoint": f"{base}/token/introspect",
+            }
+
+        @app.get("/realms/{realm}")
+        async def realm_info(realm: str):
+            failure = await inject("realm")
+            if failure:
+                return failure
+            return {"realm": realm, "public_key": self.public_key_b64}
+
+        @app.post("/realms/{realm}/protocol/openid-connect/token")
+        async def token(realm: str, request: Request):
+            failure = await inject("token")
+            if failure:
+                return failure
+            form = await request.form()
+            if form.get("grant_type") == "client_credentials":
+                access_token = self.mint_token(f"service-account-{CLIENT_ID}")
+                self.admin_tokens.add(access_token)
+                return {"access_token": access_token, "expires_in": 300, "token_type": "Bearer"}
+            return {
+                "access_token": self.mint_token("refreshed-user"),
+                "refresh_token": form.get("refresh_token"),
+                "expires_in": 300,
+                "token_type": "Bearer",
+            }
+
+        @app.post("/realms/{realm}/protocol/openid-connect/token/introspect")
+        async def introspect(realm: str, request: Request):
+            failure = await inject("introspect")
+            if failure:
+                return failure
+            self.introspected.append(realm)
+            if self.introspect_body is not None:
+                return Response(self.introspect_body, media_type="text/html")
+            token = (await request.form()).get("token", "")
+            payload = self.opaque_tokens.get(token)
+            if payload is None:
+                try:
+                    payload = jwt.decode(token, self.jwk, algorithms=["RS256"], options={"verify_aud": False})
+                except JWTError:
+                    payload = None
+            # 與 Keycloak 相同：其他 realm 的 Token 與過期的 Token 都不是 active
+            if payload is None or payload["iss"] != f"{self.url}/realms/{realm}" or payload["exp"] < time.time():
+                return {"active": False}
+            return {**payload, "active": True, "client_id": payload.get("azp")}
+
+        @app.get("/admin/realms/{realm}/users")
+        async def users(realm: str, request: Request, first: int = 0, limit: int = Query(100, alias="max"),
+                        search: Optional[str] = None):
+            failure = await inject("users")
+            if failure:
+                return failure
+            authorization = request.headers.get("Authorization", "")
+            if authorization.removeprefix("Bearer ") not in self.admin_tokens:
+                return Response(status_code=401)
+            self.user_pages.append((first, limit))
+            matched = self.users if search is None else [user for user in self.users if search in user["username"]]
+            return matched[first:first + limit]
+
+        return app
+
+    def start(self, host: str = "127.0.0.1") -> str:
+        """在背景執行緒啟動服務，回傳 base URL"""
+        port = _free_port()
+        server = uvicorn.Server(uvicorn.Config(self.app, host=host, port=port, log_level="warning"))
+        threading.Thread(target=server.run, daemon=True).start()
+        while not server.started:
+            time.sleep(0.05)
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+# ============================================================================
+# 後端子程序
+# ============================================================================
+
+def start_backend(keycloak_url: str) -> Tuple[subprocess.Popen, str]:
+    """以子程序啟動後端並等待就緒"""
+    port = _free_port()
+    # 以模擬 Keycloak 作為唯一候選 URL 啟動後端
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning", "--no-access-log"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env={**os.environ, "KEYCLOAK_URLS": keycloak_url},
+    )
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"{url}/", timeout=1).status_code == 200:
+                return process, url
+        except httpx.HTTPError:
+            pass
+        if process.poll() is not None:
+            raise RuntimeError("後端啟動失敗")
+        time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("等待後端啟動逾時")
+
+# ============================================================================
+# 壓測
+# ============================================================================
+
+def _process_cpu_seconds(pid: int) -> Optional[float]:
+    """讀取程序累計的 CPU 時間（user + system），非 Linux 環境回傳 None"""
+    try:
+        with open(f"/proc/{pid}/stat") as stat_file:
+            fields = stat_file.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    # utime / stime 為 stat 的第 14、15 欄（去掉 pid 與 comm 後為第 12、13 欄）
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+def _percentile(sorted_values: List[float], percent: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(percent / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+async def run_scenario(backend_url: str, scenario: str, tokens: List[str], concurrency: int,
+                       total: int, keycloak: FakeKeycloak, backend_pid: Optional[int] = None) -> Dict[str, Any]:
+    """以固定並行度送出 total 個請求，回傳統計結果"""
+    method, path = SCENARIOS[scenario]
+    latencies: List[float] = []
+    statuses: Counter = Counter()
+    remaining = total
+    calls_before = sum(keycloak.calls.values())
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=backend_url, limits=limits, timeout=30) as client:
+        async def worker(worker_id: int):
+            nonlocal remaining
+            index = worker_id
+            while remaining > 0:
+                remaining -= 1
+                token = tokens[index % len(tokens)]
+                index += concurrency
+                if method == "POST":
+                    request = client.post(path, json={"refresh_token": token})
+                else:
+                    request = client.get(path, headers={"Authorization": f"Bearer {token}"})
+                start = time.perf_counter()
+                try:
+                    response = await request
+                    statuses[response.status_code] += 1
+                except httpx.HTTPError:
+                    statuses["error"] += 1
+                latencies.append(time.perf_counter() - start)
+
+        cpu_before = _process_cpu_seconds(backend_pid) if backend_pid else None
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(i) for i in range(concurrency)))
+        elapsed = time.perf_counter() - started
+        cpu_after = _process_cpu_seconds(backend_pid) if backend_pid else None
+
+    latencies.sort()
+    cpu_ms = None
+    if cpu_before is not None and cpu_after is not None and latencies:
+        cpu_ms = (cpu_after - cpu_before) / len(latencies) * 1000
+    return {
+        "requests": len(latencies),
+        "elapsed": elapsed,
+        "rps": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": _percentile(latencies, 50) * 1000,
+        "p99_ms": _percentile(latencies, 99) * 1000,
+        "cpu_ms": cpu_ms,
+        "statuses": {str(code): count for code, count in statuses.items()},
+        "outbound_calls": sum(keycloak.calls.values()) - calls_before,
+    }
+
+def print_report(results: Dict[str, Dict[str, Any]], baseline: Optional[Dict[str, Any]] = None):
+    """輸出結果表格（提供基準時一併顯示變化百分比）"""
+    header = (f"{'情境':<16}{'請求數':>8}{'RPS':>10}{'p50 ms':>10}{'p99 ms':>10}{'CPU ms/req':>12}"
+              f"{'對外請求':>10}  狀態碼")
+    print(header)
+    print("-" * (len(header) + 16))
+    for scenario, result in results.items():
+        cpu_ms = result.get("cpu_ms")
+        cpu_text = f"{cpu_ms:.3f}" if cpu_ms is not None else "n/a"
+        print(f"{scenario:<16}{result['requests']:>8}{result['rps']:>10.1f}{result['p50_ms']:>10.2f}"
+              f"{result['p99_ms']:>10.2f}{cpu_text:>12}{result['outbound_calls']:>10}  {result['statuses']}")
+        if baseline and scenario in baseline.get("results", {}):
+            base = baseline["results"][scenario]
+
+            def delta(key: str) -> str:
+                if not base.get(key) or result.get(key) is None:
+                    return "n/a"
+                return f"{(result[key] - base[key]) / base[key] * 100:+.1f}%"
+
+            print(f"{'  vs 基準':<16}{'':>8}{delta('rps'):>10}{delta('p50_ms'):>10}{delta('p99_ms'):>10}"
+                  f"{delta('cpu_ms'):>12}")
+
+async def run_benchmark(args) -> Dict[str, Any]:
+    keycloak = FakeKeycloak(latency=args.kc_latency_ms / 1000, failure_rate=args.kc_failure_rate,
+                            key_size=args.key_size)
+    keycloak_url = keycloak.start()
+    tokens = [keycloak.mint_token(f"user-{i}", lifetime=3600) for i in range(args.tokens)]
+
+    process, backend_url = start_backend(keycloak_url)
+    try:
+        results = {}
+        for scenario in args.scenarios:
+            # 預熱：讓後端完成端點探索與公鑰載入
+            await run_scenario(backend_url, scenario, tokens, min(args.concurrency, 4), args.warmup, keycloak)
+            results[scenario] = await run_scenario(
+                backend_url, scenario, tokens, args.concurrency, args.requests, keycloak, process.pid)
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+
+    return {
+        "config": {
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "tokens": args.tokens,
+            "kc_latency_ms": args.kc_latency_ms,
+            "kc_failure_rate": args.kc_failure_rate,
+            "key_size": args.key_size,
+        },
+        "results": results,
+        "keycloak_calls": dict(keycloak.calls),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Keycloak API 測試後端效能基準測試")
+    parser.add_argument("-c", "--concurrency", type=int, default=50, help="並行請求數（預設 50）")
+    parser.add_argument("-n", "--requests", type=int, default=2000, help="每個情境的請求數（預設 2000）")
+    parser.add_argument("--warmup", type=int, default=50, help="每個情境的預熱請求數（預設 50）")
+    parser.add_argument("--tokens", type=int, default=10, help="輪流使用的不同 Token 數量（預設 10）")
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS),
+                        help="要執行的情境")
+    parser.add_argument("--kc-latency-ms", type=float, default=0.0, help="模擬 Keycloak 每個請求的延遲（毫秒）")
+    parser.add_argument("--kc-failure-rate", type=float, default=0.0, help="模擬 Keycloak 回應 503 的比例（0~1）")
+    parser.add_argument("--key-size", type=int, default=2048, help="RSA 金鑰長度（預設 2048）")
+    parser.add_argument("--output", help="將結果寫入 JSON 檔案")
+    parser.add_argument("--baseline", help="與先前保存的 JSON 結果比較")
+    args = parser.parse_args()
+
+    report = asyncio.run(run_benchmark(args))
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(report["results"], baseline)
+    print(f"\n模擬 Keycloak 端點呼叫次數: {report['keycloak_calls']}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"結果已寫入 {args.output}")
+
+if __name__ == "__main__":
+    main()
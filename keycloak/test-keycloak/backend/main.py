@@ -18,15 +18,66 @@ Keycloak API 測試後端
 相容: Keycloak 17+ (包含 24.x 開發模式)
 """
 
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, Form, HTTPException, Query, Request, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from pydantic import BaseModel
-import requests
+from pydantic import BaseModel, ConfigDict, Field, field_validator, model_validator
+from contextlib import asynccontextmanager
+from urllib.parse import quote, urlsplit
+import httpx
 import json
-from jose import JWTError, jwt
-from typing import Optional, Dict, Any
+from jose import JWTError, jwk
+from jose.exceptions import ExpiredSignatureError, JWKError, JWTClaimsError
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from collections.abc import Mapping
+from types import MappingProxyType
+from typing import Optional, Dict, Any, List, Literal, Tuple
+import asyncio
+import atexit
+import base64
+import concurrent.futures
+import functools
+import gzip
+import hashlib
+import hmac
+import logging
+import logging.handlers
+import math
+import mmap
 import os
+import queue
+import random
+import stat
+import struct
+import time
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    應用程式生命週期管理
+    
+    啟動時建立共用的非同步 HTTP 客戶端、預先載入公鑰並啟動背景任務，關閉時依序釋放。
+    有快照時直接採用上次的端點與公鑰，不等待 Keycloak（由背景任務重新驗證）。
+    """
+    await start_http_client()
+    snapshot_loaded = False
+    if shared_store is not None:
+        endpoint_resolver.load_snapshot()
+        snapshot_loaded = jwks_cache.load_snapshot(settings.jwks_snapshot_max_age)
+    endpoint_resolver.start()
+    if settings.jwks_background_refresh:
+        if not snapshot_loaded:
+            await jwks_cache.warm(settings.jwks_warm_timeout)
+        jwks_cache.start()
+    try:
+        yield
+    finally:
+        await jwks_cache.stop()
+        await endpoint_resolver.stop()
+        await close_http_client()
+        shutdown_verify_executor()
 
 # 建立 FastAPI 應用實例
 app = FastAPI(
@@ -34,39 +85,657 @@ app = FastAPI(
     version="1.0.0",
     description="用於測試 Keycloak JWT 驗證和 API 整合的後端服務",
     docs_url="/docs",  # Swagger UI 文檔路徑
-    redoc_url="/redoc"  # ReDoc 文檔路徑
+    redoc_url="/redoc",  # ReDoc 文檔路徑
+    lifespan=lifespan   # 啟動/關閉時管理共用資源
 )
 
+# ============================================================================
+# 設定
+# ============================================================================
+# 所有可調整的設定集中在 Settings，啟動時從環境變數與 .env 檔讀取一次並驗證型別；
+# 由設定衍生的 URL 與 issuer 表也在啟動時預先組好，請求處理路徑上只做查表
+# 支援多種網絡配置，自動嘗試不同的 Keycloak 連接方式
+# 適用於不同的部署環境：本地開發、Docker、生產環境
+
+def _read_env_file(path: str) -> Dict[str, str]:
+    """
+    讀取 .env 檔（KEY=VALUE 格式，# 開頭為註解）
+    
+    Args:
+        path: .env 檔路徑
+        
+    Returns:
+        Dict[str, str]: 檔案中的設定，檔案不存在時為空字典
+    """
+    values: Dict[str, str] = {}
+    try:
+        with open(path, encoding="utf-8") as env_file:
+            lines = env_file.read().splitlines()
+    except FileNotFoundError:
+        return values
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if line.startswith("export "):
+            line = line[len("export "):]
+        key, separator, value = line.partition("=")
+        if not separator:
+            continue
+        value = value.strip()
+        if len(value) >= 2 and value[0] == value[-1] and value[0] in "\"'":
+            value = value[1:-1]
+        values[key.strip()] = value
+    return values
+
+# issuer 中 realm 之前可能出現的路徑前綴（新版 / 舊版 Keycloak）
+KEYCLOAK_PATH_PREFIXES = ("", "/auth")
+
+class KeycloakEndpoints:
+    """單一 (base_url, realm) 的 Keycloak 端點 URL（建立時一次組好）"""
+    
+    __slots__ = ("issuer", "jwks", "discovery", "token", "introspect", "admin_users")
+    
+    def __init__(self, base_url: str, realm: str, prefix: str = ""):
+        self.issuer = f"{base_url}{prefix}/realms/{realm}"                           # Token 的 iss，同時也是 realm 資訊端點
+        self.jwks = f"{self.issuer}/protocol/openid-connect/certs"
+        self.discovery = f"{self.issuer}/.well-known/openid-configuration"
+        self.token = f"{self.issuer}/protocol/openid-connect/token"
+        self.introspect = f"{self.issuer}/protocol/openid-connect/token/introspect"
+        self.admin_users = f"{base_url}{prefix}/admin/realms/{realm}/users"
+
+@functools.lru_cache(maxsize=4096)
+def keycloak_endpoints(base_url: str, realm: str, prefix: str = "") -> KeycloakEndpoints:
+    """取得 (base_url, realm) 的端點 URL（設定中的 realm 於啟動時預先建立，其餘 realm 第一次使用時建立）"""
+    return KeycloakEndpoints(base_url, realm, prefix)
+
+# 可由多個環境變數提供的設定（依序取第一個有設定的）
+_SETTINGS_ENV_ALIASES = {
+    "keycloak_urls": ("KEYCLOAK_URLS", "KEYCLOAK_URL"),
+    "cors_origins": ("CORS_ORIGINS", "FRONTEND_URL"),
+}
+
+class Settings(BaseModel):
+    """應用程式設定
+    
+    每個欄位對應同名的大寫環境變數（例如 jwks_cache_ttl ↔ JWKS_CACHE_TTL），
+    環境變數優先於 .env 檔，未設定時使用預設值；型別不符時啟動即失敗。
+    """
+    
+    model_config = ConfigDict(frozen=True)
+    
+    # Keycloak 連線設定
+    keycloak_urls: Tuple[str, ...] = (
+        "http://localhost:8080",                # 標準本地開發訪問
+        "http://127.0.0.1:8080",               # IP 地址訪問（避免 DNS 問題）
+        "http://host.docker.internal:8080",     # 從 Docker 容器訪問主機
+        "http://docker.for.mac.localhost:8080", # Mac Docker Desktop 舊版本支援
+    )
+    realm: str = "sam-test"                                   # 你的 Keycloak Realm 名稱
+    client_id: str = "myclient"                               # 你的 Keycloak Client ID
+    
+    # API 與 CORS 設定
+    api_host: str = "0.0.0.0"
+    api_port: int = 8000
+    cors_origins: Tuple[str, ...] = ("http://localhost:3000",)  # 允許的前端域名
+    
+    # 多 Realm（多租戶）設定
+    # 只接受下列 realm 發行的 Token，每個 realm 各自延遲載入並快取 JWKS
+    keycloak_realms: Tuple[str, ...] = ()                     # 信任的 realm（逗號分隔，* 表示任何 realm；預設只有 realm）
+    keycloak_realm_cache_size: int = 1000                     # 同時保留公鑰的 realm 數上限（LRU 淘汰閒置 realm）
+    keycloak_unknown_realm_ttl: float = 60                    # 不存在的 realm（Keycloak 回應 404）多久內不再抓取
+    
+    # JWKS 快取設定
+    # 避免每個受保護請求都重新向 Keycloak 抓取公鑰
+    jwks_cache_ttl: float = 300                               # 預設快取秒數（回應未帶 max-age 時）
+    jwks_cache_min_ttl: float = 30                            # 快取秒數下限（no-cache 時亦使用）
+    jwks_cache_max_ttl: float = 3600                          # 快取秒數上限
+    jwks_kid_miss_min_interval: float = 30                    # 未知 kid 觸發重新抓取的最小間隔
+    jwks_fetch_timeout: float = 5                             # 抓取公鑰（JWKS / discovery / realm 端點）的逾時秒數
+    jwks_failure_backoff: float = 2                           # 抓取失敗後，請求觸發的重新抓取至少間隔秒數（期間直接回傳錯誤）
+    
+    # JWKS 背景刷新設定
+    # 啟動時預先載入公鑰，並在過期前於背景刷新，請求不需要等待抓取
+    jwks_background_refresh: bool = True
+    jwks_refresh_ahead: float = 10                            # 在過期前幾秒刷新
+    jwks_refresh_backoff_max: float = 60                      # 刷新失敗時的最大重試間隔
+    jwks_stale_grace: float = 300                             # Keycloak 無法連線時，過期公鑰仍可使用的寬限秒數
+    jwks_warm_timeout: float = 10                             # 啟動時預先載入的等待上限
+    jwks_snapshot_max_age: float = 86400                      # 啟動時可採用的快照最長年齡（需設定 SHARED_CACHE_DIR）
+    
+    # Keycloak 端點探索設定
+    # 記住成功的端點，並以斷路器跳過無法連線的 URL
+    keycloak_circuit_failure_threshold: int = 3               # 連續失敗幾次後標記為不健康
+    keycloak_circuit_cooldown: float = 30                     # 不健康端點的冷卻秒數
+    keycloak_reprobe_interval: float = 60                     # 背景重新探測間隔（0 表示停用）
+    keycloak_probe_mode: Literal["race", "sequential"] = "race"  # race: 並行競速 / sequential: 依序嘗試
+    keycloak_explore_timeout: float = 2                       # /api/explore-keycloak 每個探測請求的逾時秒數
+    
+    # 已驗證 Token 結果快取設定（預設關閉）
+    # 同一個 Token 重複呼叫時略過簽名驗證
+    token_cache_enabled: bool = False
+    token_cache_max_size: int = 10000                         # 最多快取的 Token 數量
+    token_cache_max_age: float = 60                           # 單一 Token 最長快取秒數（仍受 exp 限制）
+    
+    # 對外 HTTP 連線池設定
+    # 所有對 Keycloak 的請求共用同一個非同步客戶端（keep-alive 連線重用）
+    http_timeout: float = 5                                   # 預設請求逾時秒數
+    http_max_connections: int = 100                           # 連線池總連線數上限
+    http_max_keepalive: int = 20                              # 保持存活的閒置連線數
+    http_max_connections_per_host: int = 10                   # 單一主機同時請求數上限
+    
+    # 日誌設定
+    log_level: str = "INFO"                                   # 整體日誌等級
+    log_format: Literal["text", "json"] = "text"              # text: 純文字 / json: 結構化 JSON
+    log_debug_stages: str = ""                                # 開啟 debug 的階段（逗號分隔，all 表示全部）
+    
+    # 指標 (Prometheus) 設定
+    metrics_enabled: bool = True                              # 是否提供 /metrics 端點
+    
+    # Token 刷新代理設定
+    refresh_timeout: float = 5                                # 刷新請求逾時秒數（連線逾時最多 2 秒）
+    refresh_result_ttl: float = 5                             # 相同 Refresh Token 的結果快取秒數（0 表示停用）
+    refresh_result_cache_size: int = 1000                     # 結果快取最多項目數
+    refresh_max_per_client: int = 4                           # 單一用戶端同時進行的刷新數上限
+    refresh_max_upstream: int = 20                            # 同時對 Keycloak 發出的刷新數上限
+    
+    # 多 worker 部署設定
+    workers: int = 1                                          # 直接執行 main.py 時的 worker 數（auto 表示依 CPU 核心數）
+    shared_cache_dir: str = ""                                # 跨 worker 共用 / 重啟後保留的快取目錄（空字串表示停用）
+    shared_token_cache_slots: int = 65536                     # 共用已驗證 Token 表的槽位數（每槽 48 bytes）
+    
+    # 回應序列化設定
+    response_gzip_min_size: int = 1024                        # 超過此位元組數才壓縮（用戶端支援 gzip 時）
+    response_gzip_level: int = 5                              # gzip 壓縮等級（1 最快 / 9 最小）
+    
+    # Token Introspection 設定（不透明 Token / 撤銷感知）
+    # off: 停用 / opaque: 只有非 JWT 格式的 Token 使用 introspection / always: 所有 Token 都使用 introspection
+    introspection_mode: Literal["off", "opaque", "always"] = "off"
+    introspection_client_id: str = ""                         # 呼叫 introspection 的 confidential client（預設為 client_id）
+    introspection_client_secret: str = ""
+    introspection_cache_ttl: float = 30                       # 有效結果快取秒數（仍受 exp 限制）
+    introspection_negative_ttl: float = 10                    # 無效結果快取秒數
+    introspection_cache_size: int = 10000                     # 結果快取最多項目數
+    introspection_timeout: float = 5                          # introspection 請求逾時秒數
+    
+    # 簽名驗證設定
+    verify_backend: Literal["cryptography", "jose"] = "cryptography"  # 驗證後端（見 bench_verify.py）
+    verify_algorithms: Tuple[str, ...] = ("RS256", "PS256", "ES256", "EdDSA")  # 允許的簽名算法（逗號分隔）
+    verify_pool: Literal["none", "thread", "process"] = "none"  # 單一 Token 驗證的簽名運算執行位置（none: 事件迴圈）
+    verify_pool_size: int = 4                                 # 驗證工作池大小（批次驗證一律使用工作池）
+    
+    # 批次驗證設定（/api/verify/batch）
+    batch_verify_max_tokens: int = 1000                       # 單次請求最多的 Token 數
+    batch_verify_secret: str = ""                             # 閘道 / sidecar 以 X-Batch-Verify-Secret 標頭帶入的共用密鑰（未設定時停用端點）
+    
+    # Keycloak Admin API 設定（/api/admin/users）
+    # 以 service account（client_credentials）呼叫，client 需要 realm-management 的 view-users 角色
+    admin_client_id: str = ""                                 # service account client（預設為 client_id）
+    admin_client_secret: str = ""                             # 未設定時停用 Admin API 呼叫
+    admin_page_size: int = 100                                # 每次向 Keycloak 取得的使用者數
+    admin_prefetch_pages: int = 2                             # 回傳目前分頁時同時預先抓取的後續分頁數
+    admin_timeout: float = 10                                 # Admin API 請求逾時秒數
+    admin_token_refresh_ahead: float = 30                     # service account Token 在到期前幾秒重新取得
+    
+    # Backchannel Logout 設定（/api/backchannel-logout）
+    revocation_max_token_lifetime: float = 3600               # 撤銷項目保留秒數（應不小於 realm 最長的 Access Token 有效期）
+    revocation_sync_interval: float = 1                       # 多 worker 時重新載入其他 worker 撤銷紀錄的間隔秒數
+    
+    # 速率限制設定（受保護端點依 Token 的 sub / azp，未驗證的端點依用戶端 IP）
+    rate_limit_enabled: bool = False
+    rate_limit_rate: float = 10                               # 每個用戶端每秒可用的請求數（token bucket 補充速率）
+    rate_limit_burst: int = 20                                # 每個用戶端可累積的突發請求數
+    # 個別路由的限制，逗號分隔的 路由=每秒請求數[:突發數]（例如 /api/debug-token=1:5；每秒請求數為 0 表示不限制）
+    rate_limit_routes: Dict[str, Tuple[float, int]] = {}
+    rate_limit_max_concurrent: int = 0                        # 每個用戶端同時處理中的請求上限（0 表示不限制）
+    rate_limit_max_keys: int = 100000                         # 每個路由最多追蹤的用戶端數（超過時淘汰最久未使用的）
+    rate_limit_sweep_interval: float = 60                     # 移除閒置用戶端的間隔秒數
+    # 受保護端點 Token 驗證失敗的限制（依用戶端 IP，所有路由共用；額度用完時在驗證前拒絕，每秒失敗次數為 0 表示不限制）
+    rate_limit_auth_failure_rate: float = 1                   # 每個 IP 每秒可容許的驗證失敗次數
+    rate_limit_auth_failure_burst: int = 20                   # 每個 IP 可累積的驗證失敗次數
+    
+    @model_validator(mode="before")
+    @classmethod
+    def _apply_defaults(cls, data: Any) -> Any:
+        """預設值依賴其他欄位的設定（未設定或為空字串時）"""
+        if isinstance(data, dict):
+            realm = data.get("realm") or cls.model_fields["realm"].default
+            if not data.get("keycloak_realms"):
+                data["keycloak_realms"] = (realm,)
+            client_id = data.get("client_id") or cls.model_fields["client_id"].default
+            if not data.get("introspection_client_id"):
+                data["introspection_client_id"] = client_id
+            if not data.get("admin_client_id"):
+                data["admin_client_id"] = client_id
+        return data
+    
+    @field_validator("keycloak_urls", "cors_origins", "keycloak_realms", "verify_algorithms", mode="before")
+    @classmethod
+    def _split_list(cls, value: Any) -> Any:
+        """逗號分隔字串 → tuple"""
+        if isinstance(value, str):
+            return tuple(item.strip() for item in value.split(",") if item.strip())
+        return value
+    
+    @field_validator("rate_limit_routes", mode="before")
+    @classmethod
+    def _parse_route_limits(cls, value: Any) -> Any:
+        """/a=1:5,/b=2 → {"/a": (1.0, 5), "/b": (2.0, 2)}（未指定突發數時為每秒請求數，至少 1）"""
+        if not isinstance(value, str):
+            return value
+        limits = {}
+        for item in value.split(","):
+            if not item.strip():
+                continue
+            route, separator, limit = item.partition("=")
+            if not separator:
+                raise ValueError(f"路由限制格式應為 路由=每秒請求數[:突發數]: {item.strip()}")
+            rate, _, burst = limit.partition(":")
+            limits[route.strip()] = (float(rate), int(burst) if burst.strip() else max(1, math.ceil(float(rate))))
+        return limits
+    
+    @field_validator("keycloak_urls")
+    @classmethod
+    def _normalize_urls(cls, value: Tuple[str, ...]) -> Tuple[str, ...]:
+        if not value:
+            raise ValueError("至少需要一個 Keycloak URL")
+        return tuple(url.rstrip("/") for url in value)
+    
+    @field_validator("workers", mode="before")
+    @classmethod
+    def _parse_workers(cls, value: Any) -> Any:
+        if isinstance(value, str) and value.strip().lower() == "auto":
+            return os.cpu_count() or 1
+        return value
+    
+    @field_validator("log_level")
+    @classmethod
+    def _upper_log_level(cls, value: str) -> str:
+        return value.upper()
+    
+    # ---- 衍生設定（第一次存取時計算一次，load() 會預先存取）----
+    
+    @functools.cached_property
+    def trusted_bases(self) -> frozenset:
+        """issuer 中 /realms/ 之前允許的部分（base_url × 新版 / 舊版路徑前綴）"""
+        return frozenset(
+            f"{base_url}{prefix}" for base_url in self.keycloak_urls for prefix in KEYCLOAK_PATH_PREFIXES
+        )
+    
+    @functools.cached_property
+    def issuer_realms(self) -> Dict[str, str]:
+        """設定中每個 realm 的合法 issuer → realm"""
+        return {
+            keycloak_endpoints(base_url, realm, prefix).issuer: realm
+            for realm in dict.fromkeys((self.realm, *self.keycloak_realms))
+            if realm != "*"
+            for base_url in self.keycloak_urls
+            for prefix in KEYCLOAK_PATH_PREFIXES
+        }
+    
+    @functools.cached_property
+    def valid_issuers(self) -> frozenset:
+        """合法 issuer 集合（O(1) 成員檢查）"""
+        return frozenset(self.issuer_realms)
+    
+    @classmethod
+    def load(cls, env_file: Optional[str] = None) -> "Settings":
+        """
+        從環境變數與 .env 檔載入設定，並預先建立衍生的 URL 與 issuer 表
+        
+        Args:
+            env_file: .env 檔路徑（預設為 ENV_FILE 環境變數，或 main.py 所在目錄的 .env）
+            
+        Returns:
+            Settings: 驗證過的設定
+            
+        Raises:
+            pydantic.ValidationError: 設定值型別或內容不正確
+        """
+        env_file = env_file or os.getenv("ENV_FILE") or os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env")
+        values = _read_env_file(env_file)
+        values.update(os.environ)  # 環境變數優先於 .env 檔
+        
+        data = {}
+        for name in cls.model_fields:
+            for key in _SETTINGS_ENV_ALIASES.get(name, (name.upper(),)):
+                if key in values:
+                    data[name] = values[key]
+                    break
+        loaded = cls(**data)
+        loaded.valid_issuers
+        loaded.trusted_bases
+        return loaded
+
+# 全域設定（啟動時載入一次）
+settings = Settings.load()
+
 # ============================================================================
 # CORS 設定 - 跨域資源共享
 # ============================================================================
 # 允許前端 (React) 從不同端口訪問 API
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["http://localhost:3000"],  # 允許的前端域名
+    allow_origins=list(settings.cors_origins),  # 允許的前端域名
     allow_credentials=True,  # 允許包含認證資訊（如 cookies）
     allow_methods=["*"],     # 允許所有 HTTP 方法
     allow_headers=["*"],     # 允許所有 HTTP 標頭
 )
 
+# HTTP Bearer Token 安全方案（用於提取 Authorization 標頭）
+security = HTTPBearer()
+
 # ============================================================================
-# Keycloak 配置設定
+# 日誌
 # ============================================================================
-# 支援多種網絡配置，自動嘗試不同的 Keycloak 連接方式
-# 適用於不同的部署環境：本地開發、Docker、生產環境
-KEYCLOAK_URLS = [
-    "http://localhost:8080",                # 標準本地開發訪問
-    "http://127.0.0.1:8080",               # IP 地址訪問（避免 DNS 問題）
-    "http://host.docker.internal:8080",     # 從 Docker 容器訪問主機
-    "http://docker.for.mac.localhost:8080", # Mac Docker Desktop 舊版本支援
-]
+# 使用 logging 取代 print：訊息延遲格式化，且實際輸出由背景執行緒負責，
+# 請求處理路徑上不會進行同步的 stdout 寫入
 
-# Keycloak Realm 和 Client 設定
-REALM = "sam-test"      # 你的 Keycloak Realm 名稱
-CLIENT_ID = "myclient"  # 你的 Keycloak Client ID
+logger = logging.getLogger("keycloak_backend")
+endpoint_logger = logger.getChild("endpoint")  # Keycloak 端點探索 / 斷路器
+jwks_logger = logger.getChild("jwks")          # JWKS 快取與金鑰解析
+verify_logger = logger.getChild("verify")      # Token 驗證
+admin_logger = logger.getChild("admin")        # Keycloak Admin API
 
-# HTTP Bearer Token 安全方案（用於提取 Authorization 標頭）
-security = HTTPBearer()
+# 可個別開啟 debug 的階段
+LOG_STAGES = {
+    "endpoint": endpoint_logger,
+    "jwks": jwks_logger,
+    "verify": verify_logger,
+    "admin": admin_logger,
+}
+
+class _JsonFormatter(logging.Formatter):
+    """結構化 JSON 日誌格式（包含透過 extra 傳入的欄位）"""
+    
+    _RESERVED = frozenset(logging.LogRecord("", 0, "", 0, "", (), None).__dict__) | {"message", "asctime"}
+    
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in self._RESERVED:
+                data[key] = value
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+def configure_logging() -> logging.handlers.QueueListener:
+    """
+    設定應用程式日誌
+    
+    - 日誌記錄只放入佇列，由 QueueListener 的背景執行緒寫出（非阻塞）
+    - LOG_DEBUG_STAGES 可只對特定階段開啟 debug，例如 "endpoint,jwks"
+    
+    Returns:
+        logging.handlers.QueueListener: 已啟動的背景輸出執行緒
+    """
+    handler = logging.StreamHandler()
+    if settings.log_format == "json":
+        handler.setFormatter(_JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    
+    logger.handlers[:] = [logging.handlers.QueueHandler(log_queue)]
+    logger.setLevel(settings.log_level)
+    logger.propagate = False
+    
+    stages = {stage.strip() for stage in settings.log_debug_stages.split(",") if stage.strip()}
+    for stage, stage_logger in LOG_STAGES.items():
+        stage_logger.setLevel(logging.DEBUG if stage in stages or "all" in stages else logging.NOTSET)
+    
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+log_listener = configure_logging()
+
+# ============================================================================
+# 指標 (Prometheus 格式)
+# ============================================================================
+# 輕量的計數器 / 直方圖實作，只在記憶體中累加，/metrics 被抓取時才轉成文字格式
+
+# 延遲直方圖的預設分桶（秒）
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _format_labels(labelnames, values) -> str:
+    if not labelnames:
+        return ""
+    pairs = []
+    for name, value in zip(labelnames, values):
+        escaped = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{escaped}"')
+    return "{" + ",".join(pairs) + "}"
+
+class Counter:
+    """只會遞增的計數器（標籤值以位置參數傳入）"""
+    
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple, float] = {}
+    
+    def inc(self, *labelvalues, amount: float = 1.0):
+        self._values[labelvalues] = self._values.get(labelvalues, 0.0) + amount
+    
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} counter"
+        for labelvalues, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, labelvalues)} {value}"
+
+class Histogram:
+    """分桶直方圖（標籤值以位置參數傳入）"""
+    
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._states: Dict[Tuple, list] = {}               # 標籤值 → [各分桶計數..., 總和, 總數]
+    
+    def observe(self, value: float, *labelvalues):
+        state = self._states.get(labelvalues)
+        if state is None:
+            state = self._states[labelvalues] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        state[bisect_left(self.buckets, value)] += 1
+        state[-2] += value
+        state[-1] += 1
+    
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        bucket_labelnames = self.labelnames + ("le",)
+        for labelvalues, state in self._states.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), state):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                yield f"{self.name}_bucket{_format_labels(bucket_labelnames, labelvalues + (le,))} {cumulative}"
+            labels = _format_labels(self.labelnames, labelvalues)
+            yield f"{self.name}_sum{labels} {state[-2]}"
+            yield f"{self.name}_count{labels} {state[-1]}"
+
+class MetricsRegistry:
+    """指標註冊表
+    
+    除了直接累加的指標之外，也可以註冊收集函數（collector），
+    在抓取時才讀取快取統計等既有的計數值。
+    """
+    
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+    
+    def counter(self, name: str, documentation: str, labelnames=()) -> Counter:
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+    
+    def histogram(self, name: str, documentation: str, labelnames=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+    
+    def add_collector(self, collector):
+        """註冊收集函數，回傳 (名稱, 類型, 說明, [(標籤 dict, 值), ...]) 的清單"""
+        self._collectors.append(collector)
+    
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            for name, metric_type, documentation, samples in collector():
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(tuple(labels), tuple(labels.values()))} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+
+# Token 驗證各階段延遲（parse / issuer / jwks / key_select / signature / claims / total）
+VERIFY_STAGE_SECONDS = metrics.histogram(
+    "auth_verify_stage_seconds", "Token 驗證各階段耗時", ("stage",))
+# 驗證失敗次數（依原因）
+AUTH_FAILURES = metrics.counter(
+    "auth_failures_total", "Token 驗證失敗（401）次數", ("reason",))
+# 對 Keycloak 的公鑰請求（依 base_url 與策略）
+KEYCLOAK_REQUESTS = metrics.counter(
+    "keycloak_key_requests_total", "對 Keycloak 發出的公鑰請求次數", ("base_url", "strategy", "outcome"))
+KEYCLOAK_REQUEST_SECONDS = metrics.histogram(
+    "keycloak_key_request_seconds", "對 Keycloak 發出的公鑰請求耗時", ("base_url", "strategy"))
+# Token 刷新代理（依處理結果：upstream / coalesced / cached / throttled / error）
+REFRESH_REQUESTS = metrics.counter(
+    "token_refresh_requests_total", "Token 刷新請求次數", ("outcome",))
+# Token Introspection（依處理結果：cached / coalesced / upstream / error）
+INTROSPECTION_REQUESTS = metrics.counter(
+    "token_introspection_requests_total", "Token introspection 請求次數", ("outcome",))
+# 批次驗證的 Token 數（依結果：valid 或失敗原因）
+BATCH_VERIFY_TOKENS = metrics.counter(
+    "auth_batch_tokens_total", "批次驗證的 Token 數", ("result",))
+# Backchannel Logout（依結果：session / subject / invalid）
+BACKCHANNEL_LOGOUTS = metrics.counter(
+    "auth_backchannel_logouts_total", "收到的 Backchannel Logout 次數", ("result",))
+# Keycloak Admin API（依類型：token / page / retry / error）
+ADMIN_API_REQUESTS = metrics.counter(
+    "keycloak_admin_requests_total", "對 Keycloak Admin API 發出的請求次數", ("outcome",))
+# 速率限制拒絕次數（依路由）
+RATE_LIMITED = metrics.counter(
+    "rate_limited_total", "速率限制拒絕 (429) 次數", ("route",))
+# 授權拒絕次數（依政策）
+AUTHZ_DENIALS = metrics.counter(
+    "authz_denied_total", "授權政策拒絕次數 (403)", ("policy",))
+# HTTP 端點處理延遲
+HTTP_REQUEST_SECONDS = metrics.histogram(
+    "http_request_duration_seconds", "API 請求處理耗時", ("method", "route", "status"))
+
+class MetricsMiddleware:
+    """記錄每個 API 請求耗時的 ASGI 中介層"""
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        start = time.perf_counter()
+        status_code = 500
+        
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+        
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            route_path = getattr(route, "path", "unmatched")
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, scope["method"], route_path, status_code)
+
+if settings.metrics_enabled:
+    app.add_middleware(MetricsMiddleware)
+
+# ============================================================================
+# 回應序列化
+# ============================================================================
+# 高流量端點自行組出 JSON bytes 直接回傳：略過 jsonable_encoder 與 response_model 驗證
+# （資料都是我們自己從 Claims 組出來的，不需要再檢查一次）
+
+# orjson 為選用套件（比標準 json 快數倍），未安裝時使用標準 json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def _json_default(value: Any) -> Any:
+    """序列化 JSON 原生不支援的型別：唯讀 mapping（Claims 的 payload）轉為一般物件"""
+    if isinstance(value, ReadOnlyDict):
+        return value._data                                     # 直接序列化底層 dict，不逐層轉換
+    if isinstance(value, MappingProxyType):
+        return dict(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def dump_json(content: Any) -> bytes:
+    """序列化為 JSON bytes（格式與 FastAPI 預設的 JSONResponse 相同：UTF-8、無多餘空白）"""
+    if orjson is not None:
+        return orjson.dumps(content, default=_json_default)
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":"),
+                      default=_json_default).encode("utf-8")
+
+class FastJSONResponse(JSONResponse):
+    """以 dump_json 序列化的 JSON 回應（用於 response_class，讓 OpenAPI 文件標示為 JSON）"""
+    
+    def render(self, content: Any) -> bytes:
+        return dump_json(content)
+
+def _accepts_gzip(accept_encoding: str) -> bool:
+    """解析 Accept-Encoding，判斷用戶端是否接受 gzip（q=0 視為不接受）"""
+    for item in accept_encoding.split(","):
+        coding, _, params = item.partition(";")
+        if coding.strip().lower() not in ("gzip", "*"):
+            continue
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                return float(params[2:]) > 0
+            except ValueError:
+                return False
+        return True
+    return False
+
+def json_response(content: Any, request: Optional[Request] = None) -> Response:
+    """
+    建立 JSON 回應
+    
+    Args:
+        content: 要回傳的資料（只包含 JSON 原生型別）
+        request: 提供時依 Accept-Encoding 協商 gzip 壓縮（適用於較大的回應）
+        
+    Returns:
+        Response: 已序列化的 JSON 回應
+    """
+    body = dump_json(content)
+    headers = None
+    if request is not None:
+        headers = {"Vary": "Accept-Encoding"}
+        if len(body) >= settings.response_gzip_min_size and _accepts_gzip(request.headers.get("accept-encoding", "")):
+            body = gzip.compress(body, compresslevel=settings.response_gzip_level)
+            headers["Content-Encoding"] = "gzip"
+    return Response(body, media_type="application/json", headers=headers)
 
 # ============================================================================
 # 資料模型定義 (Pydantic Models)
@@ -84,227 +753,2955 @@ class UserInfo(BaseModel):
     given_name: Optional[str] = None           # 名字
     family_name: Optional[str] = None          # 姓氏
 
+class BatchVerifyRequest(BaseModel):
+    """批次驗證請求資料模型"""
+    tokens: List[str] = Field(max_length=settings.batch_verify_max_tokens)  # 要驗證的 Token（結果依相同順序回傳）
+    mode: Literal["full", "basic"] = "full"     # full: 完整驗證 / basic: 基本驗證（不驗證簽名）
+
 class TokenValidationError(Exception):
     """自定義例外：Token 驗證錯誤
     
-    用於處理 JWT Token 驗證過程中的各種錯誤情況
+    用於處理 JWT Token 驗證過程中的各種錯誤情況
+    """
+    pass
+
+class KeycloakStatusError(TokenValidationError):
+    """自定義例外：Keycloak 端點回應非預期的 HTTP 狀態碼（例如 realm 不存在時的 404）"""
+    
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+
+class TokenRevokedError(JWTClaimsError):
+    """自定義例外：Token 所屬的 session / 使用者已登出（見 RevocationIndex）"""
+    pass
+
+# ============================================================================
+# 共用非同步 HTTP 客戶端
+# ============================================================================
+# 避免在 async 函數中呼叫同步的 requests，阻塞整個事件迴圈
+
+# HTTP/2 需要額外安裝 h2 套件，未安裝時自動使用 HTTP/1.1
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+_http_client: Optional[httpx.AsyncClient] = None
+_host_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+def _create_http_client() -> httpx.AsyncClient:
+    """建立具備連線池與 keep-alive 的非同步 HTTP 客戶端"""
+    return httpx.AsyncClient(
+        http2=HTTP2_AVAILABLE,
+        timeout=settings.http_timeout,
+        limits=httpx.Limits(
+            max_connections=settings.http_max_connections,
+            max_keepalive_connections=settings.http_max_keepalive,
+        ),
+    )
+
+async def start_http_client():
+    """建立共用 HTTP 客戶端（由 lifespan 在啟動時呼叫）"""
+    global _http_client
+    if _http_client is None:
+        _http_client = _create_http_client()
+
+async def close_http_client():
+    """關閉共用 HTTP 客戶端並釋放連線池（由 lifespan 在關閉時呼叫）"""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+    _host_semaphores.clear()
+
+def get_http_client() -> httpx.AsyncClient:
+    """
+    取得共用 HTTP 客戶端
+    
+    在 lifespan 以外被呼叫時（例如直接匯入模組使用）會自動建立。
+    """
+    global _http_client
+    if _http_client is None:
+        _http_client = _create_http_client()
+    return _http_client
+
+def _host_semaphore(url: str) -> asyncio.Semaphore:
+    """取得目標主機的並行請求限制"""
+    parts = urlsplit(url)
+    host = f"{parts.scheme}://{parts.netloc}"
+    semaphore = _host_semaphores.get(host)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(settings.http_max_connections_per_host)
+        _host_semaphores[host] = semaphore
+    return semaphore
+
+def _pool_timeout(timeout: Any) -> Optional[float]:
+    """請求的 timeout 參數中等待連線名額的秒數（httpx.Timeout 取 pool，數字直接使用）"""
+    if isinstance(timeout, httpx.Timeout):
+        return timeout.pool
+    return timeout
+
+async def http_request(method: str, url: str, **kwargs) -> httpx.Response:
+    """
+    透過共用客戶端發送 HTTP 請求
+    
+    所有對 Keycloak 的對外請求都應該經過此函數，以套用連線池與單一主機並行上限。
+    等待單一主機並行名額的時間也受請求的逾時限制（慢的刷新或 Admin API 請求佔滿名額時，
+    JWKS 與 introspection 請求不會無限期排隊）。
+    
+    Args:
+        method: HTTP 方法
+        url: 目標 URL
+        **kwargs: 傳遞給 httpx 的其他參數（timeout、data 等）
+        
+    Returns:
+        httpx.Response: HTTP 回應
+        
+    Raises:
+        httpx.PoolTimeout: 等待並行名額逾時
+        httpx.HTTPError: 請求失敗
+    """
+    semaphore = _host_semaphore(url)
+    try:
+        await asyncio.wait_for(semaphore.acquire(), _pool_timeout(kwargs.get("timeout", settings.http_timeout)))
+    except TimeoutError:
+        raise httpx.PoolTimeout(f"等待 {urlsplit(url).netloc} 的並行名額逾時") from None
+    try:
+        return await get_http_client().request(method, url, **kwargs)
+    finally:
+        semaphore.release()
+
+# ============================================================================
+# 跨程序共用快取（多 worker）
+# ============================================================================
+# 以多個 worker 執行時，每個程序各自的記憶體快取都是冷的。
+# 公鑰與已驗證 Token 透過本機檔案共用，新增 worker 不會倍增對 Keycloak 的請求。
+
+# 檔案鎖只在 Unix 上提供，其他平台不協調抓取（仍會共用結果）
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# 不跟隨符號連結開啟檔案（不支援的平台為 0）
+_O_NOFOLLOW = getattr(os, "O_NOFOLLOW", 0)
+
+def _check_private(stat_result: os.stat_result, path: str):
+    """
+    確認共用快取的目錄或檔案屬於目前使用者，且群組與其他使用者不可寫入
+    
+    共用快取的內容會被直接信任（公鑰、已驗證 Token 摘要），他人可寫入時就能植入偽造的公鑰。
+    
+    Raises:
+        PermissionError: 擁有者不是目前使用者，或群組 / 其他使用者可寫入
+    """
+    if hasattr(os, "getuid") and stat_result.st_uid != os.getuid():
+        raise PermissionError(f"共用快取 {path} 的擁有者 (uid {stat_result.st_uid}) 不是目前使用者")
+    if stat_result.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise PermissionError(f"共用快取 {path} 可被群組或其他使用者寫入 (mode {stat.S_IMODE(stat_result.st_mode):o})")
+
+def _open_private(path: str, flags: int) -> int:
+    """以 O_NOFOLLOW 開啟共用快取檔案（新檔案權限為 0600），並確認擁有者與權限"""
+    fd = os.open(path, flags | _O_NOFOLLOW, 0o600)
+    try:
+        _check_private(os.fstat(fd), path)
+    except OSError:
+        os.close(fd)
+        raise
+    return fd
+
+class SharedFileStore:
+    """跨程序共用的 JSON 檔案快取
+    
+    每個項目是目錄中的一個 JSON 檔案：
+    1. 寫入時先寫暫存檔再 os.replace，讀取端不會看到寫到一半的內容
+    2. 以 flock 檔案鎖協調抓取：同一時間只有一個 worker 向 Keycloak 抓取，其他 worker 等待結果
+    3. 目錄與檔案必須屬於目前使用者且他人不可寫入，檔案一律以 O_NOFOLLOW 開啟
+    """
+    
+    def __init__(self, directory: str):
+        """
+        Raises:
+            PermissionError: 目錄不屬於目前使用者，或群組 / 其他使用者可寫入
+        """
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        _check_private(os.stat(directory), directory)
+        self.directory = directory
+    
+    def _path(self, name: str, suffix: str = ".json") -> str:
+        return os.path.join(self.directory, quote(name, safe="") + suffix)
+    
+    def read(self, name: str) -> Optional[Dict[str, Any]]:
+        """讀取項目，不存在或內容損毀時回傳 None"""
+        path = self._path(name)
+        try:
+            with open(_open_private(path, os.O_RDONLY), "rb") as entry_file:
+                data = json.loads(entry_file.read())
+        except PermissionError as e:
+            logger.warning("忽略不安全的共用快取檔案: %s", e)
+            return None
+        except (OSError, ValueError):
+            return None
+        return data if isinstance(data, dict) else None
+    
+    def version(self, name: str) -> Optional[Tuple[int, int]]:
+        """項目目前的版本（inode 與修改時間，每次寫入都會改變），不存在時回傳 None"""
+        try:
+            stat_result = os.lstat(self._path(name))
+        except OSError:
+            return None
+        return stat_result.st_ino, stat_result.st_mtime_ns
+    
+    def write(self, name: str, data: Dict[str, Any]):
+        """以原子替換方式寫入項目（失敗時只記錄警告）"""
+        path = self._path(name)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(_open_private(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC), "wb") as entry_file:
+                entry_file.write(json.dumps(data, separators=(",", ":")).encode())
+            os.replace(temp_path, path)
+        except OSError as e:
+            logger.warning("無法寫入共用快取 %s: %s", path, e)
+    
+    def try_lock(self, name: str) -> Optional[int]:
+        """
+        嘗試取得項目的跨程序鎖（不阻塞）
+        
+        Returns:
+            Optional[int]: 成功時回傳鎖的檔案描述符（不支援檔案鎖時為 -1），已被其他程序持有時回傳 None
+        """
+        if fcntl is None:
+            return -1
+        fd = _open_private(self._path(name, ".lock"), os.O_RDWR | os.O_CREAT)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return None
+        return fd
+    
+    def lock(self, name: str) -> int:
+        """
+        取得項目的跨程序鎖（阻塞等待，只用於短暫的讀取-合併-寫入）
+        
+        Returns:
+            int: 鎖的檔案描述符（不支援檔案鎖時為 -1）
+        """
+        if fcntl is None:
+            return -1
+        fd = _open_private(self._path(name, ".lock"), os.O_RDWR | os.O_CREAT)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        except OSError:
+            os.close(fd)
+            raise
+        return fd
+    
+    @staticmethod
+    def unlock(fd: int):
+        """釋放 try_lock() / lock() 取得的鎖"""
+        if fd >= 0:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+class SharedTokenTable:
+    """跨程序共用的已驗證 Token 摘要表（mmap 檔案）
+    
+    固定大小的直接映射 (direct-mapped) 表，碰撞時直接覆蓋：
+    - 每個槽位保存 Token 的 SHA-256 摘要、到期時間與世代 (epoch)
+    - 只代表「簽名與發行者已驗證」，命中時仍會重新檢查 exp / aud 等 claims
+    - 金鑰輪替時遞增 epoch，所有舊項目同時失效
+    """
+    
+    _MAGIC = 0x4B43544F4B454E31                                # 檔案格式識別碼
+    _HEADER = struct.Struct("<QQQ")                            # magic、槽位數、epoch
+    _SLOT = struct.Struct("<32sdQ")                            # 摘要、到期時間 (time.time())、epoch
+    
+    def __init__(self, path: str, slots: int):
+        """
+        Raises:
+            PermissionError: 檔案不屬於目前使用者，或群組 / 其他使用者可寫入
+        """
+        self._slots = slots
+        size = self._HEADER.size + slots * self._SLOT.size
+        fd = _open_private(path, os.O_RDWR | os.O_CREAT)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fd).st_size != size:
+                    os.ftruncate(fd, 0)                        # 格式不同時整個清空
+                    os.ftruncate(fd, size)
+                self._map = mmap.mmap(fd, size)
+                magic, stored_slots, _ = self._HEADER.unpack_from(self._map, 0)
+                if magic != self._MAGIC or stored_slots != slots:
+                    self._map[:] = bytes(size)
+                    self._HEADER.pack_into(self._map, 0, self._MAGIC, slots, 1)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+        self.hits = 0                                          # 命中次數
+        self.misses = 0                                        # 未命中次數
+    
+    def _epoch(self) -> int:
+        return self._HEADER.unpack_from(self._map, 0)[2]
+    
+    def _offset(self, digest: bytes) -> int:
+        return self._HEADER.size + int.from_bytes(digest[:8], "little") % self._slots * self._SLOT.size
+    
+    def contains(self, token: str) -> bool:
+        """Token 是否已由任一 worker 驗證過（且尚未過期、未因金鑰輪替失效）"""
+        digest = hashlib.sha256(token.encode()).digest()
+        stored_digest, expires_at, epoch = self._SLOT.unpack_from(self._map, self._offset(digest))
+        if stored_digest == digest and epoch == self._epoch() and time.time() < expires_at:
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+    
+    def put(self, token: str, expires_at: float):
+        """記錄已驗證的 Token"""
+        digest = hashlib.sha256(token.encode()).digest()
+        self._SLOT.pack_into(self._map, self._offset(digest), digest, expires_at, self._epoch())
+    
+    def clear(self):
+        """使所有項目失效（金鑰輪替時呼叫）"""
+        magic, slots, epoch = self._HEADER.unpack_from(self._map, 0)
+        self._HEADER.pack_into(self._map, 0, magic, slots, epoch + 1)
+    
+    def stats(self) -> Dict[str, Any]:
+        """共用表統計資訊（僅本 worker 的查詢次數）"""
+        return {"slots": self._slots, "hits": self.hits, "misses": self.misses}
+
+# 全域共用快取（SHARED_CACHE_DIR 未設定時為 None）
+shared_store: Optional[SharedFileStore] = SharedFileStore(settings.shared_cache_dir) if settings.shared_cache_dir else None
+
+# ============================================================================
+# 簽名驗證後端
+# ============================================================================
+# 公鑰在 JWKS 載入時由驗證後端建構成 VerifierKey，簽名算法取自 JWK 的 alg：
+# - cryptography（預設）：直接呼叫 cryptography，支援 RS256 / PS256 / ES256 / EdDSA
+# - jose：沿用 python-jose 的金鑰物件，支援 RS256 / ES256
+# 兩者的效能可用 bench_verify.py 比較。
+# 簽名驗證可選擇交給執行緒池或程序池（VERIFY_POOL），避免 RSA 運算佔用事件迴圈
+
+def _b64url_uint(value: str) -> int:
+    return int.from_bytes(base64.urlsafe_b64decode(value + "=" * (-len(value) % 4)), "big")
+
+def _jwk_algorithm(key_data: Dict[str, Any]) -> str:
+    """JWK 的簽名算法（未標示 alg 時依金鑰類型推斷）"""
+    alg = key_data.get("alg")
+    if alg:
+        return alg
+    kty = key_data.get("kty")
+    if kty == "EC":
+        return "ES256"
+    if kty == "OKP":
+        return "EdDSA"
+    return "RS256"
+
+class VerifierKey:
+    """單一公鑰的簽名驗證器（由驗證後端建立）
+    
+    verify(signing_input, signature) 回傳簽名是否正確。
+    交給程序池時只傳送 JWK，由工作程序重新建構（並快取）金鑰。
+    """
+    
+    __slots__ = ("backend", "alg", "key_data", "verify")
+    
+    def __init__(self, backend: str, alg: str, key_data: Dict[str, Any], verify):
+        self.backend = backend                                  # 建立此金鑰的驗證後端名稱
+        self.alg = alg                                          # 此金鑰可驗證的簽名算法
+        self.key_data = key_data                                # 原始 JWK
+        self.verify = verify                                    # (signing_input, signature) -> bool
+    
+    def __reduce__(self):
+        return (_load_verifier_key, (self.backend, self.key_data))
+
+class VerificationBackend:
+    """簽名驗證後端介面"""
+    
+    name = ""
+    algorithms: frozenset = frozenset()                        # 支援的簽名算法
+    
+    def _verifier(self, key_data: Dict[str, Any], alg: str):
+        """建立 (signing_input, signature) -> bool 的驗證函數"""
+        raise NotImplementedError
+    
+    def load_key(self, key_data: Dict[str, Any]) -> VerifierKey:
+        """
+        由 JWK 建立驗證器
+        
+        Raises:
+            JWKError: 不支援的算法或金鑰內容不正確
+        """
+        alg = _jwk_algorithm(key_data)
+        if alg not in self.algorithms:
+            raise JWKError(f"{self.name} 驗證後端不支援算法 {alg}")
+        try:
+            verify = self._verifier(key_data, alg)
+        except JWKError:
+            raise
+        except Exception as e:
+            raise JWKError(f"無法解析 {alg} 公鑰: {e}")
+        return VerifierKey(self.name, alg, key_data, verify)
+
+class JoseBackend(VerificationBackend):
+    """python-jose 驗證後端（python-jose 不支援 PS256 與 EdDSA）"""
+    
+    name = "jose"
+    algorithms = frozenset({"RS256", "ES256"})
+    
+    def _verifier(self, key_data: Dict[str, Any], alg: str):
+        return jwk.construct(key_data, alg).verify
+
+class CryptographyBackend(VerificationBackend):
+    """直接使用 cryptography 的驗證後端（略過 python-jose 的包裝層）"""
+    
+    name = "cryptography"
+    algorithms = frozenset({"RS256", "PS256", "ES256", "EdDSA"})
+    
+    def _verifier(self, key_data: Dict[str, Any], alg: str):
+        from cryptography.exceptions import InvalidSignature
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.asymmetric import ec, ed448, ed25519, padding, rsa
+        from cryptography.hazmat.primitives.asymmetric.utils import encode_dss_signature
+        
+        kty = key_data.get("kty")
+        if alg in ("RS256", "PS256"):
+            if kty != "RSA":
+                raise JWKError(f"{alg} 需要 RSA 金鑰，收到 {kty}")
+            public_key = rsa.RSAPublicNumbers(_b64url_uint(key_data["e"]), _b64url_uint(key_data["n"])).public_key()
+            if alg == "RS256":
+                pad = padding.PKCS1v15()
+            else:
+                # RFC 7518：PSS 的 salt 長度等於雜湊長度
+                pad = padding.PSS(mgf=padding.MGF1(hashes.SHA256()), salt_length=hashes.SHA256.digest_size)
+            algorithm = hashes.SHA256()
+            
+            def verify(signing_input: bytes, signature: bytes) -> bool:
+                try:
+                    public_key.verify(signature, signing_input, pad, algorithm)
+                except InvalidSignature:
+                    return False
+                return True
+            return verify
+        
+        if alg == "ES256":
+            if kty != "EC" or key_data.get("crv") != "P-256":
+                raise JWKError("ES256 需要 P-256 EC 金鑰")
+            public_key = ec.EllipticCurvePublicNumbers(
+                _b64url_uint(key_data["x"]), _b64url_uint(key_data["y"]), ec.SECP256R1()).public_key()
+            algorithm = ec.ECDSA(hashes.SHA256())
+            
+            def verify(signing_input: bytes, signature: bytes) -> bool:
+                # JWS 的 ECDSA 簽名為固定長度的 r || s，cryptography 需要 DER 格式
+                if len(signature) != 64:
+                    return False
+                der = encode_dss_signature(int.from_bytes(signature[:32], "big"), int.from_bytes(signature[32:], "big"))
+                try:
+                    public_key.verify(der, signing_input, algorithm)
+                except InvalidSignature:
+                    return False
+                return True
+            return verify
+        
+        # EdDSA
+        curves = {"Ed25519": ed25519.Ed25519PublicKey, "Ed448": ed448.Ed448PublicKey}
+        if kty != "OKP" or key_data.get("crv") not in curves:
+            raise JWKError("EdDSA 需要 Ed25519 / Ed448 OKP 金鑰")
+        x = key_data["x"]
+        public_key = curves[key_data["crv"]].from_public_bytes(base64.urlsafe_b64decode(x + "=" * (-len(x) % 4)))
+        
+        def verify(signing_input: bytes, signature: bytes) -> bool:
+            try:
+                public_key.verify(signature, signing_input)
+            except InvalidSignature:
+                return False
+            return True
+        return verify
+
+# 可用的驗證後端
+VERIFICATION_BACKENDS: Dict[str, VerificationBackend] = {
+    backend.name: backend for backend in (CryptographyBackend(), JoseBackend())
+}
+
+# 目前使用的驗證後端（VERIFY_BACKEND）
+verification_backend = VERIFICATION_BACKENDS[settings.verify_backend]
+
+# 程序池工作程序中重新建構的金鑰（JWK → VerifierKey）
+_process_keys: Dict[Tuple[str, str], VerifierKey] = {}
+
+def _load_verifier_key(backend: str, key_data: Dict[str, Any]) -> VerifierKey:
+    """在程序池工作程序中還原 VerifierKey（同一把金鑰只建構一次）"""
+    cache_key = (backend, json.dumps(key_data, sort_keys=True))
+    key = _process_keys.get(cache_key)
+    if key is None:
+        if len(_process_keys) >= 64:
+            _process_keys.clear()
+        key = _process_keys[cache_key] = VERIFICATION_BACKENDS[backend].load_key(key_data)
+    return key
+
+_verify_executor: Optional[concurrent.futures.Executor] = None
+
+def get_verify_executor() -> concurrent.futures.Executor:
+    """
+    取得簽名驗證用的工作池（第一次使用時建立，大小為 VERIFY_POOL_SIZE）
+    
+    VERIFY_POOL=process 時為程序池，否則為執行緒池（批次驗證一律使用工作池）。
+    """
+    global _verify_executor
+    if _verify_executor is None:
+        if settings.verify_pool == "process":
+            _verify_executor = concurrent.futures.ProcessPoolExecutor(max_workers=settings.verify_pool_size)
+        else:
+            _verify_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=settings.verify_pool_size, thread_name_prefix="verify")
+    return _verify_executor
+
+def shutdown_verify_executor():
+    """關閉簽名驗證工作池"""
+    global _verify_executor
+    if _verify_executor is not None:
+        _verify_executor.shutdown(wait=False, cancel_futures=True)
+        _verify_executor = None
+
+# ============================================================================
+# 核心功能函數
+# ============================================================================
+
+def _parse_cache_max_age(headers) -> Optional[float]:
+    """
+    解析 Cache-Control 標頭中的快取秒數
+    
+    Args:
+        headers: HTTP 回應標頭
+        
+    Returns:
+        Optional[float]: max-age 秒數；no-cache / no-store 回傳 0；未指定時回傳 None
+    """
+    cache_control = headers.get("cache-control", "")
+    if not cache_control:
+        return None
+    
+    max_age = None
+    for directive in cache_control.lower().split(","):
+        directive = directive.strip()
+        if directive in ("no-cache", "no-store"):
+            return 0.0
+        if directive.startswith("max-age="):
+            try:
+                max_age = float(directive.split("=", 1)[1])
+            except ValueError:
+                continue
+    return max_age
+
+# 公鑰取得策略（依優先順序分組）
+# 每個候選端點是 (base_url, 策略) 的組合，成功後會被記住並優先重用
+KEY_STRATEGY_GROUPS = (
+    ("jwks", "jwks_legacy"),        # 策略 1: 直接 JWKS 端點（Keycloak 17+ / 16- 舊版路徑）
+    ("openid", "openid_legacy"),    # 策略 2: OpenID Connect Discovery（備用）
+    ("realm",),                     # 策略 3: Realm 端點 PEM 公鑰（開發模式）
+)
+
+# 策略優先順序（數字越小越優先）
+_STRATEGY_PRIORITY = {
+    strategy: priority
+    for priority, group in enumerate(KEY_STRATEGY_GROUPS)
+    for strategy in group
+}
+
+# 舊版 Keycloak (16-) 的路徑前綴
+_LEGACY_STRATEGIES = frozenset({"jwks_legacy", "openid_legacy"})
+
+def _realm_info_to_jwks(realm_info: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    公鑰格式轉換: PEM → JWKS
+    
+    Keycloak 開發模式提供 PEM 格式，但 JWT 驗證需要 JWKS 格式
+    
+    Args:
+        realm_info: Realm 端點回傳的資訊（包含 public_key 欄位）
+        
+    Returns:
+        dict: JWKS 格式的公鑰資訊
+    """
+    from cryptography.hazmat.primitives.serialization import load_pem_public_key
+    import base64
+    
+    # 重建完整的 PEM 格式公鑰
+    # Keycloak 只提供公鑰內容，需要添加 PEM 標頭和標尾
+    pem_key = f"-----BEGIN PUBLIC KEY-----\n{realm_info['public_key']}\n-----END PUBLIC KEY-----"
+    public_key = load_pem_public_key(pem_key.encode())
+    
+    # 提取算法資訊（預設為 RS256）
+    algorithm = realm_info.get("algorithm", "RS256")
+    
+    # 建構標準 JWKS (JSON Web Key Set) 格式
+    # 將 RSA 公鑰轉換為 JWT 驗證所需的格式
+    return {
+        "keys": [{
+            "kty": "RSA",                                    # 金鑰類型: RSA
+            "use": "sig",                                    # 用途: 數位簽名
+            "kid": realm_info.get("realm", "default"),     # 金鑰識別碼
+            "n": base64.urlsafe_b64encode(                   # RSA 模數 (n)
+                public_key.public_numbers().n.to_bytes(
+                    (public_key.key_size + 7) // 8, 'big'
+                )
+            ).decode().rstrip('='),
+            "e": base64.urlsafe_b64encode(                   # RSA 指數 (e)
+                public_key.public_numbers().e.to_bytes(3, 'big')
+            ).decode().rstrip('='),
+            "alg": algorithm                                # 簽名算法
+        }]
+    }
+
+async def _fetch_key_with_strategy(base_url: str, strategy: str, realm: str = settings.realm) -> Tuple[Dict[str, Any], Optional[float]]:
+    """
+    使用指定的 (base_url, 策略) 組合抓取公鑰
+    
+    Args:
+        base_url: Keycloak 基礎 URL
+        strategy: 策略名稱（見 KEY_STRATEGY_GROUPS）
+        realm: Realm 名稱
+        
+    Returns:
+        Tuple[dict, Optional[float]]: JWKS 格式的公鑰資訊，以及回應 Cache-Control 的快取秒數
+        
+    Raises:
+        httpx.TransportError: 無法連線到 Keycloak
+        TokenValidationError: 端點回應不正確
+    """
+    endpoints = keycloak_endpoints(base_url, realm, "/auth" if strategy in _LEGACY_STRATEGIES else "")
+    
+    if strategy in ("jwks", "jwks_legacy"):
+        # 這是最直接的方式，跳過 OpenID Connect Discovery
+        url = endpoints.jwks
+        response = await http_request("GET", url, timeout=settings.jwks_fetch_timeout)
+        if response.status_code != 200:
+            raise KeycloakStatusError(response.status_code, f"JWKS 端點回應 {response.status_code}: {url}")
+        jwks_data = response.json()
+        if "keys" not in jwks_data:
+            raise TokenValidationError(f"JWKS 端點缺少 keys: {url}")
+        return jwks_data, _parse_cache_max_age(response.headers)
+    
+    if strategy in ("openid", "openid_legacy"):
+        # 這是 Keycloak 生產模式的標準做法，提供完整的配置資訊
+        url = endpoints.discovery
+        response = await http_request("GET", url, timeout=settings.jwks_fetch_timeout)
+        if response.status_code != 200:
+            raise KeycloakStatusError(response.status_code, f"OpenID 配置回應 {response.status_code}: {url}")
+        jwks_uri = response.json()["jwks_uri"]
+        jwks_response = await http_request("GET", jwks_uri, timeout=settings.jwks_fetch_timeout)
+        jwks_response.raise_for_status()
+        return jwks_response.json(), _parse_cache_max_age(jwks_response.headers)
+    
+    if strategy == "realm":
+        # 適用於 Keycloak 開發模式或自定義配置，直接從 realm 資訊獲取公鑰
+        url = endpoints.issuer
+        response = await http_request("GET", url, timeout=settings.jwks_fetch_timeout)
+        if response.status_code != 200:
+            raise KeycloakStatusError(response.status_code, f"Realm 端點回應 {response.status_code}: {url}")
+        realm_info = response.json()
+        if not realm_info.get("public_key"):
+            raise TokenValidationError(f"Realm 端點未提供公鑰: {url}")
+        return _realm_info_to_jwks(realm_info), _parse_cache_max_age(response.headers)
+    
+    raise ValueError(f"未知的公鑰取得策略: {strategy}")
+
+def _exploration_error(errors: List[Exception]) -> Exception:
+    """
+    探索時所有候選端點都失敗的例外
+    
+    全部都回應 404 時保留 KeycloakStatusError，讓 IssuerRegistry 把 realm 記為不存在；
+    否則為一般的 TokenValidationError。
+    """
+    if errors and all(isinstance(e, KeycloakStatusError) and e.status_code == 404 for e in errors):
+        return errors[0]
+    return TokenValidationError("無法從任何端點獲取 Keycloak 公鑰")
+
+def _is_endpoint_failure(error: Exception) -> bool:
+    """
+    是否為端點本身的故障（連線失敗、逾時或 5xx）
+    
+    4xx（例如 realm 不存在時的 404）代表端點正常，只是該 realm 的請求無效。
+    """
+    if isinstance(error, httpx.TransportError):
+        return True
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500
+    if isinstance(error, KeycloakStatusError):
+        return error.status_code >= 500
+    return False
+
+class KeycloakEndpointResolver:
+    """Keycloak 端點探索與記憶
+    
+    記住第一個成功的 (base_url, 策略) 組合，之後的抓取直接使用該端點，
+    避免每次都依序嘗試所有 URL 並等待逾時：
+    1. 穩定狀態下只對已知可用的端點發出一次請求
+    2. 斷路器 (circuit breaker)：連續連線失敗的 base_url 會被標記為不健康，冷卻期間跳過
+    3. 背景重新探測：定期檢查不健康的 base_url，恢復後重新納入候選
+    4. 競速探索：沒有已知端點時同時嘗試所有候選，延遲約為一次往返時間
+    5. 快照（提供 snapshot_store 時）：記住的端點寫入檔案，重新啟動後直接使用
+    """
+    
+    def __init__(self, base_urls, failure_threshold: int, cooldown: float, reprobe_interval: float,
+                 probe_mode: str = "race", snapshot_store: Optional["SharedFileStore"] = None):
+        self._base_urls = base_urls                            # 候選 base_url 清單（依優先順序）
+        self._probe_mode = probe_mode                          # 探索模式: race（並行競速）或 sequential（依序）
+        self._failure_threshold = failure_threshold
+        self._cooldown = cooldown
+        self._reprobe_interval = reprobe_interval
+        self._preferred: Optional[Tuple[str, str]] = None      # 已知可用的 (base_url, 策略)
+        self._failures: Dict[str, int] = {}                    # 各 base_url 連續失敗次數
+        self._open_until: Dict[str, float] = {}                # 各 base_url 斷路器開啟期限（monotonic）
+        self._task: Optional[asyncio.Task] = None
+        self._snapshot_store = snapshot_store
+    
+    def _remember(self, candidate: Tuple[str, str]):
+        """記住可用的 (base_url, 策略)，並寫入快照"""
+        endpoint_logger.info("成功獲取公鑰並記住端點: %s (%s)", candidate[0], candidate[1],
+                             extra={"base_url": candidate[0], "strategy": candidate[1]})
+        self._preferred = candidate
+        if self._snapshot_store is not None:
+            self._snapshot_store.write("endpoint", {"base_url": candidate[0], "strategy": candidate[1]})
+    
+    def load_snapshot(self) -> bool:
+        """
+        載入上次記住的端點（啟動時使用）
+        
+        Returns:
+            bool: 快照存在且端點仍在候選清單中時回傳 True
+        """
+        if self._snapshot_store is None or self._preferred is not None:
+            return False
+        entry = self._snapshot_store.read("endpoint") or {}
+        candidate = (entry.get("base_url"), entry.get("strategy"))
+        if candidate[0] not in self._base_urls or candidate[1] not in _STRATEGY_PRIORITY:
+            return False
+        self._preferred = candidate
+        endpoint_logger.info("已從快照載入端點: %s (%s)", candidate[0], candidate[1])
+        return True
+    
+    @property
+    def preferred(self) -> Optional[Tuple[str, str]]:
+        """目前記住的 (base_url, 策略)"""
+        return self._preferred
+    
+    @property
+    def base_url(self) -> str:
+        """目前建議使用的 base_url（已知可用 → 第一個健康 → 第一個候選）"""
+        if self._preferred and self.is_healthy(self._preferred[0]):
+            return self._preferred[0]
+        for base_url in self._base_urls:
+            if self.is_healthy(base_url):
+                return base_url
+        return self._base_urls[0]
+    
+    def is_healthy(self, base_url: str) -> bool:
+        """斷路器未開啟（或冷卻期已過，允許再試一次）"""
+        return time.monotonic() >= self._open_until.get(base_url, 0.0)
+    
+    def record_success(self, base_url: str):
+        """連線成功：重置失敗計數並關閉斷路器"""
+        self._failures.pop(base_url, None)
+        self._open_until.pop(base_url, None)
+    
+    def record_failure(self, base_url: str):
+        """端點故障（連線失敗、逾時或 5xx）：累計失敗次數，達到門檻時開啟斷路器"""
+        failures = self._failures.get(base_url, 0) + 1
+        self._failures[base_url] = failures
+        if failures >= self._failure_threshold:
+            if self.is_healthy(base_url):
+                endpoint_logger.warning("Keycloak 端點標記為不健康（冷卻 %.0f 秒）: %s", self._cooldown, base_url,
+                                        extra={"base_url": base_url})
+            self._open_until[base_url] = time.monotonic() + self._cooldown
+    
+    def candidates(self):
+        """
+        依優先順序列出候選 (base_url, 策略)
+        
+        跳過斷路器開啟中的 base_url；全部都不健康時仍回傳完整清單，避免永久失敗。
+        """
+        healthy = [base_url for base_url in self._base_urls if self.is_healthy(base_url)]
+        base_urls = healthy or list(self._base_urls)
+        return [
+            (base_url, strategy)
+            for group in KEY_STRATEGY_GROUPS
+            for base_url in base_urls
+            for strategy in group
+        ]
+    
+    async def _try(self, base_url: str, strategy: str, realm: str = settings.realm) -> Tuple[Dict[str, Any], Optional[float]]:
+        """嘗試單一候選端點，並更新斷路器狀態與指標（連線失敗、逾時與 5xx 計為端點故障）"""
+        start = time.perf_counter()
+        try:
+            result = await _fetch_key_with_strategy(base_url, strategy, realm)
+        except httpx.TransportError:
+            self.record_failure(base_url)
+            KEYCLOAK_REQUESTS.inc(base_url, strategy, "unreachable")
+            raise
+        except asyncio.CancelledError:
+            KEYCLOAK_REQUESTS.inc(base_url, strategy, "cancelled")
+            raise
+        except Exception as e:
+            if _is_endpoint_failure(e):                        # 5xx 同樣計入斷路器；404 等 4xx 代表端點正常
+                self.record_failure(base_url)
+            KEYCLOAK_REQUESTS.inc(base_url, strategy, "error")
+            raise
+        finally:
+            KEYCLOAK_REQUEST_SECONDS.observe(time.perf_counter() - start, base_url, strategy)
+        KEYCLOAK_REQUESTS.inc(base_url, strategy, "success")
+        self.record_success(base_url)
+        return result
+    
+    async def fetch_public_key(self, realm: str = settings.realm) -> Tuple[Dict[str, Any], Optional[float]]:
+        """
+        抓取公鑰：優先使用已知可用端點，失敗時才重新探索
+        
+        已知端點與 realm 無關（同一個 Keycloak 上的所有 realm 共用），
+        因此多個 realm 之間也會重用探索結果。
+        已知端點只在連線失敗、逾時或 5xx 時才放棄並重新探索；
+        4xx（例如不存在的 realm 回應 404）直接拋出，不影響其他 realm，也不會對所有候選端點重新探索。
+        
+        Args:
+            realm: Realm 名稱
+            
+        Returns:
+            Tuple[dict, Optional[float]]: JWKS 格式的公鑰資訊，以及快取秒數
+            
+        Raises:
+            KeycloakStatusError: 所有候選端點都回應 404（realm 不存在）時拋出
+            TokenValidationError: 所有候選端點都失敗時拋出
+        """
+        preferred = self._preferred
+        if preferred and self.is_healthy(preferred[0]):
+            try:
+                return await self._try(*preferred, realm)
+            except Exception as e:
+                if not _is_endpoint_failure(e):
+                    raise
+                endpoint_logger.warning("已知端點失敗，重新探索: %s (%s): %s", preferred[0], preferred[1], e,
+                                        extra={"base_url": preferred[0], "strategy": preferred[1]})
+                self._preferred = None
+        
+        candidates = [candidate for candidate in self.candidates() if candidate != preferred]
+        if self._probe_mode == "race":
+            return await self._race(candidates, realm)
+        
+        errors = []
+        for base_url, strategy in candidates:
+            # 同一輪探索中剛被斷路器標記的 base_url 不再嘗試其他策略
+            if not self.is_healthy(base_url) and any(self.is_healthy(url) for url in self._base_urls):
+                continue
+            try:
+                endpoint_logger.debug("嘗試公鑰端點: %s (%s)", base_url, strategy)
+                result = await self._try(base_url, strategy, realm)
+            except Exception as e:
+                endpoint_logger.debug("公鑰端點失敗: %s (%s): %s", base_url, strategy, e)
+                errors.append(e)
+                continue
+            self._remember((base_url, strategy))
+            return result
+        
+        raise _exploration_error(errors)
+    
+    async def _race(self, candidates, realm: str = settings.realm) -> Tuple[Dict[str, Any], Optional[float]]:
+        """
+        競速模式：同時對所有候選端點發出請求，採用第一個有效回應並取消其餘請求
+        
+        為了避免記住較差的策略，較低優先的策略成功時會先保留結果，
+        直到所有較高優先的請求都失敗後才採用。
+        
+        Raises:
+            KeycloakStatusError: 所有候選端點都回應 404（realm 不存在）時拋出
+            TokenValidationError: 所有候選端點都失敗時拋出
+        """
+        errors = []
+        pending: Dict[asyncio.Task, Tuple[str, str]] = {
+            asyncio.create_task(self._try(base_url, strategy, realm)): (base_url, strategy)
+            for base_url, strategy in candidates
+        }
+        best: Optional[Tuple[int, Tuple[str, str], Tuple[Dict[str, Any], Optional[float]]]] = None
+        
+        def higher_priority_pending(priority: int) -> bool:
+            return any(_STRATEGY_PRIORITY[candidate[1]] < priority for candidate in pending.values())
+        
+        try:
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    base_url, strategy = pending.pop(task)
+                    if task.exception() is not None:
+                        endpoint_logger.debug("公鑰端點失敗: %s (%s): %s", base_url, strategy, task.exception())
+                        errors.append(task.exception())
+                        continue
+                    priority = _STRATEGY_PRIORITY[strategy]
+                    if best is None or priority < best[0]:
+                        best = (priority, (base_url, strategy), task.result())
+                
+                if best is not None and not higher_priority_pending(best[0]):
+                    _, candidate, result = best
+                    self._remember(candidate)
+                    return result
+        finally:
+            # 取消尚未完成的請求
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+        
+        raise _exploration_error(errors)
+    
+    async def reprobe(self):
+        """重新探測斷路器開啟中的 base_url，恢復者重新納入候選"""
+        strategy = self._preferred[1] if self._preferred else KEY_STRATEGY_GROUPS[0][0]
+        for base_url in list(self._open_until):
+            try:
+                await _fetch_key_with_strategy(base_url, strategy)
+            except Exception:
+                # 仍然失敗：延長冷卻時間
+                self._open_until[base_url] = time.monotonic() + self._cooldown
+                continue
+            endpoint_logger.info("Keycloak 端點已恢復: %s", base_url, extra={"base_url": base_url})
+            self.record_success(base_url)
+    
+    async def _reprobe_loop(self):
+        while True:
+            await asyncio.sleep(self._reprobe_interval)
+            try:
+                await self.reprobe()
+            except Exception as e:
+                endpoint_logger.warning("背景重新探測失敗: %s", e)
+    
+    def start(self):
+        """啟動背景重新探測（由 lifespan 呼叫）"""
+        if self._task is None and self._reprobe_interval > 0:
+            self._task = asyncio.create_task(self._reprobe_loop())
+    
+    async def stop(self):
+        """停止背景重新探測（由 lifespan 呼叫）"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+# 全域 Keycloak 端點探索實例
+endpoint_resolver = KeycloakEndpointResolver(
+    settings.keycloak_urls,
+    failure_threshold=settings.keycloak_circuit_failure_threshold,
+    cooldown=settings.keycloak_circuit_cooldown,
+    reprobe_interval=settings.keycloak_reprobe_interval,
+    probe_mode=settings.keycloak_probe_mode,
+    snapshot_store=shared_store,
+)
+
+async def _fetch_public_key(realm: str = settings.realm) -> Tuple[Dict[str, Any], Optional[float]]:
+    """
+    從 Keycloak 抓取公鑰 - 支援多版本 Keycloak
+    
+    這個函數實現了多層次的相容性策略：
+    1. 直接嘗試標準 JWKS 端點
+    2. 回退到 OpenID Connect Discovery
+    3. 回退到直接 Realm 端點 (適用於開發模式或舊版本)，並自動轉換公鑰格式 (PEM → JWKS)
+    
+    成功的端點會被記住，之後直接重用（見 KeycloakEndpointResolver）。
+    
+    Args:
+        realm: Realm 名稱（預設為 settings.realm）
+    
+    Returns:
+        Tuple[dict, Optional[float]]: JWKS 格式的公鑰資訊，以及回應 Cache-Control 的快取秒數
+        
+    Raises:
+        TokenValidationError: 無法獲取公鑰時拋出
+        
+    注意: 此函數會發出網路請求，一般請使用有快取的 get_public_key()
+        
+    支援的 Keycloak 版本：
+    - Keycloak 17+ (標準生產模式)
+    - Keycloak 24.x (開發模式)
+    - 舊版 Keycloak (相容性支援)
+    """
+    try:
+        return await endpoint_resolver.fetch_public_key(realm)
+    except TokenValidationError:
+        raise
+    except Exception as e:
+        raise TokenValidationError(f"無法獲取 Keycloak 公鑰: {str(e)}")
+
+class KeySet:
+    """預先解析的公鑰集合
+    
+    JWKS 載入時就把每把金鑰建構成可直接驗證簽名的金鑰物件，並依 kid 建立索引：
+    - 每個請求不需要重新從 base64 的 n / e 建構 RSA 公鑰
+    - 依 kid 查詢為 O(1)，不需要線性掃描 jwks["keys"]
+    - 金鑰輪替時整個物件一次替換，讀取端不會看到半更新的狀態
+    """
+    
+    __slots__ = ("jwks", "keys", "default")
+    
+    def __init__(self, jwks: Dict[str, Any]):
+        keys: Dict[Optional[str], Any] = {}
+        default = None
+        for key_data in jwks.get("keys", []):
+            # 跳過加密用金鑰（Keycloak 的 JWKS 會同時提供 RSA-OAEP 金鑰）
+            if key_data.get("use", "sig") != "sig":
+                continue
+            try:
+                key = verification_backend.load_key(key_data)
+            except JWKError as e:
+                jwks_logger.warning("略過無法解析的公鑰 %s: %s", key_data.get("kid"), e)
+                continue
+            keys[key_data.get("kid")] = key
+            if default is None:
+                default = key
+        
+        self.jwks = jwks                                        # 原始 JWKS（提供給 get_public_key()）
+        self.keys = keys                                        # kid → 金鑰物件
+        self.default = default                                  # 第一把簽名金鑰（kid 不符時的回退）
+    
+    def get(self, kid: Optional[str]):
+        """依 kid 取得金鑰物件，找不到時回傳 None"""
+        return self.keys.get(kid)
+    
+    def __contains__(self, kid: Optional[str]) -> bool:
+        return kid in self.keys
+
+class JWKSCache:
+    """JWKS 公鑰快取
+    
+    在記憶體中保存最近一次抓取的 JWKS，避免每個請求都向 Keycloak 發出網路請求：
+    1. TTL 過期機制（優先採用回應的 Cache-Control max-age，並限制在上下限之間）
+    2. 遇到未知 kid 時提前刷新（金鑰輪替），並依上次嘗試抓取的時間限制頻率（抓取失敗時同樣有效），
+       避免被惡意 kid 灌爆
+    3. 單一抓取 (single-flight)：同時間只有一個抓取任務，其他請求等待同一個任務，共用結果或例外；
+       抓取失敗後 failure_backoff 秒內由請求觸發的抓取直接拋出上次的錯誤，不再呼叫 Keycloak
+    4. 抓取後立即解析為 KeySet，驗證時不需要再解析金鑰
+    5. 背景刷新：啟動時預先載入，並在過期前刷新（失敗時以隨機抖動的指數退避重試）
+    6. 寬限期：Keycloak 暫時無法連線時，過期的公鑰在寬限期內仍可使用
+    7. 跨 worker 共用（提供 shared_store 時）：優先採用其他 worker 剛抓取的 JWKS，
+       並以檔案鎖確保同一時間只有一個 worker 向 Keycloak 抓取
+    8. 快照：共用檔案在重新啟動後仍然有效，啟動時直接載入（可超過 TTL，但不超過快照年齡上限）
+    """
+    
+    def __init__(self, fetcher, ttl: float, min_ttl: float, max_ttl: float, kid_miss_min_interval: float,
+                 stale_grace: float = 0.0, refresh_ahead: float = 10.0, backoff_max: float = 60.0,
+                 shared_store: Optional[SharedFileStore] = None, shared_name: str = "jwks",
+                 shared_wait: float = 5.0, failure_backoff: float = 2.0):
+        self._fetcher = fetcher                                # 實際抓取 JWKS 的協程函數
+        self._ttl = ttl
+        self._min_ttl = min_ttl
+        self._max_ttl = max_ttl
+        self._kid_miss_min_interval = kid_miss_min_interval
+        self._key_set: Optional[KeySet] = None
+        self._expires_at = 0.0                                 # 過期時間（monotonic）
+        self._last_attempt = 0.0                               # 最近一次開始抓取的時間（monotonic，不論成功與否）
+        self._inflight: Optional[asyncio.Task] = None          # 進行中的抓取任務（所有等待者共用）
+        self._failure_backoff = failure_backoff
+        self._failed_until = 0.0                               # 在此之前不再由請求觸發抓取（monotonic）
+        self._last_error: Optional[Exception] = None           # 最近一次抓取失敗的例外
+        self._rotation_listeners = []                          # 金鑰輪替時呼叫的回呼函數
+        self.hits = 0                                          # 快取命中次數
+        self.misses = 0                                        # 快取未命中（需要抓取）次數
+        self.fetches = 0                                       # 實際抓取次數
+        self.stale_served = 0                                  # 以過期公鑰回應的次數（寬限期內）
+        self.refresh_failures = 0                              # 抓取失敗次數
+        self._stale_grace = stale_grace
+        self._refresh_ahead = refresh_ahead
+        self._backoff_max = backoff_max
+        self._task: Optional[asyncio.Task] = None
+        self._shared_store = shared_store                      # 跨 worker 共用的檔案快取
+        self._shared_name = shared_name                        # 在共用快取中的項目名稱
+        self._shared_wait = shared_wait                        # 等待其他 worker 抓取的上限秒數
+        self._fetched_wall = 0.0                               # 目前公鑰的抓取時間（time.time()，跨程序比較用）
+        self._stale_until = 0.0                                # 快照公鑰可使用的期限（monotonic，超過 TTL 的快照用）
+        self.shared_adopted = 0                                # 採用其他 worker 抓取結果的次數
+    
+    def add_rotation_listener(self, callback):
+        """註冊金鑰輪替回呼（kid 集合改變時呼叫，例如清除已驗證 Token 快取）"""
+        self._rotation_listeners.append(callback)
+    
+    def _compute_ttl(self, max_age: Optional[float]) -> float:
+        """根據 Cache-Control 計算實際快取秒數"""
+        if max_age is None:
+            return self._ttl
+        return min(max(max_age, self._min_ttl), self._max_ttl)
+    
+    @property
+    def loaded(self) -> bool:
+        """是否已有公鑰（抓取成功或已載入快照）"""
+        return self._key_set is not None
+    
+    @property
+    def last_error(self) -> Optional[Exception]:
+        """最近一次抓取失敗的例外（之後抓取成功時為 None）"""
+        return self._last_error
+    
+    def has_kid(self, kid: Optional[str]) -> bool:
+        """檢查目前快取的 JWKS 是否包含指定 kid"""
+        key_set = self._key_set
+        return key_set is not None and kid in key_set
+    
+    def _within_grace(self) -> bool:
+        """過期的公鑰是否仍在寬限期內（或仍在快照的可使用期限內）"""
+        now = time.monotonic()
+        return self._key_set is not None and (now < self._expires_at + self._stale_grace or now < self._stale_until)
+    
+    async def get_key_set(self) -> KeySet:
+        """
+        取得預先解析的公鑰集合，快取有效時不發出任何網路請求
+        
+        背景刷新執行中時，寬限期內的過期公鑰直接回傳（由背景任務負責刷新）；
+        否則同步抓取，抓取失敗但仍在寬限期內時回傳最後一次成功的公鑰。
+        """
+        key_set = self._key_set
+        if key_set is not None and time.monotonic() < self._expires_at:
+            self.hits += 1
+            return key_set
+        
+        if self._task is not None and self._within_grace():
+            self.stale_served += 1
+            return key_set
+        
+        self.misses += 1
+        try:
+            return await self._refresh()
+        except Exception as e:
+            if not self._within_grace():
+                raise
+            self.stale_served += 1
+            jwks_logger.warning("JWKS 刷新失敗，使用最後一次成功的公鑰: %s", e)
+            return self._key_set
+    
+    async def get(self) -> Dict[str, Any]:
+        """取得原始 JWKS，快取有效時不發出任何網路請求"""
+        return (await self.get_key_set()).jwks
+    
+    async def refresh_for_kid(self, kid: Optional[str]) -> KeySet:
+        """
+        遇到未知 kid 時提前刷新 JWKS
+        
+        距離上次嘗試抓取（包括失敗的抓取）未滿最小間隔時不會刷新，直接回傳目前的公鑰集合。
+        """
+        key_set = self._key_set
+        if key_set is not None:
+            if kid in key_set:
+                return key_set
+            if time.monotonic() - self._last_attempt < self._kid_miss_min_interval:
+                return key_set
+        return await self._refresh()
+    
+    def _install(self, jwks: Dict[str, Any], ttl: float, fetched_wall: float) -> KeySet:
+        """解析並替換目前的公鑰集合，kid 集合改變時通知輪替回呼"""
+        key_set = KeySet(jwks)
+        previous = self._key_set
+        now = time.monotonic()
+        self._key_set = key_set                                # 一次替換整個公鑰集合
+        self._fetched_wall = fetched_wall
+        self._expires_at = now + ttl
+        self._stale_until = 0.0
+        
+        if previous is not None and previous.keys.keys() != key_set.keys.keys():
+            jwks_logger.info("偵測到金鑰輪替: %s → %s", list(previous.keys), list(key_set.keys))
+            for callback in self._rotation_listeners:
+                callback()
+        return key_set
+    
+    def _adopt_shared(self) -> Optional[KeySet]:
+        """採用共用快取中比目前更新、且尚未過期的 JWKS"""
+        entry = self._shared_store.read(self._shared_name)
+        if entry is None:
+            return None
+        try:
+            fetched_wall = float(entry["fetched_at"])
+            remaining = fetched_wall + float(entry["ttl"]) - time.time()
+            jwks = entry["jwks"]
+        except (KeyError, TypeError, ValueError):
+            return None
+        if fetched_wall <= self._fetched_wall or remaining <= 0:
+            return None
+        self.shared_adopted += 1
+        return self._install(jwks, remaining, fetched_wall)
+    
+    async def _wait_for_shared(self) -> Optional[KeySet]:
+        """其他 worker 正在抓取時，等待其結果寫入共用快取"""
+        deadline = time.monotonic() + self._shared_wait
+        while time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+            key_set = self._adopt_shared()
+            if key_set is not None:
+                return key_set
+        return None
+    
+    async def _refresh(self, force: bool = False) -> KeySet:
+        """
+        抓取 JWKS（single-flight）
+        
+        已有抓取任務進行中時等待同一個任務；上次抓取失敗且仍在 failure_backoff 內時直接拋出該錯誤。
+        
+        Args:
+            force: 忽略失敗退避（背景刷新使用，本身已有退避）
+        """
+        task = self._inflight
+        if task is None:
+            if not force and self._last_error is not None and time.monotonic() < self._failed_until:
+                raise self._last_error
+            task = self._inflight = asyncio.create_task(self._fetch())
+            task.add_done_callback(self._fetch_done)
+        # shield: 單一等待者被取消時不取消共用的抓取任務
+        return await asyncio.shield(task)
+    
+    def _fetch_done(self, task: asyncio.Task):
+        self._inflight = None
+        if not task.cancelled():
+            task.exception()                                   # 沒有等待者時避免 "exception was never retrieved"
+    
+    async def _fetch(self) -> KeySet:
+        """實際抓取；其他 worker 已抓取（或正在抓取）時直接採用其結果"""
+        self._last_attempt = time.monotonic()
+        shared_lock = None
+        if self._shared_store is not None:
+            key_set = self._adopt_shared()
+            if key_set is not None:
+                return key_set
+            shared_lock = self._shared_store.try_lock(self._shared_name)
+            if shared_lock is None:
+                key_set = await self._wait_for_shared()
+                if key_set is not None:
+                    return key_set
+        
+        try:
+            jwks, max_age = await self._fetcher()
+        except Exception as e:
+            self.refresh_failures += 1
+            self._last_error = e
+            self._failed_until = time.monotonic() + self._failure_backoff
+            raise
+        finally:
+            if shared_lock is not None:
+                self._shared_store.unlock(shared_lock)
+        self._last_error = None
+        self.fetches += 1
+        ttl = self._compute_ttl(max_age)
+        fetched_wall = time.time()
+        if self._shared_store is not None:
+            self._shared_store.write(self._shared_name, {"jwks": jwks, "fetched_at": fetched_wall, "ttl": ttl})
+        return self._install(jwks, ttl, fetched_wall)
+    
+    def clear(self):
+        """清除快取，下一次 get() 會重新抓取"""
+        self._key_set = None
+        self._expires_at = 0.0
+        self._fetched_wall = 0.0
+    
+    def load_snapshot(self, max_age: float) -> bool:
+        """
+        啟動時載入上次成功抓取的 JWKS 快照，不需要等待 Keycloak
+        
+        快照已超過 TTL 但未超過 max_age 時仍會載入，在 max_age 內可繼續使用，
+        並由背景刷新（或下一次請求）重新向 Keycloak 驗證。
+        
+        Args:
+            max_age: 快照最長年齡（秒），超過時忽略
+            
+        Returns:
+            bool: 是否成功載入
+        """
+        if self._shared_store is None or self._key_set is not None:
+            return False
+        entry = self._shared_store.read(self._shared_name)
+        if entry is None:
+            return False
+        try:
+            fetched_wall = float(entry["fetched_at"])
+            ttl = float(entry["ttl"])
+            jwks = entry["jwks"]
+        except (KeyError, TypeError, ValueError):
+            return False
+        age = max(time.time() - fetched_wall, 0.0)
+        if age > max_age:
+            jwks_logger.info("JWKS 快照已超過 %.0f 秒，忽略", max_age)
+            return False
+        
+        key_set = self._install(jwks, max(ttl - age, 0.0), fetched_wall)
+        if age >= ttl:
+            self._stale_until = time.monotonic() + (max_age - age)
+        jwks_logger.info("已從快照載入 JWKS（%.0f 秒前抓取）: %s", age, list(key_set.keys))
+        return True
+    
+    async def warm(self, timeout: float):
+        """
+        啟動時預先載入公鑰（warm start）
+        
+        Keycloak 無法連線時只記錄警告，不阻止應用程式啟動。
+        """
+        try:
+            await asyncio.wait_for(self._refresh(force=True), timeout)
+            jwks_logger.info("已預先載入 JWKS: %s", list(self._key_set.keys))
+        except Exception as e:
+            jwks_logger.warning("啟動時無法預先載入 JWKS，將於背景重試: %s", e or type(e).__name__)
+    
+    def _next_refresh_delay(self) -> float:
+        """距離下一次排程刷新的秒數（過期前 refresh_ahead 秒）"""
+        return max(self._expires_at - self._refresh_ahead - time.monotonic(), 1.0)
+    
+    async def _refresh_loop(self):
+        failures = 0
+        while True:
+            if self._key_set is not None and failures == 0:
+                await asyncio.sleep(self._next_refresh_delay())
+            try:
+                await self._refresh(force=True)
+                failures = 0
+            except Exception as e:
+                failures += 1
+                # 指數退避加上隨機抖動，避免多個實例同時重試
+                delay = min(self._backoff_max, 2 ** (failures - 1)) * random.uniform(0.5, 1.0)
+                jwks_logger.warning("背景刷新 JWKS 失敗（第 %d 次），%.1f 秒後重試: %s", failures, delay, e)
+                await asyncio.sleep(delay)
+    
+    def start(self):
+        """啟動背景刷新（由 lifespan 呼叫）"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._refresh_loop())
+    
+    async def stop(self):
+        """停止背景刷新（由 lifespan 呼叫）"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+# 全域 JWKS 快取實例
+jwks_cache = JWKSCache(
+    _fetch_public_key,
+    ttl=settings.jwks_cache_ttl,
+    min_ttl=settings.jwks_cache_min_ttl,
+    max_ttl=settings.jwks_cache_max_ttl,
+    kid_miss_min_interval=settings.jwks_kid_miss_min_interval,
+    stale_grace=settings.jwks_stale_grace,
+    refresh_ahead=settings.jwks_refresh_ahead,
+    backoff_max=settings.jwks_refresh_backoff_max,
+    shared_store=shared_store,
+    shared_name=f"jwks-{settings.realm}",
+    shared_wait=settings.http_timeout,
+    failure_backoff=settings.jwks_failure_backoff,
+)
+
+async def get_public_key() -> Dict[str, Any]:
+    """
+    獲取 Keycloak 公鑰（經過快取）
+    
+    Returns:
+        dict: JWKS 格式的公鑰資訊
+        
+    Raises:
+        TokenValidationError: 無法獲取公鑰時拋出
+    """
+    return await jwks_cache.get()
+
+async def get_key_set() -> KeySet:
+    """
+    獲取預先解析的 Keycloak 公鑰集合（經過快取）
+    
+    Returns:
+        KeySet: 依 kid 索引的金鑰物件
+        
+    Raises:
+        TokenValidationError: 無法獲取公鑰時拋出
+    """
+    return await jwks_cache.get_key_set()
+
+class IssuerRegistry:
+    """依 issuer 管理各 realm 的 JWKS 快取（多 Realm / 多租戶）
+    
+    一個後端同時服務多個 realm 時，每個 realm 使用各自的公鑰：
+    1. 只接受由信任的 Keycloak base_url 與 realm 組成的 issuer，不信任 Token 自稱的 iss
+    2. 設定中的 issuer 啟動時已預先建表，其餘已驗證過的 issuer 也記在字典，issuer → JWKSCache 為 O(1)
+    3. 各 realm 的公鑰在第一次用到時才載入，並各自快取、各自輪替
+    4. realm 數超過上限時淘汰最久未使用的 realm（預設 realm 常駐，由背景任務刷新）
+    5. 第一次出現的 realm 先放在候補區，公鑰抓取成功後才納入 LRU，
+       偽造的 realm 不會擠掉正常的 realm；同一個 realm 同時的請求共用同一個抓取
+    6. Keycloak 回應 404（realm 不存在）的 realm 在 unknown_ttl 秒內直接視為不受信任，不再向 Keycloak 抓取
+    """
+    
+    def __init__(self, trusted_bases: frozenset, issuer_realms: Dict[str, str], realms, default_realm: str,
+                 default_cache: JWKSCache, cache_factory, max_realms: int, unknown_ttl: float = 60.0):
+        self._trusted_bases = trusted_bases                    # 信任的 base_url（含路徑前綴）
+        self._known_issuers = issuer_realms                    # 設定中 realm 的 issuer → realm（預先建立）
+        self._allow_any_realm = "*" in realms
+        self._realms = frozenset(realm for realm in realms if realm != "*")
+        self._default_realm = default_realm
+        self._default_cache = default_cache                    # 預設 realm 的快取（常駐，不淘汰）
+        self._cache_factory = cache_factory                    # realm → 新的 JWKSCache
+        self._max_realms = max_realms
+        self._caches: "OrderedDict[str, JWKSCache]" = OrderedDict()  # 其他 realm 的快取（LRU）
+        self._pending: "OrderedDict[str, JWKSCache]" = OrderedDict()  # 尚未成功抓取公鑰的 realm（候補）
+        self._unknown: "OrderedDict[str, float]" = OrderedDict()      # 不存在的 realm → 負向快取期限（monotonic）
+        self._unknown_ttl = unknown_ttl
+        self._issuers: Dict[str, str] = {}                     # 其他已驗證的 issuer → realm（允許任何 realm 時）
+        self._rotation_listeners = []
+        self.evictions = 0                                     # 因容量淘汰的 realm 次數
+    
+    def add_rotation_listener(self, callback):
+        """註冊金鑰輪替回呼（套用到所有 realm，包括之後才載入的 realm）"""
+        self._rotation_listeners.append(callback)
+        self._default_cache.add_rotation_listener(callback)
+        for cache in (*self._caches.values(), *self._pending.values()):
+            cache.add_rotation_listener(callback)
+    
+    def _is_trusted_realm(self, realm: str) -> bool:
+        return realm == self._default_realm or realm in self._realms or self._allow_any_realm
+    
+    def realm_for_issuer(self, issuer: Any) -> Optional[str]:
+        """
+        由 issuer 取得 realm 名稱
+        
+        Returns:
+            Optional[str]: issuer 來自信任的 Keycloak 與 realm 時回傳 realm，否則回傳 None
+        """
+        if not isinstance(issuer, str):
+            return None
+        realm = self._known_issuers.get(issuer) or self._issuers.get(issuer)
+        if realm is not None:
+            return realm
+        
+        base, separator, realm = issuer.rpartition("/realms/")
+        if not separator or not realm or "/" in realm or not self._is_trusted_realm(realm):
+            return None
+        if base not in self._trusted_bases:
+            return None
+        
+        if len(self._issuers) >= self._max_realms * len(self._trusted_bases):
+            self._issuers.clear()
+        self._issuers[issuer] = realm
+        return realm
+    
+    def cache_for_realm(self, realm: str) -> Optional[JWKSCache]:
+        """
+        取得 realm 的 JWKS 快取，不存在時建立（延遲載入）
+        
+        Returns:
+            Optional[JWKSCache]: realm 已確認不存在（負向快取期間）時回傳 None
+        """
+        if realm == self._default_realm:
+            return self._default_cache
+        
+        cache = self._caches.get(realm)
+        if cache is not None:
+            self._caches.move_to_end(realm)
+            return cache
+        
+        cache = self._pending.get(realm)
+        if cache is not None:
+            if cache.loaded:
+                del self._pending[realm]
+                self._promote(realm, cache)
+            elif self._is_missing_realm(cache.last_error):
+                del self._pending[realm]
+                self._mark_unknown(realm)
+                return None
+            return cache
+        
+        if self._is_unknown(realm):
+            return None
+        
+        cache = self._cache_factory(realm)
+        for callback in self._rotation_listeners:
+            cache.add_rotation_listener(callback)
+        if cache.loaded:                                       # 已從快照載入
+            self._promote(realm, cache)
+        else:
+            self._pending[realm] = cache
+            while len(self._pending) > self._max_realms:
+                oldest, pending = self._pending.popitem(last=False)
+                if pending.loaded:                             # 已抓到公鑰但尚未再次使用的 realm 不丟棄
+                    self._promote(oldest, pending)
+        return cache
+    
+    def _promote(self, realm: str, cache: JWKSCache):
+        """公鑰已載入的 realm 納入 LRU"""
+        self._caches[realm] = cache
+        while len(self._caches) > self._max_realms:
+            evicted, _ = self._caches.popitem(last=False)
+            self.evictions += 1
+            jwks_logger.debug("淘汰閒置 realm 的公鑰快取: %s", evicted)
+    
+    @staticmethod
+    def _is_missing_realm(error: Optional[Exception]) -> bool:
+        """抓取失敗的原因是否為 realm 不存在（Keycloak 回應 404）"""
+        return isinstance(error, KeycloakStatusError) and error.status_code == 404
+    
+    def _mark_unknown(self, realm: str):
+        jwks_logger.info("realm 不存在，%.0f 秒內不再抓取: %s", self._unknown_ttl, realm)
+        self._unknown.pop(realm, None)
+        self._unknown[realm] = time.monotonic() + self._unknown_ttl
+        while len(self._unknown) > self._max_realms:
+            self._unknown.popitem(last=False)
+    
+    def _is_unknown(self, realm: str) -> bool:
+        """realm 是否在負向快取期間（順便移除已過期的項目；期限依加入順序遞增）"""
+        now = time.monotonic()
+        unknown = self._unknown
+        while unknown:
+            oldest = next(iter(unknown))
+            if unknown[oldest] > now:
+                break
+            del unknown[oldest]
+        return realm in unknown
+    
+    def get(self, issuer: Any) -> Optional[JWKSCache]:
+        """
+        取得 issuer 對應的 JWKS 快取
+        
+        Returns:
+            Optional[JWKSCache]: issuer 不受信任（或 realm 已確認不存在）時回傳 None
+        """
+        realm = self.realm_for_issuer(issuer)
+        if realm is None:
+            return None
+        return self.cache_for_realm(realm)
+    
+    def stats(self) -> Dict[str, Any]:
+        """realm 快取統計資訊"""
+        return {
+            "realms": len(self._caches) + 1,
+            "max_realms": self._max_realms,
+            "evictions": self.evictions,
+            "pending": len(self._pending),
+            "unknown": len(self._unknown),
+        }
+
+def _create_realm_cache(realm: str) -> JWKSCache:
+    """建立非預設 realm 的 JWKS 快取（設定與預設 realm 相同，但不進行背景刷新；有快照時直接載入）"""
+    cache = JWKSCache(
+        functools.partial(_fetch_public_key, realm),
+        ttl=settings.jwks_cache_ttl,
+        min_ttl=settings.jwks_cache_min_ttl,
+        max_ttl=settings.jwks_cache_max_ttl,
+        kid_miss_min_interval=settings.jwks_kid_miss_min_interval,
+        stale_grace=settings.jwks_stale_grace,
+        refresh_ahead=settings.jwks_refresh_ahead,
+        backoff_max=settings.jwks_refresh_backoff_max,
+        shared_store=shared_store,
+        shared_name=f"jwks-{realm}",
+        shared_wait=settings.http_timeout,
+        failure_backoff=settings.jwks_failure_backoff,
+    )
+    cache.load_snapshot(settings.jwks_snapshot_max_age)
+    return cache
+
+# 全域 issuer 註冊表（預設 realm 使用 jwks_cache）
+issuer_registry = IssuerRegistry(
+    settings.trusted_bases,
+    settings.issuer_realms,
+    settings.keycloak_realms,
+    default_realm=settings.realm,
+    default_cache=jwks_cache,
+    cache_factory=_create_realm_cache,
+    max_realms=settings.keycloak_realm_cache_size,
+    unknown_ttl=settings.keycloak_unknown_realm_ttl,
+)
+
+class TokenCache:
+    """已驗證 Token 結果快取（LRU）
+    
+    以 Token 的 SHA-256 摘要為鍵，保存驗證通過的 Claims：
+    - 有效期限為 min(Token exp, 設定的最長快取秒數)
+    - 超過容量時淘汰最久未使用的項目
+    - 金鑰輪替時整個清除
+    - 提供命中 / 未命中 / 淘汰計數，方便調整容量
+    """
+    
+    def __init__(self, max_size: int, max_age: float):
+        self._max_size = max_size
+        self._max_age = max_age
+        self._entries: "OrderedDict[bytes, Tuple[float, Claims]]" = OrderedDict()
+        self.hits = 0                                          # 命中次數
+        self.misses = 0                                        # 未命中次數
+        self.evictions = 0                                     # 因容量淘汰的次數
+        self.expirations = 0                                   # 因過期移除的次數
+    
+    @staticmethod
+    def _digest(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+    
+    def get(self, token: str) -> Optional["Claims"]:
+        """取得已驗證的 Claims，不存在或已過期時回傳 None"""
+        digest = self._digest(token)
+        entry = self._entries.get(digest)
+        if entry is None:
+            self.misses += 1
+            return None
+        
+        expires_at, claims = entry
+        if time.time() >= expires_at:
+            del self._entries[digest]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        
+        self._entries.move_to_end(digest)
+        self.hits += 1
+        return claims
+    
+    def put(self, token: str, claims: "Claims"):
+        """保存驗證通過的 Claims"""
+        expires_at = time.time() + self._max_age
+        exp = claims.exp
+        if isinstance(exp, (int, float)):
+            expires_at = min(expires_at, exp)
+        if expires_at <= time.time():
+            return
+        
+        digest = self._digest(token)
+        self._entries[digest] = (expires_at, claims)
+        self._entries.move_to_end(digest)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+    
+    def clear(self):
+        """清除所有項目（金鑰輪替時呼叫）"""
+        self._entries.clear()
+    
+    def stats(self) -> Dict[str, Any]:
+        """快取統計資訊"""
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self._max_size,
+            "max_age": self._max_age,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+# 全域已驗證 Token 快取實例（TOKEN_CACHE_ENABLED 關閉時為 None）
+token_cache: Optional[TokenCache] = None
+if settings.token_cache_enabled:
+    token_cache = TokenCache(max_size=settings.token_cache_max_size, max_age=settings.token_cache_max_age)
+    issuer_registry.add_rotation_listener(token_cache.clear)
+
+# 跨 worker 共用的已驗證 Token 表（同時啟用 Token 快取與共用快取目錄時）
+shared_token_table: Optional[SharedTokenTable] = None
+if token_cache is not None and shared_store is not None:
+    shared_token_table = SharedTokenTable(os.path.join(settings.shared_cache_dir, "tokens.bin"), settings.shared_token_cache_slots)
+    issuer_registry.add_rotation_listener(shared_token_table.clear)
+
+# ============================================================================
+# 撤銷索引（Backchannel Logout）
+# ============================================================================
+
+class RevocationIndex:
+    """已登出 session / 使用者的撤銷索引
+    
+    Keycloak 在使用者登出時呼叫 backchannel logout 端點，之後該 session 的 Token
+    即使簽名與 exp 仍然有效，也不需要 introspection 就能拒絕：
+    1. 以 sid 撤銷：拒絕該 session 的所有 Token
+    2. 以 sub 撤銷（登出 Token 沒有 sid 時）：拒絕該使用者在登出之前發行的 Token
+    3. 查詢只有兩次 dict 查找（O(1)），索引為空時直接回傳
+    4. 項目在登出後 max_token_lifetime 秒自動淘汰（登出前發行的 Token 此時都已過期）
+    5. 跨 worker 共用（提供 shared_store 時）：登出時合併寫入共用快照，
+       其他 worker 每 sync_interval 秒比對快照版本並重新載入；重新啟動後也會沿用
+    """
+    
+    def __init__(self, max_token_lifetime: float, shared_store: Optional[SharedFileStore] = None,
+                 shared_name: str = "revocations", sync_interval: float = 1.0):
+        self._max_token_lifetime = max_token_lifetime
+        self._shared_store = shared_store                      # 跨 worker 共用的檔案快取
+        self._shared_name = shared_name
+        self._sync_interval = sync_interval
+        self._sessions: Dict[str, float] = {}                  # sid → 淘汰時間 (time.time())
+        self._subjects: Dict[str, Tuple[float, float]] = {}    # sub → (登出時間, 淘汰時間)
+        self._next_maintenance = 0.0                           # 下次載入快照 / 淘汰過期項目的時間 (monotonic)
+        self._snapshot_version: Optional[Tuple[int, int]] = None  # 目前已載入的快照版本
+        self.logouts = 0                                       # 本 worker 收到的登出次數
+    
+    def is_revoked(self, claims: "Claims") -> bool:
+        """Token 所屬的 session 或使用者是否已登出"""
+        if time.monotonic() >= self._next_maintenance:
+            self._maintain()
+        if not self._sessions and not self._subjects:
+            return False
+        
+        sid = claims.sid
+        if isinstance(sid, str) and sid in self._sessions:
+            return True
+        sub = claims.sub
+        entry = self._subjects.get(sub) if isinstance(sub, str) else None
+        if entry is None:
+            return False
+        # 沒有 iat 的 Token 無法判斷是否在登出後發行，一律拒絕
+        iat = claims.iat
+        return not (isinstance(iat, (int, float)) and iat > entry[0])
+    
+    def revoke(self, sid: Optional[str], sub: Optional[str], logged_out_at: float):
+        """
+        記錄登出（有 sid 時只撤銷該 session，否則撤銷該使用者在 logged_out_at 之前發行的 Token）
+        
+        Args:
+            sid: Keycloak session ID
+            sub: 使用者唯一識別碼
+            logged_out_at: 登出時間（登出 Token 的 iat）
+        """
+        expires_at = logged_out_at + self._max_token_lifetime
+        sessions: Dict[str, float] = {}
+        subjects: Dict[str, Tuple[float, float]] = {}
+        if sid:
+            sessions[sid] = expires_at
+        else:
+            subjects[sub] = (logged_out_at, expires_at)
+        self._merge(sessions, subjects)
+        self.logouts += 1
+        
+        if self._shared_store is not None:
+            # 在鎖內合併其他 worker 的紀錄後寫回，避免同時登出時互相覆蓋
+            lock = self._shared_store.lock(self._shared_name)
+            try:
+                self._load_snapshot()
+                self._sweep()
+                self._shared_store.write(self._shared_name, {
+                    "sessions": self._sessions,
+                    "subjects": {key: list(entry) for key, entry in self._subjects.items()},
+                })
+                self._snapshot_version = self._shared_store.version(self._shared_name)
+            finally:
+                self._shared_store.unlock(lock)
+    
+    def _merge(self, sessions: Dict[str, Any], subjects: Dict[str, Any]):
+        """合併撤銷紀錄（同一 sid / sub 保留較晚的紀錄）"""
+        for sid, expires_at in sessions.items():
+            if isinstance(expires_at, (int, float)) and expires_at > self._sessions.get(sid, 0):
+                self._sessions[sid] = expires_at
+        for sub, entry in subjects.items():
+            if isinstance(entry, (list, tuple)) and len(entry) == 2 and all(isinstance(v, (int, float)) for v in entry):
+                current = self._subjects.get(sub)
+                if current is None or entry[0] > current[0]:
+                    self._subjects[sub] = (entry[0], entry[1])
+    
+    def _load_snapshot(self):
+        """共用快照有變更時載入（只比對檔案版本，未變更時不讀取內容）"""
+        version = self._shared_store.version(self._shared_name)
+        if version is None or version == self._snapshot_version:
+            return
+        snapshot = self._shared_store.read(self._shared_name) or {}
+        self._snapshot_version = version
+        sessions, subjects = snapshot.get("sessions"), snapshot.get("subjects")
+        self._merge(sessions if isinstance(sessions, dict) else {}, subjects if isinstance(subjects, dict) else {})
+    
+    def _sweep(self):
+        """淘汰過期的撤銷項目"""
+        now = time.time()
+        for sid in [sid for sid, expires_at in self._sessions.items() if expires_at <= now]:
+            del self._sessions[sid]
+        for sub in [sub for sub, (_, expires_at) in self._subjects.items() if expires_at <= now]:
+            del self._subjects[sub]
+    
+    def _maintain(self):
+        self._next_maintenance = time.monotonic() + self._sync_interval
+        if self._shared_store is not None:
+            self._load_snapshot()
+        self._sweep()
+    
+    def stats(self) -> Dict[str, Any]:
+        """撤銷索引統計資訊"""
+        return {
+            "sessions": len(self._sessions),
+            "subjects": len(self._subjects),
+            "max_token_lifetime": self._max_token_lifetime,
+            "logouts": self.logouts,
+            "shared": self._shared_store is not None,
+        }
+
+# 全域撤銷索引實例
+revocation_index = RevocationIndex(
+    max_token_lifetime=settings.revocation_max_token_lifetime,
+    shared_store=shared_store,
+    sync_interval=settings.revocation_sync_interval,
+)
+
+# ============================================================================
+# Token 解析（單次解析，後續各階段共用）
+# ============================================================================
+
+def _b64url_decode(segment: str) -> bytes:
+    """Base64url 解碼（自動補齊 padding）"""
+    return base64.urlsafe_b64decode(segment + "=" * (-len(segment) % 4))
+
+class ParsedToken:
+    """解析後的 JWT
+    
+    Token 只切割、base64 解碼、JSON 解析一次，
+    之後的 kid 選擇、簽名驗證、claims 檢查都直接使用這個物件。
+    """
+    
+    __slots__ = ("raw", "header", "claims", "signing_input", "signature")
+    
+    def __init__(self, raw: str, header: Dict[str, Any], claims: Dict[str, Any],
+                 signing_input: bytes, signature: bytes):
+        self.raw = raw                                          # 原始 Token 字串
+        self.header = header                                    # JOSE 標頭
+        self.claims = claims                                    # Token 負載 (payload)
+        self.signing_input = signing_input                      # 簽名內容（header.payload）
+        self.signature = signature                              # 簽名位元組
+    
+    @property
+    def kid(self) -> Optional[str]:
+        return self.header.get("kid")
+    
+    @property
+    def alg(self) -> Optional[str]:
+        return self.header.get("alg")
+
+def parse_token(token: str) -> ParsedToken:
+    """
+    解析 JWT（不驗證簽名）
+    
+    Args:
+        token: JWT 字串
+        
+    Returns:
+        ParsedToken: 解析後的 Token
+        
+    Raises:
+        JWTError: Token 格式不正確時拋出
+    """
+    if isinstance(token, str):
+        token_bytes = token.encode("utf-8")
+    else:
+        token_bytes = token
+    
+    # JWS compact 格式必須恰好三段；多出的 "." 會被併入 claims 段而誤判為可解碼
+    if token_bytes.count(b".") != 2:
+        raise JWTError("Not enough segments")
+    
+    try:
+        signing_input, signature_segment = token_bytes.rsplit(b".", 1)
+        header_segment, claims_segment = signing_input.split(b".", 1)
+    except ValueError:
+        raise JWTError("Not enough segments")
+    
+    try:
+        header = json.loads(_b64url_decode(header_segment.decode("ascii")))
+    except (ValueError, TypeError, UnicodeDecodeError):
+        raise JWTError("Error decoding token headers.")
+    if not isinstance(header, dict):
+        raise JWTError("Invalid header string: must be a json object")
+    
+    try:
+        claims = json.loads(_b64url_decode(claims_segment.decode("ascii")))
+    except (ValueError, TypeError, UnicodeDecodeError):
+        raise JWTError("Invalid payload string")
+    if not isinstance(claims, dict):
+        raise JWTError("Invalid payload string: must be a json object")
+    
+    try:
+        signature = _b64url_decode(signature_segment.decode("ascii"))
+    except (ValueError, TypeError, UnicodeDecodeError):
+        raise JWTError("Invalid crypto padding")
+    
+    return ParsedToken(token, header, claims, signing_input, signature)
+
+def _validate_claims(claims: Dict[str, Any], audience: Optional[str] = None, leeway: int = 0):
+    """
+    檢查時間相關 claims 與 audience（語意與 python-jose 的 jwt.decode 相同）
+    
+    Raises:
+        ExpiredSignatureError: Token 已過期
+        JWTClaimsError: claims 格式或內容不正確
+    """
+    now = int(time.time())
+    
+    if "iat" in claims and not isinstance(claims["iat"], (int, float)):
+        raise JWTClaimsError("Issued At claim (iat) must be an integer.")
+    
+    if "nbf" in claims:
+        nbf = claims["nbf"]
+        if not isinstance(nbf, (int, float)):
+            raise JWTClaimsError("Not Before claim (nbf) must be an integer.")
+        if nbf > now + leeway:
+            raise JWTClaimsError("The token is not yet valid (nbf)")
+    
+    if "exp" in claims:
+        exp = claims["exp"]
+        if not isinstance(exp, (int, float)):
+            raise JWTClaimsError("Expiration Time claim (exp) must be an integer.")
+        if exp < now - leeway:
+            raise ExpiredSignatureError("Signature has expired.")
+    
+    if "aud" in claims:
+        audience_claims = claims["aud"]
+        if isinstance(audience_claims, str):
+            audience_claims = [audience_claims]
+        if not isinstance(audience_claims, list) or any(not isinstance(c, str) for c in audience_claims):
+            raise JWTClaimsError("Invalid claim format in token")
+        if audience not in audience_claims:
+            raise JWTClaimsError("Invalid audience")
+
+def _verify_signature(parsed: ParsedToken, public_key, algorithms):
+    """
+    檢查簽名算法並驗證簽名
+    
+    Token 標頭的 alg 必須在允許清單中，且必須與公鑰的算法相同（防止算法混淆）。
+    
+    Raises:
+        JWTError: 算法不允許或簽名不正確時拋出
+    """
+    if parsed.alg not in algorithms or parsed.alg != public_key.alg:
+        raise JWTError("The specified alg value is not allowed")
+    
+    try:
+        signature_valid = public_key.verify(parsed.signing_input, parsed.signature)
+    except Exception:
+        signature_valid = False
+    if not signature_valid:
+        raise JWTError("Signature verification failed.")
+
+async def verify_signature_async(parsed: ParsedToken, public_key, algorithms):
+    """
+    驗證簽名（VERIFY_POOL 設定工作池時在工作池中執行，否則直接在事件迴圈執行）
+    
+    Raises:
+        JWTError: 算法不允許或簽名不正確時拋出
+    """
+    if settings.verify_pool == "none":
+        _verify_signature(parsed, public_key, algorithms)
+        return
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(get_verify_executor(), _verify_signature, parsed, public_key, algorithms)
+
+def verify_parsed_token(parsed: ParsedToken, public_key, algorithms, audience: Optional[str] = None) -> Dict[str, Any]:
+    """
+    以預先解析的金鑰物件驗證已解析的 Token
+    
+    Args:
+        parsed: parse_token() 的結果
+        public_key: 預先解析的金鑰物件（KeySet 中的項目）
+        algorithms: 允許的簽名算法
+        audience: 預期的 audience
+        
+    Returns:
+        Dict[str, Any]: 驗證成功的 Token 負載 (payload)
+        
+    Raises:
+        JWTError: 簽名或 claims 驗證失敗時拋出
+    """
+    _verify_signature(parsed, public_key, algorithms)
+    _validate_claims(parsed.claims, audience=audience)
+    return parsed.claims
+
+# ============================================================================
+# Token Claims
+# ============================================================================
+
+def _realm_grant(role: str) -> str:
+    return f"realm:{role}"
+
+def _client_grant(client: str, role: str) -> str:
+    return f"client:{client}:{role}"
+
+def _scope_grant(scope: str) -> str:
+    return f"scope:{scope}"
+
+def _freeze(value: Any) -> Any:
+    """將 JSON 值轉為唯讀（dict → ReadOnlyDict、list → tuple；dict 內容在讀取時才轉換）"""
+    if isinstance(value, dict):
+        return ReadOnlyDict(value)
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+class ReadOnlyDict(Mapping):
+    """dict 的唯讀檢視（不複製）
+    
+    建立時只包住最外層；巢狀的 dict / list 在第一次讀取時才轉為唯讀並記住，
+    沒有讀取的部分不產生任何額外物件。
+    """
+    
+    __slots__ = ("_data", "_frozen")
+    
+    def __init__(self, data: Dict[str, Any]):
+        self._data = data
+        self._frozen: Dict[str, Any] = {}                      # 已轉為唯讀的巢狀值
+    
+    def __getitem__(self, key: str) -> Any:
+        frozen = self._frozen.get(key)
+        if frozen is not None:
+            return frozen
+        value = self._data[key]
+        if isinstance(value, (dict, list)):
+            value = self._frozen[key] = _freeze(value)
+        return value
+    
+    def get(self, key: str, default: Any = None) -> Any:
+        return self[key] if key in self._data else default
+    
+    def __contains__(self, key: object) -> bool:
+        return key in self._data
+    
+    def __iter__(self):
+        return iter(self._data)
+    
+    def __len__(self) -> int:
+        return len(self._data)
+    
+    def __repr__(self) -> str:
+        return f"ReadOnlyDict({self._data!r})"
+
+class Claims:
+    """驗證通過的 Token claims（不可變）
+    
+    驗證成功時建立一次（並與 Token 一起快取），處理函數直接讀取屬性：
+    - 常用欄位預先取出，不需要在每個處理函數重複 .get() 鏈
+    - realm 角色、client 角色與 scope 預先整理成 frozenset
+    - grants 為授權政策使用的單一權限集合（見 Policy）
+    - raw 與 client_roles 為唯讀 mapping，快取共用的物件不會被處理函數改動；
+      raw 不複製 payload，巢狀的 dict / list 在第一次讀取時才轉為唯讀
+    """
+    
+    __slots__ = (
+        "raw", "sub", "iss", "aud", "azp", "typ", "sid", "exp", "iat",
+        "preferred_username", "email", "name", "given_name", "family_name",
+        "realm_roles", "client_roles", "scopes", "grants",
+    )
+    
+    def __init__(self, payload: Dict[str, Any]):
+        get = payload.get
+        realm_access = get("realm_access")
+        realm_roles = frozenset(realm_access.get("roles") or ()) if isinstance(realm_access, dict) else frozenset()
+        
+        client_roles: Dict[str, frozenset] = {}
+        resource_access = get("resource_access")
+        if isinstance(resource_access, dict):
+            for client, access in resource_access.items():
+                if isinstance(access, dict):
+                    client_roles[client] = frozenset(access.get("roles") or ())
+        
+        scope = get("scope")
+        scopes = frozenset(scope.split()) if isinstance(scope, str) else frozenset()
+        
+        grants = {_realm_grant(role) for role in realm_roles}
+        grants.update(_client_grant(client, role) for client, roles in client_roles.items() for role in roles)
+        grants.update(_scope_grant(item) for item in scopes)
+        
+        raw = ReadOnlyDict(payload)
+        get = raw.get                                               # 欄位取自唯讀檢視（aud 為 list 時轉為 tuple）
+        setattr_ = object.__setattr__
+        setattr_(self, "raw", raw)                                  # 原始 payload（唯讀）
+        setattr_(self, "sub", get("sub"))                           # 使用者唯一識別碼
+        setattr_(self, "iss", get("iss"))                           # 發行者
+        setattr_(self, "aud", get("aud"))                           # 受眾
+        setattr_(self, "azp", get("azp"))                           # 取得 Token 的 client
+        setattr_(self, "typ", get("typ"))                           # Token 類型
+        setattr_(self, "sid", get("sid"))                           # Keycloak session ID
+        setattr_(self, "exp", get("exp"))                           # 過期時間
+        setattr_(self, "iat", get("iat"))                           # 發行時間
+        setattr_(self, "preferred_username", get("preferred_username"))
+        setattr_(self, "email", get("email"))
+        setattr_(self, "name", get("name"))
+        setattr_(self, "given_name", get("given_name"))
+        setattr_(self, "family_name", get("family_name"))
+        setattr_(self, "realm_roles", realm_roles)                  # realm 角色
+        setattr_(self, "client_roles", MappingProxyType(client_roles))  # client → 角色（唯讀）
+        setattr_(self, "scopes", scopes)                            # scope
+        setattr_(self, "grants", frozenset(grants))                 # 授權政策使用的權限集合
+    
+    def __setattr__(self, name, value):
+        raise AttributeError("Claims 為不可變物件")
+    
+    def __delattr__(self, name):
+        raise AttributeError("Claims 為不可變物件")
+    
+    def get(self, key: str, default: Any = None) -> Any:
+        """讀取未預先取出的 claim（與 dict.get 相同）"""
+        return self.raw.get(key, default)
+    
+    def user_info(self) -> Dict[str, Any]:
+        """使用者基本資訊（對應 UserInfo 模型）"""
+        return {
+            "sub": self.sub,
+            "email": self.email,
+            "name": self.name,
+            "preferred_username": self.preferred_username,
+            "given_name": self.given_name,
+            "family_name": self.family_name,
+        }
+    
+    def __repr__(self) -> str:
+        return f"Claims(sub={self.sub!r}, iss={self.iss!r})"
+
+# ============================================================================
+# Token Introspection（不透明 Token 驗證）
+# ============================================================================
+
+class TokenIntrospector:
+    """以 Keycloak introspection 端點驗證 Token
+    
+    用於無法在本地驗證的不透明 (opaque / reference) Token，或需要感知撤銷的情境：
+    1. 透過共用連線池呼叫 Token 所屬 realm 的 introspection 端點
+       （JWT 格式依 iss 經 IssuerRegistry 決定 realm，不透明 Token 使用預設 realm）
+    2. 回應的 iss 必須是該 realm，並與本地驗證相同檢查 exp / nbf / aud，不符時視為無效
+    3. 同一個 Token 同時的 introspection 合併為一次上游呼叫
+    4. 有效結果快取至 min(exp, 設定秒數)，無效結果短暫快取（負向快取）
+    """
+    
+    def __init__(self, client_id: str, client_secret: str, cache_ttl: float, negative_ttl: float,
+                 max_cached: int, timeout: float):
+        self._auth = (client_id, client_secret)
+        self._cache_ttl = cache_ttl
+        self._negative_ttl = negative_ttl
+        self._max_cached = max_cached
+        self._timeout = httpx.Timeout(timeout, connect=min(timeout, 2.0))
+        self._inflight: Dict[bytes, asyncio.Task] = {}
+        # Token 摘要 → (到期時間 time.time(), 結果 Claims；無效時為 None)
+        self._results: "OrderedDict[bytes, Tuple[float, Optional[Claims]]]" = OrderedDict()
+    
+    def _store(self, digest: bytes, claims: Optional[Claims]):
+        now = time.time()
+        if claims is None:
+            expires_at = now + self._negative_ttl
+        else:
+            expires_at = now + self._cache_ttl
+            exp = claims.exp
+            if isinstance(exp, (int, float)):
+                expires_at = min(expires_at, exp)
+        if expires_at <= now:
+            return
+        self._results[digest] = (expires_at, claims)
+        self._results.move_to_end(digest)
+        while len(self._results) > self._max_cached:
+            self._results.popitem(last=False)
+    
+    @staticmethod
+    def _realm_for_token(token: str) -> Optional[str]:
+        """JWT 格式的 Token 依 iss 決定 realm（issuer 不受信任時回傳 None），不透明 Token 使用預設 realm"""
+        if not _is_jwt(token):
+            return settings.realm
+        try:
+            parsed = parse_token(token)
+        except JWTError:
+            return settings.realm
+        return issuer_registry.realm_for_issuer(parsed.claims.get("iss"))
+    
+    @staticmethod
+    def _active_claims(result: Dict[str, Any], realm: str) -> Optional[Claims]:
+        """introspection 回應有效、issuer 屬於查詢的 realm 且 claims 檢查通過時回傳 Claims"""
+        if not result.get("active"):
+            return None
+        if issuer_registry.realm_for_issuer(result.get("iss")) != realm:
+            verify_logger.info("Introspection 回應的 issuer 不屬於 realm %s: %s", realm, result.get("iss"))
+            return None
+        try:
+            _validate_claims(result, audience="account")       # 與本地驗證相同（Keycloak 預設的 audience）
+        except JWTError as e:
+            verify_logger.info("Introspection 回應的 claims 不符: %s", e)
+            return None
+        return Claims(result)
+    
+    async def _introspect_upstream(self, digest: bytes, token: str) -> Optional[Claims]:
+        realm = self._realm_for_token(token)
+        if realm is None:
+            claims = None                                       # 不受信任的 issuer 不送往 Keycloak
+        else:
+            url = keycloak_endpoints(endpoint_resolver.base_url, realm).introspect
+            response = await http_request(
+                "POST", url,
+                data={"token": token, "token_type_hint": "access_token"},
+                auth=self._auth,
+                timeout=self._timeout,
+            )
+            response.raise_for_status()
+            try:
+                result = response.json()
+            except ValueError:
+                result = None
+            if not isinstance(result, dict):
+                # 代理伺服器的錯誤頁或被截斷的回應：與連線失敗相同處理（回應 401，不快取結果）
+                raise httpx.DecodingError("introspection 回應不是 JSON 物件", request=response.request)
+            claims = self._active_claims(result, realm)
+        self._store(digest, claims)
+        return claims
+    
+    async def introspect(self, token: str) -> Optional[Claims]:
+        """
+        查詢 Token 狀態
+        
+        Args:
+            token: 要查詢的 Token
+            
+        Returns:
+            Optional[Claims]: 有效時回傳 introspection 結果；無效、issuer 不受信任或 aud 不符時回傳 None
+            
+        Raises:
+            httpx.HTTPError: introspection 端點呼叫失敗，或回應不是 JSON 物件
+        """
+        digest = hashlib.sha256(token.encode()).digest()
+        
+        entry = self._results.get(digest)
+        if entry is not None:
+            expires_at, claims = entry
+            if time.time() < expires_at:
+                self._results.move_to_end(digest)
+                INTROSPECTION_REQUESTS.inc("cached")
+                return claims
+            del self._results[digest]
+        
+        task = self._inflight.get(digest)
+        if task is not None:
+            INTROSPECTION_REQUESTS.inc("coalesced")
+            return await asyncio.shield(task)
+        
+        task = asyncio.create_task(self._introspect_upstream(digest, token))
+        self._inflight[digest] = task
+        task.add_done_callback(lambda _: self._inflight.pop(digest, None))
+        try:
+            claims = await asyncio.shield(task)
+        except httpx.HTTPError:
+            INTROSPECTION_REQUESTS.inc("error")
+            raise
+        INTROSPECTION_REQUESTS.inc("upstream")
+        return claims
+    
+    def clear(self):
+        """清除所有快取結果"""
+        self._results.clear()
+
+# 全域 introspection 實例（INTROSPECTION_MODE=off 時為 None）
+introspector: Optional[TokenIntrospector] = None
+if settings.introspection_mode in ("opaque", "always"):
+    introspector = TokenIntrospector(
+        client_id=settings.introspection_client_id,
+        client_secret=settings.introspection_client_secret,
+        cache_ttl=settings.introspection_cache_ttl,
+        negative_ttl=settings.introspection_negative_ttl,
+        max_cached=settings.introspection_cache_size,
+        timeout=settings.introspection_timeout,
+    )
+
+def _is_jwt(token: str) -> bool:
+    """粗略判斷 Token 是否為 JWT（三段以 . 分隔）"""
+    return token.count(".") == 2
+
+async def verify_token_introspection(token: str) -> Claims:
+    """
+    以 introspection 驗證 Token
+    
+    Args:
+        token: 要驗證的 Token
+        
+    Returns:
+        Claims: introspection 回傳的 Token 資訊
+        
+    Raises:
+        HTTPException: Token 無效或無法查詢時拋出 401 錯誤
+    """
+    try:
+        claims = await introspector.introspect(token)
+    except httpx.HTTPError as e:
+        AUTH_FAILURES.inc("introspection_unavailable")
+        verify_logger.warning("Token introspection 失敗: %s", e)
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail=f"無法驗證 Token: {str(e) or type(e).__name__}",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    
+    if claims is None or revocation_index.is_revoked(claims):
+        AUTH_FAILURES.inc("inactive" if claims is None else "revoked")
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Token 無效或已撤銷",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return claims
+
+# 驗證失敗原因（依失敗時所在階段分類）
+_FAILURE_REASONS = {
+    "parse": "malformed",
+    "issuer": "untrusted_issuer",
+    "signature": "invalid_signature",
+    "claims": "invalid_claims",
+}
+
+def _failure_reason(error: Exception, stage: str) -> str:
+    """依例外類型與失敗時所在階段決定失敗原因（auth_failures_total 的 reason）"""
+    if isinstance(error, ExpiredSignatureError):
+        return "expired"
+    if isinstance(error, TokenRevokedError):
+        return "revoked"
+    if isinstance(error, JWTError):
+        return _FAILURE_REASONS.get(stage, "invalid_token")
+    if isinstance(error, TokenValidationError):
+        return "no_matching_key" if stage == "key_select" else "keys_unavailable"
+    return "error"
+
+async def _select_public_key(key_cache: JWKSCache, key_set: KeySet, kid: Optional[str]):
+    """
+    依 kid 選擇驗證用公鑰
+    
+    1. 精確匹配 kid
+    2. 遇到未知 kid 時代表可能發生金鑰輪替，提前刷新快取後再試一次
+    3. 回退策略：使用第一個可用公鑰（適用於舊版 Keycloak 或只有單一公鑰的情況）
+    
+    Raises:
+        TokenValidationError: 找不到可用的公鑰
+    """
+    public_key = key_set.get(kid)
+    
+    if public_key is None:
+        key_set = await key_cache.refresh_for_kid(kid)
+        public_key = key_set.get(kid)
+    
+    if public_key is None and key_set.default is not None:
+        verify_logger.debug("找不到對應的 kid，使用第一個可用的公鑰")
+        public_key = key_set.default
+    
+    if public_key is None:
+        raise TokenValidationError("找不到對應的公鑰")
+    return public_key
+
+def _check_revoked(claims: Claims):
+    """
+    檢查 Token 所屬的 session / 使用者是否已登出（見 RevocationIndex）
+    
+    Raises:
+        TokenRevokedError: 已登出
+    """
+    if revocation_index.is_revoked(claims):
+        raise TokenRevokedError("Token 已撤銷（已登出）")
+
+def _remember_verified(token: str, claims: Claims):
+    """將簽名驗證通過的 Token 放入已驗證 Token 快取（啟用時，含跨 worker 共用表）"""
+    if token_cache is not None:
+        token_cache.put(token, claims)
+        if shared_token_table is not None:
+            shared_token_table.put(token, min(time.time() + settings.token_cache_max_age, claims.exp or 0))
+
+async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)) -> Claims:
+    """
+    完整的 JWT Token 驗證
+    
+    執行完整的 JWT 驗證流程，包括：
+    1. 數位簽名驗證（使用 Keycloak 公鑰）
+    2. Token 完整性檢查
+    3. 發行者 (issuer) 驗證（只接受信任的 realm，並使用該 realm 的公鑰）
+    4. 受眾 (audience) 驗證
+    5. 過期時間檢查
+    6. 撤銷檢查（已透過 backchannel logout 登出的 session）
+    
+    啟用 INTROSPECTION_MODE 時，不透明 Token（或全部 Token）改由 Keycloak introspection 驗證。
+    
+    Args:
+        credentials: HTTP Bearer Token 憑證
+        
+    Returns:
+        Claims: 驗證成功的 Token claims（常用欄位與角色已預先取出）
+        
+    Raises:
+        HTTPException: Token 驗證失敗時拋出 401 錯誤
+        
+    安全等級: 最高（生產環境建議）
+    """
+    token = credentials.credentials
+    
+    # 步驟 0: 已驗證 Token 快取（啟用時），命中則完全略過簽名驗證
+    # （已登出的 Token 繼續往下，由後續的撤銷檢查拒絕並記錄原因）
+    if token_cache is not None:
+        cached_claims = token_cache.get(token)
+        if cached_claims is not None and not revocation_index.is_revoked(cached_claims):
+            return cached_claims
+    
+    # 不透明 Token（或設定為全部使用 introspection）交由 Keycloak introspection 驗證
+    if introspector is not None and (settings.introspection_mode == "always" or not _is_jwt(token)):
+        return await verify_token_introspection(token)
+    
+    # 目前所在階段（用於分階段計時與失敗原因統計）
+    stage = "parse"
+    started = stage_started = time.perf_counter()
+    
+    def end_stage(next_stage: str):
+        nonlocal stage, stage_started
+        now = time.perf_counter()
+        VERIFY_STAGE_SECONDS.observe(now - stage_started, stage)
+        stage, stage_started = next_stage, now
+    
+    try:
+        # 步驟 1: 解析 Token（只解析一次），獲取金鑰識別碼 (kid)
+        # kid 用於從多個公鑰中選擇正確的驗證金鑰
+        parsed = parse_token(token)
+        kid = parsed.kid
+        verify_logger.debug("Token kid: %s", kid)
+        end_stage("issuer")
+        
+        # 步驟 2: 依 issuer 找到該 realm 的公鑰快取，不受信任的 issuer 直接拒絕
+        key_cache = issuer_registry.get(parsed.claims.get("iss"))
+        if key_cache is None:
+            raise JWTClaimsError("Invalid issuer")
+        
+        # 其他 worker 已驗證過簽名時略過簽名驗證，只重新檢查 claims
+        if shared_token_table is not None and shared_token_table.contains(token):
+            end_stage("claims")
+            _validate_claims(parsed.claims, audience="account")
+            claims = Claims(parsed.claims)
+            _check_revoked(claims)
+            token_cache.put(token, claims)
+            end_stage("done")
+            VERIFY_STAGE_SECONDS.observe(time.perf_counter() - started, "total")
+            return claims
+        end_stage("jwks")
+        
+        # 步驟 3: 獲取該 realm 的公鑰集合（經過快取，金鑰已預先解析）
+        key_set = await key_cache.get_key_set()
+        if verify_logger.isEnabledFor(logging.DEBUG):
+            verify_logger.debug("可用的 keys: %s", list(key_set.keys))
+        end_stage("key_select")
+        
+        # 步驟 4: 金鑰匹配策略
+        # 根據 kid 找到對應的公鑰，支援多種匹配策略以提高相容性
+        public_key = await _select_public_key(key_cache, key_set, kid)
+        end_stage("signature")
+        
+        # 步驟 5: 執行 JWT 驗證
+        # 使用該 issuer 的公鑰驗證簽名，並檢查過期時間與 audience
+        # （iss 已在步驟 2 比對信任清單，且簽名只能由該 realm 的金鑰通過）
+        await verify_signature_async(
+            parsed,
+            public_key,                          # 驗證用公鑰（預先解析的金鑰物件，算法取自 JWK）
+            algorithms=settings.verify_algorithms,  # 允許的簽名算法
+        )
+        end_stage("claims")
+        _validate_claims(parsed.claims, audience="account")  # Keycloak 預設的 audience
+        claims = Claims(parsed.claims)
+        _check_revoked(claims)                               # 已登出的 session（backchannel logout）
+        end_stage("done")
+        VERIFY_STAGE_SECONDS.observe(time.perf_counter() - started, "total")
+        
+        _remember_verified(token, claims)
+        return claims
+    
+    except ExpiredSignatureError as e:
+        AUTH_FAILURES.inc("expired")
+        verify_logger.info("JWT 驗證錯誤: %s", e)  # 服務器端記錄
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail=f"Token 驗證失敗: {str(e)}",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    except JWTError as e:
+        AUTH_FAILURES.inc(_failure_reason(e, stage))
+        verify_logger.info("JWT 驗證錯誤: %s", e)  # 服務器端記錄
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail=f"Token 驗證失敗: {str(e)}",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    except TokenValidationError as e:
+        AUTH_FAILURES.inc(_failure_reason(e, stage))
+        verify_logger.info("Token 驗證錯誤: %s", e)  # 服務器端記錄
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail=str(e),
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    except Exception as e:
+        AUTH_FAILURES.inc("error")
+        verify_logger.warning("未預期的錯誤: %s", e, exc_info=True)  # 服務器端記錄
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail=f"驗證過程發生錯誤: {str(e)}",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+# ============================================================================
+# 批次驗證（API 閘道 / sidecar）
+# ============================================================================
+# 一次驗證多個 Token：依 (issuer, kid) 分組，每組只解析一次公鑰，
+# 簽名驗證（RSA 運算）交給工作池（見 get_verify_executor），不佔用事件迴圈
+
+# 每次交給執行緒池驗證的 Token 數（同一組 Token 太多時切成多塊並行）
+_BATCH_CHUNK_SIZE = 32
+
+def _batch_valid(payload: Dict[str, Any]) -> Dict[str, Any]:
+    BATCH_VERIFY_TOKENS.inc("valid")
+    return {"valid": True, "claims": payload}
+
+def _batch_invalid(reason: str, detail: str) -> Dict[str, Any]:
+    BATCH_VERIFY_TOKENS.inc(reason)
+    return {"valid": False, "error": reason, "detail": detail}
+
+def _verify_chunk(public_key, chunk):
+    """
+    在工作池中驗證同一組（相同公鑰）的 Token
+    
+    Returns:
+        list: 每個 Token 的 (索引, 失敗時的例外（成功為 None）, 失敗時所在階段)
+    """
+    outcomes = []
+    for index, parsed in chunk:
+        stage = "signature"
+        try:
+            _verify_signature(parsed, public_key, settings.verify_algorithms)
+            stage = "claims"
+            _validate_claims(parsed.claims, audience="account")
+            outcomes.append((index, None, stage))
+        except Exception as e:
+            outcomes.append((index, e, stage))
+    return outcomes
+
+async def verify_tokens_batch(tokens, mode: str = "full"):
+    """
+    批次驗證 Token
+    
+    full 模式與 verify_token 的驗證相同（快取、introspection、issuer、簽名、claims、撤銷），
+    basic 模式與 verify_token_basic 相同（不驗證簽名）。
+    重複的 Token 只驗證一次。
+    
+    Args:
+        tokens: Token 清單
+        mode: full / basic
+        
+    Returns:
+        list: 依輸入順序的結果，成功為 {"valid": True, "claims"}，
+            失敗為 {"valid": False, "error": 失敗原因, "detail": 訊息}
+    """
+    results = [None] * len(tokens)
+    first_index: Dict[str, int] = {}                           # Token → 第一次出現的索引
+    groups: Dict[Tuple[JWKSCache, Optional[str]], list] = {}   # (公鑰快取, kid) → [(索引, ParsedToken)]
+    introspected = []                                          # 交給 introspection 的索引
+    tokens_parsed: Dict[int, ParsedToken] = {}                 # 需要驗證簽名的 Token
+    
+    for index, token in enumerate(tokens):
+        if first_index.setdefault(token, index) != index:
+            continue
+        
+        stage = "parse"
+        try:
+            if mode == "basic":
+                payload = parse_token(token).claims
+                error = _basic_claims_error(payload)
+                results[index] = _batch_invalid(*error) if error else _batch_valid(payload)
+                continue
+            
+            if token_cache is not None:
+                cached_claims = token_cache.get(token)
+                if cached_claims is not None and not revocation_index.is_revoked(cached_claims):
+                    results[index] = _batch_valid(cached_claims.raw)
+                    continue
+            
+            if introspector is not None and (settings.introspection_mode == "always" or not _is_jwt(token)):
+                introspected.append(index)
+                continue
+            
+            parsed = parse_token(token)
+            stage = "issuer"
+            key_cache = issuer_registry.get(parsed.claims.get("iss"))
+            if key_cache is None:
+                raise JWTClaimsError("Invalid issuer")
+            
+            # 其他 worker 已驗證過簽名時只重新檢查 claims
+            if shared_token_table is not None and shared_token_table.contains(token):
+                stage = "claims"
+                _validate_claims(parsed.claims, audience="account")
+                claims = Claims(parsed.claims)
+                _check_revoked(claims)
+                token_cache.put(token, claims)
+                results[index] = _batch_valid(claims.raw)
+                continue
+        except Exception as e:
+            results[index] = _batch_invalid(_failure_reason(e, stage), str(e))
+            continue
+        
+        tokens_parsed[index] = parsed
+        groups.setdefault((key_cache, parsed.kid), []).append((index, parsed))
+    
+    async def verify_group(key_cache: JWKSCache, kid: Optional[str], members):
+        stage = "jwks"
+        try:
+            key_set = await key_cache.get_key_set()
+            stage = "key_select"
+            public_key = await _select_public_key(key_cache, key_set, kid)
+        except Exception as e:
+            reason = _failure_reason(e, stage)
+            for index, _ in members:
+                results[index] = _batch_invalid(reason, str(e))
+            return
+        
+        loop = asyncio.get_running_loop()
+        executor = get_verify_executor()
+        chunks = [members[start:start + _BATCH_CHUNK_SIZE] for start in range(0, len(members), _BATCH_CHUNK_SIZE)]
+        for outcomes in await asyncio.gather(*(
+            loop.run_in_executor(executor, _verify_chunk, public_key, chunk) for chunk in chunks
+        )):
+            for index, error, stage in outcomes:
+                if error is None:
+                    claims = Claims(tokens_parsed[index].claims)
+                    if revocation_index.is_revoked(claims):
+                        results[index] = _batch_invalid("revoked", "Token 已撤銷（已登出）")
+                        continue
+                    _remember_verified(tokens[index], claims)
+                    results[index] = _batch_valid(claims.raw)
+                else:
+                    results[index] = _batch_invalid(_failure_reason(error, stage), str(error))
+    
+    async def verify_introspected(index: int):
+        try:
+            claims = await introspector.introspect(tokens[index])
+        except httpx.HTTPError as e:
+            results[index] = _batch_invalid("introspection_unavailable", str(e) or type(e).__name__)
+            return
+        if claims is None or revocation_index.is_revoked(claims):
+            results[index] = _batch_invalid("inactive" if claims is None else "revoked", "Token 無效或已撤銷")
+        else:
+            results[index] = _batch_valid(claims.raw)
+    
+    await asyncio.gather(
+        *(verify_group(key_cache, kid, members) for (key_cache, kid), members in groups.items()),
+        *(verify_introspected(index) for index in introspected),
+    )
+    
+    # 重複的 Token 使用第一次出現時的結果
+    for index, token in enumerate(tokens):
+        if results[index] is None:
+            results[index] = results[first_index[token]]
+    return results
+
+# ============================================================================
+# 速率限制
+# ============================================================================
+# 受保護端點在 Token 驗證通過後依 sub（沒有時依 azp）限制，未驗證的端點依用戶端 IP 限制；
+# 每個路由各自計算額度（RATE_LIMIT_ROUTES 可個別調整）
+
+class RateLimiter:
+    """單一路由的 token bucket 速率限制與並行數限制
+    
+    1. 每個用戶端鍵只保存 [剩餘額度, 上次更新時間]，依經過時間補充額度（每秒 rate，最多 burst）
+    2. 額度不足時回傳需要等待的秒數（429 回應的 Retry-After）
+    3. 閒置超過 burst / rate 秒的鍵額度必定已補滿，與新鍵相同，定期移除；
+       鍵依最後使用時間排序，移除時從最舊的開始，遇到仍在使用的鍵即停止
+    4. 超過 max_keys 時淘汰最久未使用的鍵
+    5. max_concurrent 大於 0 時，限制每個鍵同時處理中的請求數
+    6. check() 只查詢額度不消耗，用於先檢查、事後才計費的限制（例如驗證失敗次數）
+    7. 一個請求可以消耗多個額度（例如批次驗證依 Token 數計費）：有額度時允許，餘額可以變成負數，
+       之後的請求要等額度補回才允許，長期平均仍不超過 rate
+    """
+    
+    def __init__(self, rate: float, burst: int, max_keys: int, max_concurrent: int = 0, sweep_interval: float = 60):
+        self.rate = rate
+        self.burst = burst
+        self._max_keys = max_keys
+        self._max_concurrent = max_concurrent
+        self._sweep_interval = sweep_interval
+        self._idle_after = burst / rate                        # 閒置多久後額度必定已補滿
+        self._buckets: "OrderedDict[str, List[float]]" = OrderedDict()  # 鍵 → [剩餘額度, 上次更新時間 (monotonic)]
+        self._active: Dict[str, int] = {}                      # 鍵 → 處理中的請求數（只保留非 0 的鍵）
+        self._next_sweep = time.monotonic() + sweep_interval
+        self.allowed = 0                                       # 允許的請求數
+        self.throttled = 0                                     # 因額度不足或並行數過多拒絕的請求數
+        self.swept = 0                                         # 因閒置移除的鍵數
+    
+    def acquire(self, key: str, cost: int = 1) -> float:
+        """
+        消耗額度
+        
+        Args:
+            key: 用戶端鍵
+            cost: 消耗的額度數（餘額至少為 1 即允許，不足的部分記為負債）
+            
+        Returns:
+            float: 0 表示允許；否則為額度補充到可以再次請求所需的秒數
+        """
+        now = time.monotonic()
+        if now >= self._next_sweep:
+            self._sweep(now)
+        
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [float(self.burst), now]
+            if len(self._buckets) > self._max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        
+        if bucket[0] < 1:
+            self.throttled += 1
+            return (1 - bucket[0]) / self.rate
+        bucket[0] -= cost
+        self.allowed += 1
+        return 0.0
+    
+    def check(self, key: str) -> float:
+        """
+        查詢是否還有額度（不消耗，也不建立新的鍵）
+        
+        Returns:
+            float: 0 表示還有額度；否則為額度補充到 1 所需的秒數
+        """
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            return 0.0
+        tokens = min(self.burst, bucket[0] + (time.monotonic() - bucket[1]) * self.rate)
+        if tokens < 1:
+            self.throttled += 1
+            return (1 - tokens) / self.rate
+        return 0.0
+    
+    def enter(self, key: str) -> bool:
+        """開始處理請求（並行數已達上限時回傳 False），成功時須呼叫 leave()"""
+        if not self._max_concurrent:
+            return True
+        active = self._active.get(key, 0)
+        if active >= self._max_concurrent:
+            self.throttled += 1
+            return False
+        self._active[key] = active + 1
+        return True
+    
+    def leave(self, key: str):
+        """請求處理完成"""
+        if not self._max_concurrent:
+            return
+        remaining = self._active[key] - 1
+        if remaining:
+            self._active[key] = remaining
+        else:
+            del self._active[key]
+    
+    def _sweep(self, now: float):
+        """移除閒置到額度已補滿的鍵（還有負債、尚未補滿的鍵保留）"""
+        self._next_sweep = now + self._sweep_interval
+        idle_before = now - self._idle_after
+        buckets = self._buckets
+        idle = []
+        for key, (tokens, updated_at) in buckets.items():
+            if updated_at > idle_before:
+                break
+            if tokens + (now - updated_at) * self.rate >= self.burst:
+                idle.append(key)
+        for key in idle:
+            del buckets[key]
+        self.swept += len(idle)
+    
+    def stats(self) -> Dict[str, Any]:
+        """速率限制統計資訊"""
+        return {
+            "rate": self.rate,
+            "burst": self.burst,
+            "max_concurrent": self._max_concurrent,
+            "keys": len(self._buckets),
+            "active": sum(self._active.values()),
+            "allowed": self.allowed,
+            "throttled": self.throttled,
+            "swept": self.swept,
+        }
+
+# 路由 → RateLimiter（第一次請求時建立；該路由不限制時為 None）
+rate_limiters: Dict[str, Optional[RateLimiter]] = {}
+
+def rate_limiter_for(route: str) -> Optional[RateLimiter]:
+    """取得路由的 RateLimiter（RATE_LIMIT_ROUTES 未指定的路由使用預設限制）"""
+    if route not in rate_limiters:
+        rate, burst = settings.rate_limit_routes.get(route, (settings.rate_limit_rate, settings.rate_limit_burst))
+        rate_limiters[route] = RateLimiter(
+            rate=rate,
+            burst=burst,
+            max_keys=settings.rate_limit_max_keys,
+            max_concurrent=settings.rate_limit_max_concurrent,
+            sweep_interval=settings.rate_limit_sweep_interval,
+        ) if rate > 0 else None
+    return rate_limiters[route]
+
+# 受保護端點 Token 驗證失敗的限制（依 IP，所有路由共用；未啟用時為 None）
+auth_failure_limiter: Optional[RateLimiter] = RateLimiter(
+    rate=settings.rate_limit_auth_failure_rate,
+    burst=settings.rate_limit_auth_failure_burst,
+    max_keys=settings.rate_limit_max_keys,
+    sweep_interval=settings.rate_limit_sweep_interval,
+) if settings.rate_limit_enabled and settings.rate_limit_auth_failure_rate > 0 else None
+
+def _client_ip(request: Request) -> str:
+    return request.client.host if request.client else "unknown"
+
+def _too_many_requests(route: str, retry_after: float) -> HTTPException:
+    RATE_LIMITED.inc(route)
+    return HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail="請求過於頻繁，請稍後再試",
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+    )
+
+def _admit(request: Request, key: str, cost: int = 1) -> Optional[RateLimiter]:
+    """
+    檢查速率限制，允許時回傳 RateLimiter（請求結束時須呼叫 leave()），未啟用或不限制時回傳 None
+    
+    先檢查並行數再消耗額度，因並行數被拒絕的請求不會用掉額度。
+    cost 為請求消耗的額度數（批次驗證為 Token 數）。
+    
+    Raises:
+        HTTPException: 429 超過速率或並行數限制時拋出（附 Retry-After）
+    """
+    if not settings.rate_limit_enabled:
+        return None
+    route = request.scope["route"].path
+    limiter = rate_limiter_for(route)
+    if limiter is None:
+        return None
+    
+    if not limiter.enter(key):
+        raise _too_many_requests(route, 1)
+    retry_after = limiter.acquire(key, cost)
+    if retry_after:
+        limiter.leave(key)
+        raise _too_many_requests(route, retry_after)
+    return limiter
+
+async def limit_client_ip(request: Request):
+    """
+    未驗證端點的速率限制（依用戶端 IP）
+    
+    用法: @app.get(..., dependencies=[Depends(limit_client_ip)])
     """
-    pass
-
-# ============================================================================
-# 核心功能函數
-# ============================================================================
+    key = f"ip:{_client_ip(request)}"
+    limiter = _admit(request, key)
+    try:
+        yield
+    finally:
+        if limiter is not None:
+            limiter.leave(key)
 
-async def get_public_key():
+async def _verify_token_limited(request: Request, credentials: HTTPAuthorizationCredentials) -> Claims:
     """
-    獲取 Keycloak 公鑰 - 支援多版本 Keycloak
+    驗證 Token，並依用戶端 IP 限制驗證失敗次數
     
-    這個函數實現了多層次的相容性策略：
-    1. 優先嘗試標準 OpenID Connect Discovery (適用於生產模式)
-    2. 回退到直接 Realm 端點 (適用於開發模式或舊版本)
-    3. 自動轉換不同格式的公鑰 (JWKS ↔ PEM)
+    失敗額度用完的 IP 在解析與簽名驗證之前就拒絕，大量無效 Token 不會消耗驗證的 CPU；
+    驗證成功的請求不計入。
     
-    Returns:
-        dict: JWKS 格式的公鑰資訊
-        
     Raises:
-        TokenValidationError: 無法獲取公鑰時拋出
-        
-    支援的 Keycloak 版本：
-    - Keycloak 17+ (標準生產模式)
-    - Keycloak 24.x (開發模式)
-    - 舊版 Keycloak (相容性支援)
+        HTTPException: 429 驗證失敗次數過多時拋出；401 Token 驗證失敗時拋出
     """
+    if auth_failure_limiter is None:
+        return await verify_token(credentials)
+    key = f"ip:{_client_ip(request)}"
+    retry_after = auth_failure_limiter.check(key)
+    if retry_after:
+        raise _too_many_requests(request.scope["route"].path, retry_after)
     try:
-        # 策略 1: 直接嘗試標準 JWKS 端點
-        # 這是最直接的方式，跳過 OpenID Connect Discovery
-        jwks_urls = []
-        for base_url in KEYCLOAK_URLS:
-            jwks_urls.extend([
-                f"{base_url}/realms/{REALM}/protocol/openid-connect/certs",          # Keycloak 標準 JWKS 端點
-                f"{base_url}/auth/realms/{REALM}/protocol/openid-connect/certs"      # Keycloak 16- 舊版路徑
-            ])
-        
-        for url in jwks_urls:
-            try:
-                print(f"嘗試直接 JWKS 端點: {url}")
-                response = requests.get(url, timeout=5)
-                if response.status_code == 200:
-                    jwks_data = response.json()
-                    if "keys" in jwks_data:
-                        print(f"成功從直接 JWKS 端點獲取: {url}")
-                        return jwks_data
-            except Exception as e:
-                print(f"直接 JWKS 端點失敗: {str(e)}")
-                continue
-        
-        # 策略 2: 嘗試標準 OpenID Connect Discovery（備用）
-        # 這是 Keycloak 生產模式的標準做法，提供完整的配置資訊
-        openid_urls = []
-        for base_url in KEYCLOAK_URLS:
-            openid_urls.extend([
-                f"{base_url}/realms/{REALM}/.well-known/openid_configuration",      # Keycloak 17+ 標準路徑
-                f"{base_url}/auth/realms/{REALM}/.well-known/openid_configuration" # Keycloak 16- 舊版路徑
-            ])
-        
-        for url in openid_urls:
-            try:
-                print(f"嘗試 OpenID 配置: {url}")
-                response = requests.get(url, timeout=5)
-                if response.status_code == 200:
-                    openid_config = response.json()
-                    jwks_uri = openid_config["jwks_uri"]
-                    jwks_response = requests.get(jwks_uri)
-                    jwks_response.raise_for_status()
-                    print(f"成功使用 OpenID 配置: {url}")
-                    return jwks_response.json()
-            except Exception as e:
-                print(f"OpenID 配置失敗: {str(e)}")
-                continue
-        
-        # 策略 3: 回退到直接 Realm 端點
-        # 適用於 Keycloak 開發模式或自定義配置，直接從 realm 資訊獲取公鑰
-        print("嘗試舊版 realm 端點獲取公鑰...")
-        for base_url in KEYCLOAK_URLS:
-            realm_url = f"{base_url}/realms/{REALM}"
-            try:
-                print(f"嘗試 realm 端點: {realm_url}")
-                response = requests.get(realm_url, timeout=5)
-                if response.status_code == 200:
-                    realm_info = response.json()
-                    public_key_pem = realm_info.get("public_key")
-                    if public_key_pem:
-                        # 公鑰格式轉換: PEM → JWKS
-                        # Keycloak 開發模式提供 PEM 格式，但 JWT 驗證需要 JWKS 格式
-                        from cryptography.hazmat.primitives import serialization
-                        from cryptography.hazmat.primitives.serialization import load_pem_public_key
-                        import base64
-                        
-                        # 重建完整的 PEM 格式公鑰
-                        # Keycloak 只提供公鑰內容，需要添加 PEM 標頭和標尾
-                        pem_key = f"-----BEGIN PUBLIC KEY-----\n{public_key_pem}\n-----END PUBLIC KEY-----"
-                        public_key = load_pem_public_key(pem_key.encode())
-                        
-                        # 提取算法資訊（預設為 RS256）
-                        algorithm = realm_info.get("algorithm", "RS256")
-                        
-                        # 建構標準 JWKS (JSON Web Key Set) 格式
-                        # 將 RSA 公鑰轉換為 JWT 驗證所需的格式
-                        jwks = {
-                            "keys": [{
-                                "kty": "RSA",                                    # 金鑰類型: RSA
-                                "use": "sig",                                    # 用途: 數位簽名
-                                "kid": realm_info.get("realm", "default"),     # 金鑰識別碼
-                                "n": base64.urlsafe_b64encode(                   # RSA 模數 (n)
-                                    public_key.public_numbers().n.to_bytes(
-                                        (public_key.key_size + 7) // 8, 'big'
-                                    )
-                                ).decode().rstrip('='),
-                                "e": base64.urlsafe_b64encode(                   # RSA 指數 (e)
-                                    public_key.public_numbers().e.to_bytes(3, 'big')
-                                ).decode().rstrip('='),
-                                "alg": algorithm                                # 簽名算法
-                            }]
-                        }
-                        print(f"成功從 realm 端點獲取公鑰: {realm_url}")
-                        return jwks
-            except Exception as e:
-                print(f"Realm 端點失敗: {str(e)}")
-                continue
-        
-        raise TokenValidationError("無法從任何端點獲取 Keycloak 公鑰")
-        
-    except Exception as e:
-        raise TokenValidationError(f"無法獲取 Keycloak 公鑰: {str(e)}")
+        return await verify_token(credentials)
+    except HTTPException as e:
+        if e.status_code == status.HTTP_401_UNAUTHORIZED:
+            auth_failure_limiter.acquire(key)
+        raise
 
-async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)) -> Dict[str, Any]:
+async def limit_subject(request: Request, credentials: HTTPAuthorizationCredentials = Depends(security)):
     """
-    完整的 JWT Token 驗證
+    受保護端點的速率限制（依 Token 的 sub，沒有 sub 時依 azp，都沒有時依 IP）
     
-    執行完整的 JWT 驗證流程，包括：
-    1. 數位簽名驗證（使用 Keycloak 公鑰）
-    2. Token 完整性檢查
-    3. 發行者 (issuer) 驗證
-    4. 受眾 (audience) 驗證
-    5. 過期時間檢查
+    驗證前先依 IP 檢查驗證失敗次數（見 _verify_token_limited）。
+    
+    用法: claims: Claims = Depends(limit_subject)（取代 Depends(verify_token)）
     
-    Args:
-        credentials: HTTP Bearer Token 憑證
-        
     Returns:
-        Dict[str, Any]: 驗證成功的 Token 負載 (payload)
-        
-    Raises:
-        HTTPException: Token 驗證失敗時拋出 401 錯誤
-        
-    安全等級: 最高（生產環境建議）
+        Claims: 驗證通過的 Token claims
     """
-    token = credentials.credentials
-    
+    claims = await _verify_token_limited(request, credentials)
+    if claims.sub:
+        key = f"sub:{claims.sub}"
+    elif claims.azp:
+        key = f"azp:{claims.azp}"
+    else:
+        key = f"ip:{_client_ip(request)}"
+    limiter = _admit(request, key)
     try:
-        # 步驟 1: 獲取 Keycloak 公鑰集合 (JWKS)
-        jwks = await get_public_key()
-        
-        # 步驟 2: 解析 Token 標頭，獲取金鑰識別碼 (kid)
-        # kid 用於從多個公鑰中選擇正確的驗證金鑰
-        unverified_header = jwt.get_unverified_header(token)
-        kid = unverified_header.get("kid")
-        print(f"Token kid: {kid}")
-        
-        # 步驟 3: 金鑰匹配策略
-        # 根據 kid 找到對應的公鑰，支援多種匹配策略以提高相容性
-        public_key = None
-        print(f"可用的 keys: {[key.get('kid') for key in jwks['keys']]}")
-        
-        # 策略 3a: 精確匹配 kid
-        for key in jwks["keys"]:
-            if key["kid"] == kid:
-                public_key = key
-                break
-        
-        # 策略 3b: 回退策略 - 使用第一個可用公鑰
-        # 適用於舊版 Keycloak 或只有單一公鑰的情況
-        if not public_key and jwks["keys"]:
-            print("找不到對應的 kid，使用第一個可用的公鑰")
-            public_key = jwks["keys"][0]
-        
-        if not public_key:
-            raise TokenValidationError("找不到對應的公鑰")
-        
-        # 步驟 4: 執行 JWT 驗證
-        # 使用找到的公鑰進行完整的 JWT 驗證
-        token_issuer = jwt.get_unverified_claims(token).get("iss")
-        payload = jwt.decode(
-            token,
-            public_key,                    # 驗證用公鑰
-            algorithms=["RS256"],          # 支援的簽名算法
-            audience="account",            # Keycloak 預設的 audience
-            issuer=token_issuer           # 動態 issuer 驗證
-        )
-        
-        return payload
+        yield claims
+    finally:
+        if limiter is not None:
+            limiter.leave(key)
+
+# ============================================================================
+# 授權政策
+# ============================================================================
+# 路由的角色 / scope 要求在模組載入時編譯成 frozenset，
+# Token 的權限在建立 Claims 時就整理成一個集合（Claims.grants），之後所有檢查都是集合運算
+
+class Policy:
+    """預先編譯的授權政策
     
-    except JWTError as e:
-        print(f"JWT 驗證錯誤: {str(e)}")  # 服務器端記錄
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail=f"Token 驗證失敗: {str(e)}",
-            headers={"WWW-Authenticate": "Bearer"},
-        )
-    except TokenValidationError as e:
-        print(f"Token 驗證錯誤: {str(e)}")  # 服務器端記錄
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail=str(e),
-            headers={"WWW-Authenticate": "Bearer"},
+    宣告路由需要的角色 / scope，建立時就轉換成 frozenset：
+    - any_*: 至少符合其中一個（realm 角色、client 角色、scope 之間為「或」）
+    - all_*: 全部都要符合
+    兩者同時設定時必須都成立。
+    """
+    
+    __slots__ = ("name", "detail", "_any_of", "_all_of")
+    
+    def __init__(self, name: str, *,
+                 any_realm_roles=(), all_realm_roles=(),
+                 any_client_roles: Optional[Dict[str, Any]] = None,
+                 all_client_roles: Optional[Dict[str, Any]] = None,
+                 any_scopes=(), all_scopes=(),
+                 detail: str = "權限不足"):
+        self.name = name                                       # 政策名稱（用於指標與日誌）
+        self.detail = detail                                   # 403 回應訊息
+        self._any_of = frozenset(
+            [_realm_grant(role) for role in any_realm_roles]
+            + [_client_grant(client, role) for client, roles in (any_client_roles or {}).items() for role in roles]
+            + [_scope_grant(scope) for scope in any_scopes]
         )
-    except Exception as e:
-        print(f"未預期的錯誤: {str(e)}")  # 服務器端記錄
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail=f"驗證過程發生錯誤: {str(e)}",
-            headers={"WWW-Authenticate": "Bearer"},
+        self._all_of = frozenset(
+            [_realm_grant(role) for role in all_realm_roles]
+            + [_client_grant(client, role) for client, roles in (all_client_roles or {}).items() for role in roles]
+            + [_scope_grant(scope) for scope in all_scopes]
         )
+    
+    def allows(self, grants: frozenset) -> bool:
+        """檢查 Token 權限集合是否符合政策"""
+        if self._any_of and grants.isdisjoint(self._any_of):
+            return False
+        return self._all_of <= grants
+
+def require(policy: Policy):
+    """
+    建立檢查授權政策的 FastAPI 依賴
+    
+    用法: claims: Claims = Depends(require(ADMIN_POLICY))
+    
+    Args:
+        policy: 要套用的授權政策
+        
+    Returns:
+        依賴函數：驗證 Token（含速率限制）並檢查政策，通過時回傳 Claims
+    """
+    async def dependency(claims: Claims = Depends(limit_subject)) -> Claims:
+        if not policy.allows(claims.grants):
+            AUTHZ_DENIALS.inc(policy.name)
+            verify_logger.info("授權政策拒絕: %s (sub=%s)", policy.name, claims.sub)
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=policy.detail)
+        return claims
+    return dependency
+
+# 管理員政策：realm 角色 realm-admin / admin，或 realm-management client 的 realm-admin / view-users
+ADMIN_POLICY = Policy(
+    "admin",
+    any_realm_roles=("realm-admin", "admin"),
+    any_client_roles={"realm-management": ("realm-admin", "view-users")},
+    detail="需要管理員權限才能訪問此端點",
+)
 
 # ============================================================================
 # API 端點定義
@@ -323,7 +3720,7 @@ async def root():
     """
     return {"message": "Keycloak API 測試後端運行中", "status": "OK"}
 
-@app.get("/api/public", tags=["公開 API"], summary="公開端點示範")
+@app.get("/api/public", tags=["公開 API"], summary="公開端點示範", dependencies=[Depends(limit_client_ip)])
 async def public_endpoint():
     """
     公開 API 端點
@@ -341,7 +3738,7 @@ async def public_endpoint():
         "timestamp": datetime.datetime.now().isoformat()
     }
 
-@app.get("/api/explore-keycloak", tags=["除錯工具"], summary="Keycloak 服務探索")
+@app.get("/api/explore-keycloak", tags=["除錯工具"], summary="Keycloak 服務探索", dependencies=[Depends(limit_client_ip)])
 async def explore_keycloak():
     """
     Keycloak 服務結構探索工具
@@ -354,39 +3751,132 @@ async def explore_keycloak():
         
     注意: 此端點僅用於開發和除錯，生產環境中應該移除
     """
-    results = {}
-    base_urls = ["http://localhost:8080", "http://127.0.0.1:8080"]
-    
-    for base_url in base_urls:
-        results[base_url] = {}
-        
-        # 嘗試不同的路徑
-        test_paths = [
-            "/",
-            "/realms",
-            "/auth/realms", 
-            "/admin/realms",
-            f"/realms/{REALM}",
-            f"/auth/realms/{REALM}",
-            f"/realms/{REALM}/.well-known/openid_configuration",
-            f"/auth/realms/{REALM}/.well-known/openid_configuration"
-        ]
-        
-        for path in test_paths:
-            try:
-                url = f"{base_url}{path}"
-                response = requests.get(url, timeout=2)
-                results[base_url][path] = {
-                    "status_code": response.status_code,
-                    "content_type": response.headers.get("content-type", ""),
-                    "content_preview": response.text[:200] + "..." if len(response.text) > 200 else response.text
-                }
-            except Exception as e:
-                results[base_url][path] = {"error": str(e)}
+    base_urls = settings.keycloak_urls
+    
+    # 嘗試不同的路徑
+    test_paths = [
+        "/",
+        "/realms",
+        "/auth/realms", 
+        "/admin/realms",
+        f"/realms/{settings.realm}",
+        f"/auth/realms/{settings.realm}",
+        f"/realms/{settings.realm}/.well-known/openid-configuration",
+        f"/auth/realms/{settings.realm}/.well-known/openid-configuration"
+    ]
+    
+    async def probe(url: str) -> Dict[str, Any]:
+        try:
+            response = await http_request("GET", url, timeout=settings.keycloak_explore_timeout)
+            return {
+                "status_code": response.status_code,
+                "content_type": response.headers.get("content-type", ""),
+                "content_preview": response.text[:200] + "..." if len(response.text) > 200 else response.text
+            }
+        except Exception as e:
+            return {"error": str(e)}
+    
+    # 所有 base_url × path 組合同時探測，總耗時約等於最慢的單一請求
+    matrix = [(base_url, path) for base_url in base_urls for path in test_paths]
+    probes = await asyncio.gather(*(probe(f"{base_url}{path}") for base_url, path in matrix))
+    
+    results = {base_url: {} for base_url in base_urls}
+    for (base_url, path), result in zip(matrix, probes):
+        results[base_url][path] = result
     
     return results
 
-@app.post("/api/debug-token", tags=["除錯工具"], summary="Token 結構分析")
+def _collect_cache_metrics():
+    """在抓取 /metrics 時讀取各快取的計數"""
+    collected = [
+        ("jwks_cache_lookups_total", "counter", "JWKS 快取查詢次數",
+         [({"result": "hit"}, jwks_cache.hits), ({"result": "miss"}, jwks_cache.misses)]),
+        ("jwks_cache_fetches_total", "counter", "JWKS 實際抓取次數",
+         [({}, jwks_cache.fetches)]),
+        ("jwks_cache_fetch_failures_total", "counter", "JWKS 抓取失敗次數",
+         [({}, jwks_cache.refresh_failures)]),
+        ("jwks_cache_stale_served_total", "counter", "寬限期內以過期公鑰回應的次數",
+         [({}, jwks_cache.stale_served)]),
+        ("jwks_cache_shared_adopted_total", "counter", "採用其他 worker 抓取之 JWKS 的次數",
+         [({}, jwks_cache.shared_adopted)]),
+    ]
+    realm_stats = issuer_registry.stats()
+    collected.extend([
+        ("jwks_realms_cached", "gauge", "目前保留公鑰的 realm 數",
+         [({}, realm_stats["realms"])]),
+        ("jwks_realm_evictions_total", "counter", "因容量淘汰的 realm 公鑰快取次數",
+         [({}, realm_stats["evictions"])]),
+    ])
+    if token_cache is not None:
+        stats = token_cache.stats()
+        collected.extend([
+            ("token_cache_lookups_total", "counter", "已驗證 Token 快取查詢次數",
+             [({"result": "hit"}, stats["hits"]), ({"result": "miss"}, stats["misses"])]),
+            ("token_cache_evictions_total", "counter", "已驗證 Token 快取淘汰次數",
+             [({"reason": "capacity"}, stats["evictions"]), ({"reason": "expired"}, stats["expirations"])]),
+            ("token_cache_size", "gauge", "已驗證 Token 快取目前項目數",
+             [({}, stats["size"])]),
+        ])
+    if shared_token_table is not None:
+        collected.append(
+            ("shared_token_cache_lookups_total", "counter", "跨 worker 已驗證 Token 表查詢次數",
+             [({"result": "hit"}, shared_token_table.hits), ({"result": "miss"}, shared_token_table.misses)]))
+    revocation_stats = revocation_index.stats()
+    collected.append(
+        ("revocation_index_size", "gauge", "撤銷索引目前項目數",
+         [({"kind": "session"}, revocation_stats["sessions"]), ({"kind": "subject"}, revocation_stats["subjects"])]))
+    limiters = [(route, limiter) for route, limiter in rate_limiters.items() if limiter is not None]
+    if limiters:
+        collected.append(
+            ("rate_limit_keys", "gauge", "速率限制目前追蹤的用戶端數",
+             [({"route": route}, limiter.stats()["keys"]) for route, limiter in limiters]))
+    return collected
+
+metrics.add_collector(_collect_cache_metrics)
+
+@app.get("/metrics", tags=["健康檢查"], summary="Prometheus 指標", include_in_schema=settings.metrics_enabled)
+async def metrics_endpoint():
+    """
+    Prometheus 指標端點
+    
+    提供 Token 驗證各階段延遲、對 Keycloak 的請求次數與延遲、快取命中率、
+    401 失敗原因統計及 API 請求處理延遲。
+    
+    Returns:
+        PlainTextResponse: Prometheus 文字格式的指標
+    """
+    if not settings.metrics_enabled:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/api/cache-stats", tags=["除錯工具"], summary="快取統計資訊", dependencies=[Depends(limit_client_ip)])
+async def cache_stats():
+    """
+    快取統計資訊
+    
+    顯示已驗證 Token 快取的命中 / 未命中 / 淘汰計數、各 realm 公鑰快取的數量、撤銷索引大小與各路由的速率限制，
+    用於調整快取容量與限制值。
+    
+    Returns:
+        dict: 快取是否啟用及統計資訊
+    """
+    if token_cache is None:
+        token_cache_stats = {"enabled": False}
+    else:
+        token_cache_stats = {"enabled": True, **token_cache.stats()}
+    stats = {
+        "token_cache": token_cache_stats,
+        "jwks_realms": issuer_registry.stats(),
+        "revocations": revocation_index.stats(),
+        "rate_limits": {route: limiter.stats() for route, limiter in rate_limiters.items() if limiter is not None},
+    }
+    if auth_failure_limiter is not None:
+        stats["auth_failure_limit"] = auth_failure_limiter.stats()
+    if shared_token_table is not None:
+        stats["shared_token_cache"] = shared_token_table.stats()
+    return stats
+
+@app.post("/api/debug-token", tags=["除錯工具"], summary="Token 結構分析", dependencies=[Depends(limit_client_ip)])
 async def debug_token(token_data: dict):
     """
     JWT Token 結構分析工具
@@ -407,25 +3897,52 @@ async def debug_token(token_data: dict):
         if not token:
             return {"error": "未提供 token"}
         
-        # 解碼 token header（不驗證）
-        unverified_header = jwt.get_unverified_header(token)
-        
-        # 解碼 token payload（不驗證）
-        unverified_payload = jwt.get_unverified_claims(token)
+        # 解碼 token header 與 payload（不驗證）
+        parsed = parse_token(token)
         
         return {
-            "header": unverified_header,
-            "payload": unverified_payload,
+            "header": parsed.header,
+            "payload": parsed.claims,
             "keycloak_config": {
-                "urls": KEYCLOAK_URLS,
-                "realm": REALM,
-                "client_id": CLIENT_ID,
-                "valid_issuers": [f"{url}/realms/{REALM}" for url in KEYCLOAK_URLS]
+                "urls": settings.keycloak_urls,
+                "realm": settings.realm,
+                "client_id": settings.client_id,
+                "valid_issuers": sorted(settings.valid_issuers)
             }
         }
     except Exception as e:
         return {"error": f"解析 token 失敗: {str(e)}"}
 
+def _basic_claims_error(payload: Dict[str, Any]) -> Optional[Tuple[str, str]]:
+    """
+    基本驗證的欄位檢查（不驗證簽名）
+    
+    Returns:
+        Optional[Tuple[str, str]]: 通過時回傳 None，否則回傳 (失敗原因, 錯誤訊息)
+    """
+    # 檢查必要欄位
+    if not payload.get("sub"):
+        return "invalid_claims", "Token 缺少 subject"  # 使用者識別碼
+    
+    if not payload.get("iss"):
+        return "invalid_claims", "Token 缺少 issuer"   # 發行者
+    
+    # 發行者驗證
+    # 檢查 Token 是否來自信任的 Keycloak 實例
+    # （合法 issuer 於啟動時預先建成 frozenset，不需每個請求重建清單）
+    token_issuer = payload.get("iss")
+    
+    if token_issuer not in settings.valid_issuers:
+        # 寬鬆驗證：記錄警告但不阻擋，因為實際 issuer 通常是正確的
+        verify_logger.debug("issuer 不在預期列表中，但繼續處理: %s (預期: %s)", token_issuer, settings.valid_issuers)
+    
+    # 過期時間檢查
+    exp = payload.get("exp")
+    if exp and int(time.time()) > exp:
+        return "expired", "Token 已過期"
+    
+    return None
+
 async def verify_token_basic(credentials: HTTPAuthorizationCredentials = Depends(security)) -> Dict[str, Any]:
     """
     基本 JWT Token 驗證
@@ -449,46 +3966,26 @@ async def verify_token_basic(credentials: HTTPAuthorizationCredentials = Depends
     
     try:
         # 步驟 1: 解析 Token 內容（跳過簽名驗證）
-        payload = jwt.get_unverified_claims(token)
-        
-        # 步驟 2: 檢查必要欄位
-        if not payload.get("sub"):
-            raise TokenValidationError("Token 缺少 subject")  # 使用者識別碼
-        
-        if not payload.get("iss"):
-            raise TokenValidationError("Token 缺少 issuer")   # 發行者
+        payload = parse_token(token).claims
         
-        # 步驟 3: 發行者驗證
-        # 檢查 Token 是否來自信任的 Keycloak 實例
-        token_issuer = payload.get("iss")
-        valid_issuers = [f"{base_url}/realms/{REALM}" for base_url in KEYCLOAK_URLS]
-        
-        if token_issuer not in valid_issuers:
-            print(f"Token issuer: {token_issuer}")
-            print(f"Valid issuers: {valid_issuers}")
-            # 寬鬆驗證：記錄警告但不阻擋，因為實際 issuer 通常是正確的
-            print("警告：issuer 不在預期列表中，但繼續處理")
-        
-        # 步驟 4: 過期時間檢查
-        import time
-        current_time = int(time.time())
-        exp = payload.get("exp")
-        if exp and current_time > exp:
-            raise TokenValidationError("Token 已過期")
+        # 步驟 2-4: 必要欄位、發行者與過期時間檢查
+        error = _basic_claims_error(payload)
+        if error is not None:
+            raise TokenValidationError(error[1])
         
         return payload
     
     except TokenValidationError:
         raise
     except Exception as e:
-        print(f"基本驗證錯誤: {str(e)}")
+        verify_logger.info("基本驗證錯誤: %s", e)
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail=f"Token 驗證失敗: {str(e)}",
             headers={"WWW-Authenticate": "Bearer"},
         )
 
-@app.get("/api/test-no-verify", tags=["測試端點"], summary="無驗證測試")
+@app.get("/api/test-no-verify", tags=["測試端點"], summary="無驗證測試", dependencies=[Depends(limit_client_ip)])
 async def test_no_verify_endpoint(credentials: HTTPAuthorizationCredentials = Depends(security)):
     """
     無驗證 Token 測試端點
@@ -507,7 +4004,7 @@ async def test_no_verify_endpoint(credentials: HTTPAuthorizationCredentials = De
     token = credentials.credentials
     try:
         # 只解析 token，不驗證簽名
-        unverified_payload = jwt.get_unverified_claims(token)
+        unverified_payload = parse_token(token).claims
         return {
             "message": "Token 解析成功（未驗證簽名）",
             "payload": unverified_payload
@@ -515,7 +4012,7 @@ async def test_no_verify_endpoint(credentials: HTTPAuthorizationCredentials = De
     except Exception as e:
         return {"error": f"無法解析 token: {str(e)}"}
 
-@app.get("/api/test-basic", tags=["測試端點"], summary="基本驗證測試")
+@app.get("/api/test-basic", tags=["測試端點"], summary="基本驗證測試", dependencies=[Depends(limit_client_ip)])
 async def test_basic_endpoint(payload: Dict[str, Any] = Depends(verify_token_basic)):
     """
     基本 Token 驗證測試端點
@@ -541,8 +4038,54 @@ async def test_basic_endpoint(payload: Dict[str, Any] = Depends(verify_token_bas
         "expires_at": payload.get("exp")
     }
 
-@app.get("/api/protected", tags=["受保護 API"], summary="受保護端點")
-async def protected_endpoint(payload: Dict[str, Any] = Depends(verify_token)):
+async def require_batch_secret(request: Request):
+    """
+    批次驗證端點的存取控制：X-Batch-Verify-Secret 標頭必須等於 BATCH_VERIFY_SECRET
+    
+    Raises:
+        HTTPException: 503 未設定 BATCH_VERIFY_SECRET 時拋出；401 密鑰缺少或不正確時拋出
+    """
+    if not settings.batch_verify_secret:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="未設定 BATCH_VERIFY_SECRET，批次驗證端點已停用"
+        )
+    provided = request.headers.get("X-Batch-Verify-Secret", "")
+    if not hmac.compare_digest(provided.encode(), settings.batch_verify_secret.encode()):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="批次驗證密鑰不正確")
+
+@app.post("/api/verify/batch", tags=["認證管理"], summary="批次驗證 Token", response_class=FastJSONResponse,
+          dependencies=[Depends(require_batch_secret)])
+async def verify_batch(body: BatchVerifyRequest, request: Request):
+    """
+    批次驗證 Token（供 API 閘道 / sidecar 使用）
+    
+    一次請求驗證多個 Bearer Token，不需要每個 Token 各打一次 /api/protected。
+    Token 依 (issuer, kid) 分組，每組只解析一次公鑰；簽名驗證在執行緒池中並行。
+    需要 X-Batch-Verify-Secret 標頭；速率限制依用戶端 IP、以 Token 數計費。
+    
+    Args:
+        body: Token 清單與驗證模式（full: 同 /api/protected / basic: 同 /api/test-basic）
+        request: HTTP 請求（用於 Accept-Encoding 協商）
+        
+    Returns:
+        Response: {"results": [...]}，依輸入順序；每項為
+            {"valid": true, "claims": {...}} 或 {"valid": false, "error": 失敗原因, "detail": 訊息}
+            
+    Raises:
+        HTTPException: 401 / 503 見 require_batch_secret；429 超過速率限制時拋出
+    """
+    key = f"ip:{_client_ip(request)}"
+    limiter = _admit(request, key, cost=max(1, len(body.tokens)))
+    try:
+        results = await verify_tokens_batch(body.tokens, body.mode)
+    finally:
+        if limiter is not None:
+            limiter.leave(key)
+    return json_response({"results": results}, request)
+
+@app.get("/api/protected", tags=["受保護 API"], summary="受保護端點", response_class=FastJSONResponse)
+async def protected_endpoint(claims: Claims = Depends(limit_subject)):
     """
     受保護 API 端點
     
@@ -550,154 +4093,589 @@ async def protected_endpoint(payload: Dict[str, Any] = Depends(verify_token)):
     執行完整的 Token 驗證，包含數位簽名檢查。
     
     Args:
-        payload: 經過完整驗證的 Token 負載
+        claims: 經過完整驗證的 Token claims
         
     Returns:
         dict: 使用者資訊、角色權限和 Token 訊息
         
     安全等級: 高（生產環境建議）
     """
-    return {
+    return json_response({
         "message": "成功訪問受保護端點",
-        "user_id": payload.get("sub"),
-        "username": payload.get("preferred_username"),
-        "email": payload.get("email"),
-        "roles": payload.get("realm_access", {}).get("roles", []),
+        "user_id": claims.sub,
+        "username": claims.preferred_username,
+        "email": claims.email,
+        "roles": sorted(claims.realm_roles),
         "token_info": {
-            "issued_at": payload.get("iat"),
-            "expires_at": payload.get("exp"),
-            "issuer": payload.get("iss")
+            "issued_at": claims.iat,
+            "expires_at": claims.exp,
+            "issuer": claims.iss
         }
-    }
+    })
 
-@app.get("/api/user-info", tags=["使用者管理"], summary="獲取使用者資訊", response_model=UserInfo)
-async def get_user_info(payload: Dict[str, Any] = Depends(verify_token)) -> UserInfo:
+@app.get("/api/user-info", tags=["使用者管理"], summary="獲取使用者資訊",
+         response_class=FastJSONResponse, responses={200: {"model": UserInfo}})
+async def get_user_info(claims: Claims = Depends(limit_subject)) -> Response:
     """
     獲取當前使用者詳細資訊
     
     從驗證通過的 JWT Token 中提取使用者的基本資訊。
     適用於使用者配置文件、個人資訊頁面等功能。
     
+    回應格式對應 UserInfo 模型，直接由 Claims 序列化（不重新建構 Pydantic 模型）。
+    
     Args:
-        payload: 經過驗證的 Token 負載
+        claims: 經過驗證的 Token claims
         
     Returns:
-        UserInfo: 結構化的使用者資訊物件
+        Response: 使用者資訊（UserInfo 格式）
+    """
+    return json_response(claims.user_info())
+
+class KeycloakAdminClient:
+    """Keycloak Admin API 客戶端（service account）
+    
+    1. 以 client_credentials 取得 service account Token，快取到到期前幾秒；同時的取得合併為一次
+    2. Admin API 回應 401（Token 已撤銷或提早失效）時重新取得 Token 並重試一次
+    3. 分頁列出使用者時同時預先抓取後續幾頁，逐頁交給呼叫端，不在記憶體中組出完整清單
     """
-    return UserInfo(
-        sub=payload.get("sub"),
-        email=payload.get("email"),
-        name=payload.get("name"),
-        preferred_username=payload.get("preferred_username"),
-        given_name=payload.get("given_name"),
-        family_name=payload.get("family_name")
+    
+    def __init__(self, client_id: str, client_secret: str, page_size: int, prefetch_pages: int,
+                 timeout: float, refresh_ahead: float):
+        self._auth = (client_id, client_secret)
+        self._page_size = page_size
+        self._prefetch_pages = prefetch_pages
+        self._timeout = httpx.Timeout(timeout, connect=min(timeout, 2.0))
+        self._refresh_ahead = refresh_ahead
+        self._token: Optional[str] = None
+        self._token_expires_at = 0.0                           # time.monotonic()
+        self._token_task: Optional[asyncio.Task] = None        # 進行中的 Token 取得
+    
+    @property
+    def configured(self) -> bool:
+        """是否已設定 service account 憑證"""
+        return bool(self._auth[1])
+    
+    async def _fetch_token(self) -> str:
+        url = keycloak_endpoints(endpoint_resolver.base_url, settings.realm).token
+        response = await http_request(
+            "POST", url,
+            data={"grant_type": "client_credentials"},
+            auth=self._auth,
+            timeout=self._timeout,
+        )
+        response.raise_for_status()
+        result = response.json()
+        expires_in = float(result.get("expires_in", 60))
+        self._token = result["access_token"]
+        # Token 有效期很短時至少使用一半的時間，避免每次呼叫都重新取得
+        self._token_expires_at = time.monotonic() + max(expires_in - self._refresh_ahead, expires_in / 2)
+        ADMIN_API_REQUESTS.inc("token")
+        admin_logger.debug("已取得 service account Token（%s 秒後到期）", expires_in)
+        return self._token
+    
+    async def token(self) -> str:
+        """
+        取得 service account Token（快取中且未接近到期時直接回傳）
+        
+        Raises:
+            httpx.HTTPError: Token 端點呼叫失敗
+        """
+        if self._token is not None and time.monotonic() < self._token_expires_at:
+            return self._token
+        task = self._token_task
+        if task is None:
+            task = asyncio.create_task(self._fetch_token())
+            self._token_task = task
+            task.add_done_callback(lambda _: setattr(self, "_token_task", None))
+        return await asyncio.shield(task)
+    
+    def invalidate(self, token: str):
+        """捨棄被 Keycloak 拒絕的 Token（已被替換時不動作）"""
+        if self._token == token:
+            self._token = None
+    
+    async def get(self, url: str, params: Dict[str, Any]) -> Any:
+        """
+        以 service account 身分呼叫 Admin API（GET）
+        
+        Raises:
+            httpx.HTTPError: 呼叫失敗
+        """
+        for attempt in range(2):
+            token = await self.token()
+            response = await http_request(
+                "GET", url,
+                params=params,
+                headers={"Authorization": f"Bearer {token}"},
+                timeout=self._timeout,
+            )
+            if response.status_code == 401 and attempt == 0:
+                ADMIN_API_REQUESTS.inc("retry")
+                self.invalidate(token)
+                continue
+            response.raise_for_status()
+            return response.json()
+    
+    async def iter_user_pages(self, params: Dict[str, Any], first: int = 0, limit: Optional[int] = None):
+        """
+        依序產生使用者分頁（/admin/realms/{realm}/users）
+        
+        第一頁單獨抓取；第一頁是滿的才同時預先抓取後續分頁，結果少的查詢不會多打請求。
+        
+        Args:
+            params: 直接傳給 Keycloak 的查詢條件（search、username、email 等）
+            first: 起始位置（游標）
+            limit: 最多回傳的使用者數（None 表示全部）
+            
+        Yields:
+            list: 一頁使用者（Keycloak UserRepresentation）
+            
+        Raises:
+            httpx.HTTPError: Admin API 呼叫失敗
+        """
+        url = keycloak_endpoints(endpoint_resolver.base_url, settings.realm).admin_users
+        end = None if limit is None else first + limit
+        pending = deque()                                      # (抓取中的分頁, 該頁請求的筆數)，依位置排序
+        offset = first
+        window = 1
+        try:
+            while True:
+                while len(pending) < window and (end is None or offset < end):
+                    size = self._page_size if end is None else min(self._page_size, end - offset)
+                    task = asyncio.create_task(self.get(url, {**params, "first": offset, "max": size}))
+                    pending.append((task, size))
+                    offset += size
+                if not pending:
+                    return
+                task, size = pending.popleft()
+                try:
+                    page = await task
+                except httpx.HTTPError:
+                    ADMIN_API_REQUESTS.inc("error")
+                    raise
+                ADMIN_API_REQUESTS.inc("page")
+                if page:
+                    yield page
+                if len(page) < size:
+                    return                                     # 不足一頁代表已到結尾，不再排入後續分頁
+                window = self._prefetch_pages + 1
+        finally:
+            # 提早結束（資料已取完、呼叫端中斷或出錯）時取消預先抓取的分頁，並等待取消完成，
+            # 產生器關閉後不會留下仍在進行的 Admin API 請求
+            tasks = [task for task, _ in pending]
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+# 全域 Admin API 客戶端實例
+admin_client = KeycloakAdminClient(
+    client_id=settings.admin_client_id,
+    client_secret=settings.admin_client_secret,
+    page_size=settings.admin_page_size,
+    prefetch_pages=settings.admin_prefetch_pages,
+    timeout=settings.admin_timeout,
+    refresh_ahead=settings.admin_token_refresh_ahead,
+)
+
+# 可直接傳給 Keycloak 的使用者查詢條件
+_USER_QUERY_FILTERS = (
+    "search", "username", "email", "firstName", "lastName", "enabled", "emailVerified",
+    "exact", "idpAlias", "idpUserId", "q", "briefRepresentation",
+)
+
+def _admin_api_error(e: httpx.HTTPError) -> HTTPException:
+    """將 Admin API 呼叫失敗轉換為 HTTP 錯誤"""
+    if isinstance(e, httpx.TimeoutException):
+        return HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail=f"Keycloak Admin API 逾時: {str(e) or type(e).__name__}"
+        )
+    if isinstance(e, httpx.HTTPStatusError) and e.response.status_code in (401, 403):
+        return HTTPException(
+            status_code=status.HTTP_502_BAD_GATEWAY,
+            detail="Keycloak 拒絕 service account 存取（請確認 client 具有 realm-management 的 view-users 角色）"
+        )
+    return HTTPException(
+        status_code=status.HTTP_502_BAD_GATEWAY,
+        detail=f"Keycloak Admin API 呼叫失敗: {str(e) or type(e).__name__}"
     )
 
 @app.get("/api/admin/users", tags=["管理員 API"], summary="獲取所有使用者")
-async def get_users(payload: Dict[str, Any] = Depends(verify_token)):
+async def get_users(
+    request: Request,
+    first: int = Query(0, ge=0, description="起始位置（游標，下一批為回應中的 next）"),
+    limit: Optional[int] = Query(None, ge=1, alias="max", description="最多回傳的使用者數（未指定表示全部）"),
+    format: str = Query("json", pattern="^(json|ndjson)$", description="json: 串流的 JSON 物件 / ndjson: 每行一個使用者"),
+    claims: Claims = Depends(require(ADMIN_POLICY)),
+):
     """
     管理員端點：獲取所有使用者
     
-    需要管理員權限才能訪問。
-    檢查使用者是否具有 'realm-admin' 或 'admin' 角色。
+    需要管理員權限才能訪問（見 ADMIN_POLICY）。
+    檢查使用者是否具有 'realm-admin' 或 'admin' realm 角色，
+    或 realm-management client 的 'realm-admin' / 'view-users' 角色。
+    
+    透過 Keycloak Admin API 分頁取得使用者，邊抓邊以 chunked 回應串流給呼叫端，
+    記憶體用量只與分頁大小有關，與使用者總數無關。
+    search、username、email 等查詢條件直接傳給 Keycloak。
     
     Args:
-        payload: 經過驗證的 Token 負載
+        request: HTTP 請求（讀取查詢條件）
+        first: 起始位置
+        limit: 最多回傳的使用者數
+        format: 回應格式
+        claims: 經過驗證的 Token claims
         
     Returns:
-        dict: 管理員操作結果訊息
+        StreamingResponse: json 格式為 {"first", "users", "count", "next"}（next 為 null 表示已無更多資料），
+            ndjson 格式為每行一個使用者
         
     Raises:
         HTTPException: 403 缺少管理員權限時拋出
+        HTTPException: 503 未設定 ADMIN_CLIENT_SECRET 時拋出
+        HTTPException: 502 / 504 Keycloak 拒絕存取、無法連線或逾時時拋出
         
-    權限要求: realm-admin 或 admin 角色
+    權限要求: realm-admin 或 admin 角色（realm 或 realm-management client）
     """
-    # 檢查是否有管理員角色
-    roles = payload.get("realm_access", {}).get("roles", [])
-    if "realm-admin" not in roles and "admin" not in roles:
+    if not admin_client.configured:
         raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="需要管理員權限才能訪問此端點"
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="未設定 ADMIN_CLIENT_SECRET，無法呼叫 Keycloak Admin API"
         )
     
-    return {
-        "message": "管理員端點訪問成功",
-        "note": "這裡可以實作 Keycloak Admin API 呼叫",
-        "user_roles": roles
-    }
+    params = {name: request.query_params[name] for name in _USER_QUERY_FILTERS if name in request.query_params}
+    pages = admin_client.iter_user_pages(params, first, limit)
+    
+    # 先取得第一頁：常見錯誤（權限、連線）可以回應正確的狀態碼，而不是中斷的串流
+    try:
+        first_page = await anext(pages, [])
+    except httpx.HTTPError as e:
+        await pages.aclose()
+        admin_logger.warning("列出使用者失敗: %s", e)
+        raise _admin_api_error(e)
+    
+    async def stream_pages():
+        page = first_page
+        try:
+            while page:
+                yield page
+                page = await anext(pages, None)
+        except httpx.HTTPError as e:
+            # 回應已開始傳送，只能中斷連線（chunked 回應沒有正常結尾，呼叫端可據此判斷不完整）
+            admin_logger.warning("列出使用者時中途失敗: %s", e)
+            raise
+        finally:
+            await pages.aclose()
+    
+    if format == "ndjson":
+        async def body():
+            async for page in stream_pages():
+                yield b"".join(dump_json(user) + b"\n" for user in page)
+        return StreamingResponse(body(), media_type="application/x-ndjson")
+    
+    async def body():
+        count = 0
+        yield b'{"first":%d,"users":[' % first
+        async for page in stream_pages():
+            yield (b"," if count else b"") + b",".join(dump_json(user) for user in page)
+            count += len(page)
+        # 取滿 limit 時可能還有下一批；不足時代表已到結尾
+        has_more = limit is not None and count >= limit
+        yield b'],"count":%d,"next":%s}' % (count, b"%d" % (first + count) if has_more else b"null")
+    return StreamingResponse(body(), media_type="application/json")
 
-@app.get("/api/token-info", tags=["使用者管理"], summary="獲取 Token 詳細資訊")
-async def get_token_info(payload: Dict[str, Any] = Depends(verify_token)):
+@app.get("/api/token-info", tags=["使用者管理"], summary="獲取 Token 詳細資訊", response_class=FastJSONResponse)
+async def get_token_info(request: Request, claims: Claims = Depends(limit_subject)):
     """
     獲取當前 Token 的詳細資訊
     
     提供 Token 的完整資訊，包含使用者資料、Token 元資料和權限資訊。
     適用於除錯、權限檢查和安全審計。
+    回應較大，用戶端支援時以 gzip 壓縮。
     
     Args:
-        payload: 經過驗證的 Token 負載
+        request: HTTP 請求（用於 Accept-Encoding 協商）
+        claims: 經過驗證的 Token claims
         
     Returns:
-        dict: 包含 Token 完整資訊的詳細物件
+        Response: 包含 Token 完整資訊的詳細物件
     """
-    return {
-        "token_payload": payload,
+    return json_response({
+        "token_payload": claims.raw,
         "user_info": {
-            "user_id": payload.get("sub"),
-            "username": payload.get("preferred_username"),
-            "email": payload.get("email"),
-            "name": payload.get("name"),
-            "given_name": payload.get("given_name"),
-            "family_name": payload.get("family_name")
+            "user_id": claims.sub,
+            "username": claims.preferred_username,
+            "email": claims.email,
+            "name": claims.name,
+            "given_name": claims.given_name,
+            "family_name": claims.family_name
         },
         "token_metadata": {
-            "issued_at": payload.get("iat"),
-            "expires_at": payload.get("exp"),
-            "issuer": payload.get("iss"),
-            "audience": payload.get("aud"),
-            "token_type": payload.get("typ")
+            "issued_at": claims.iat,
+            "expires_at": claims.exp,
+            "issuer": claims.iss,
+            "audience": claims.aud,
+            "token_type": claims.typ
         },
         "permissions": {
-            "realm_roles": payload.get("realm_access", {}).get("roles", []),
-            "client_roles": payload.get("resource_access", {})
+            "realm_roles": sorted(claims.realm_roles),
+            "client_roles": claims.get("resource_access", {})
         }
-    }
+    }, request)
+
+class TokenRefreshProxy:
+    """Token 刷新代理
+    
+    保護 Keycloak 不被大量同時刷新（例如多個瀏覽器分頁同時刷新）拖垮：
+    1. 共用連線池，並使用嚴格的逾時設定
+    2. 同一個 Refresh Token 同時的刷新請求合併為一次上游呼叫
+    3. 成功結果短暫快取，吸收重複的刷新請求
+    4. 限制單一用戶端同時進行的刷新數，以及整體對 Keycloak 的並行數
+    """
+    
+    def __init__(self, timeout: float, result_ttl: float, max_cached: int, max_per_client: int, max_upstream: int):
+        self._timeout = httpx.Timeout(timeout, connect=min(timeout, 2.0))
+        self._result_ttl = result_ttl
+        self._max_cached = max_cached
+        self._max_per_client = max_per_client
+        self._upstream = asyncio.Semaphore(max_upstream)
+        self._inflight: Dict[bytes, asyncio.Task] = {}         # Token 摘要 → 進行中的上游呼叫
+        self._results: "OrderedDict[bytes, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._active: Dict[str, int] = {}                      # 用戶端 → 進行中的刷新數
+    
+    def _cached_result(self, digest: bytes) -> Optional[Dict[str, Any]]:
+        entry = self._results.get(digest)
+        if entry is None:
+            return None
+        expires_at, result = entry
+        if time.monotonic() >= expires_at:
+            del self._results[digest]
+            return None
+        return result
+    
+    def _store_result(self, digest: bytes, result: Dict[str, Any]):
+        if self._result_ttl <= 0:
+            return
+        self._results[digest] = (time.monotonic() + self._result_ttl, result)
+        self._results.move_to_end(digest)
+        while len(self._results) > self._max_cached:
+            self._results.popitem(last=False)
+    
+    async def _refresh_upstream(self, digest: bytes, refresh_token: str) -> Dict[str, Any]:
+        """實際呼叫 Keycloak Token 端點"""
+        data = {
+            "grant_type": "refresh_token",
+            "client_id": settings.client_id,
+            "refresh_token": refresh_token
+        }
+        url = keycloak_endpoints(endpoint_resolver.base_url, settings.realm).token
+        async with self._upstream:
+            response = await http_request("POST", url, data=data, timeout=self._timeout)
+        response.raise_for_status()
+        result = response.json()
+        self._store_result(digest, result)
+        return result
+    
+    async def refresh(self, refresh_token: str, client: str) -> Dict[str, Any]:
+        """
+        刷新 Token
+        
+        Args:
+            refresh_token: Refresh Token
+            client: 用戶端識別（用於並行數限制）
+            
+        Returns:
+            dict: Keycloak Token 端點的回應
+            
+        Raises:
+            HTTPException: 429 用戶端同時刷新數超過上限
+            httpx.HTTPError: 上游呼叫失敗
+        """
+        digest = hashlib.sha256(refresh_token.encode()).digest()
+        
+        cached = self._cached_result(digest)
+        if cached is not None:
+            REFRESH_REQUESTS.inc("cached")
+            return cached
+        
+        # 已有相同 Refresh Token 的呼叫進行中：直接等待同一個結果
+        task = self._inflight.get(digest)
+        if task is not None:
+            REFRESH_REQUESTS.inc("coalesced")
+            return await asyncio.shield(task)
+        
+        active = self._active.get(client, 0)
+        if active >= self._max_per_client:
+            REFRESH_REQUESTS.inc("throttled")
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="刷新請求過於頻繁，請稍後再試",
+                headers={"Retry-After": "1"},
+            )
+        
+        self._active[client] = active + 1
+        try:
+            task = asyncio.create_task(self._refresh_upstream(digest, refresh_token))
+            self._inflight[digest] = task
+            task.add_done_callback(lambda _: self._inflight.pop(digest, None))
+            # shield: 單一呼叫端中斷連線時不取消其他正在等待的呼叫端
+            result = await asyncio.shield(task)
+            REFRESH_REQUESTS.inc("upstream")
+            return result
+        except httpx.HTTPError:
+            REFRESH_REQUESTS.inc("error")
+            raise
+        finally:
+            remaining = self._active[client] - 1
+            if remaining:
+                self._active[client] = remaining
+            else:
+                del self._active[client]
 
-@app.post("/api/refresh-token", tags=["認證管理"], summary="刷新 Access Token")
-async def refresh_token(refresh_token: dict):
+# 全域 Token 刷新代理實例
+refresh_proxy = TokenRefreshProxy(
+    timeout=settings.refresh_timeout,
+    result_ttl=settings.refresh_result_ttl,
+    max_cached=settings.refresh_result_cache_size,
+    max_per_client=settings.refresh_max_per_client,
+    max_upstream=settings.refresh_max_upstream,
+)
+
+@app.post("/api/refresh-token", tags=["認證管理"], summary="刷新 Access Token", dependencies=[Depends(limit_client_ip)])
+async def refresh_token(refresh_token: dict, request: Request):
     """
     使用 Refresh Token 獲取新的 Access Token
     
     當 Access Token 即將過期或已過期時，使用 Refresh Token 獲取新的 Token。
     這是 JWT 標準的一部分，用於維持長時間的用戶登入狀態。
+    同一個 Refresh Token 同時或短時間內的重複刷新只會呼叫 Keycloak 一次。
     
     Args:
         refresh_token (dict): 包含 'refresh_token' 字段的 JSON 物件
+        request: HTTP 請求（用於識別用戶端）
         
     Returns:
         dict: 新的 Access Token 和相關資訊
         
     Raises:
         HTTPException: 400 Refresh Token 無效或過期時拋出
+        HTTPException: 429 同一用戶端同時刷新過多時拋出
+        HTTPException: 502 / 504 Keycloak 無法連線或逾時時拋出
     """
+    token = refresh_token.get("refresh_token")
+    if not token or not isinstance(token, str):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Token 刷新失敗: 未提供 refresh_token"
+        )
+    
+    client = request.client.host if request.client else "unknown"
     try:
-        data = {
-            "grant_type": "refresh_token",
-            "client_id": CLIENT_ID,
-            "refresh_token": refresh_token.get("refresh_token")
-        }
-        
-        url = f"{KEYCLOAK_URLS[0]}/realms/{REALM}/protocol/openid-connect/token"
-        response = requests.post(url, data=data)
-        response.raise_for_status()
+        return await refresh_proxy.refresh(token, client)
+    
+    except httpx.TimeoutException as e:
+        raise HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail=f"Token 刷新逾時: {str(e) or type(e).__name__}"
+        )
+    except httpx.HTTPStatusError as e:
+        # Keycloak 回應 4xx 代表 Refresh Token 無效或過期；5xx 代表 Keycloak 本身異常
+        upstream_error = e.response.status_code >= 500
+        raise HTTPException(
+            status_code=status.HTTP_502_BAD_GATEWAY if upstream_error else status.HTTP_400_BAD_REQUEST,
+            detail=f"Token 刷新失敗: {str(e)}"
+        )
+    except httpx.HTTPError as e:
+        raise HTTPException(
+            status_code=status.HTTP_502_BAD_GATEWAY,
+            detail=f"Token 刷新失敗: {str(e) or type(e).__name__}"
+        )
+
+# ============================================================================
+# Backchannel Logout
+# ============================================================================
+
+# 登出 Token 的 events claim 必須包含的事件（OpenID Connect Back-Channel Logout 1.0）
+BACKCHANNEL_LOGOUT_EVENT = "http://schemas.openid.net/event/backchannel-logout"
+
+async def verify_logout_token(logout_token: str) -> Dict[str, Any]:
+    """
+    驗證 Keycloak 送出的登出 Token
+    
+    1. 簽名與 issuer：與 Access Token 相同，只接受信任 realm 的金鑰
+    2. aud 必須包含本服務的 client_id
+    3. 必須有 iat 與 backchannel-logout 事件，不能有 nonce（避免把 ID Token 當成登出 Token）
+    4. 至少要有 sid 或 sub
+    
+    Returns:
+        dict: 登出 Token 的 claims
         
-        return response.json()
+    Raises:
+        JWTError: 登出 Token 無效
+        TokenValidationError: 無法取得驗證用公鑰
+    """
+    parsed = parse_token(logout_token)
+    claims = parsed.claims
+    key_cache = issuer_registry.get(claims.get("iss"))
+    if key_cache is None:
+        raise JWTClaimsError("Invalid issuer")
+    key_set = await key_cache.get_key_set()
+    public_key = await _select_public_key(key_cache, key_set, parsed.kid)
+    await verify_signature_async(parsed, public_key, algorithms=settings.verify_algorithms)
+    
+    if "aud" not in claims:
+        raise JWTClaimsError("Missing audience")
+    _validate_claims(claims, audience=settings.client_id)
+    if not isinstance(claims.get("iat"), (int, float)):
+        raise JWTClaimsError("Missing Issued At claim (iat)")
+    events = claims.get("events")
+    if not isinstance(events, dict) or not isinstance(events.get(BACKCHANNEL_LOGOUT_EVENT), dict):
+        raise JWTClaimsError("Missing backchannel logout event")
+    if "nonce" in claims:
+        raise JWTClaimsError("Logout token must not contain nonce")
+    sid, sub = claims.get("sid"), claims.get("sub")
+    if not (isinstance(sid, str) and sid) and not (isinstance(sub, str) and sub):
+        raise JWTClaimsError("Logout token must contain sid or sub")
+    return claims
+
+@app.post("/api/backchannel-logout", tags=["認證管理"], summary="Keycloak Backchannel Logout")
+async def backchannel_logout(logout_token: str = Form(...)):
+    """
+    接收 Keycloak 的 Backchannel Logout 通知
+    
+    在 Keycloak client 設定的 "Backchannel logout URL" 填入此端點。
+    使用者登出後，Keycloak 以表單 (logout_token) 送出簽名的登出 Token；
+    驗證通過後記錄到撤銷索引，該 session（或該使用者在登出前取得）的 Token 之後一律拒絕，
+    不需要 introspection（多 worker 時透過共用快取目錄同步）。
     
-    except requests.RequestException as e:
+    Args:
+        logout_token: Keycloak 簽名的登出 Token
+        
+    Returns:
+        Response: 200（不快取）
+        
+    Raises:
+        HTTPException: 400 登出 Token 無效時拋出
+    """
+    headers = {"Cache-Control": "no-store"}
+    try:
+        claims = await verify_logout_token(logout_token)
+    except (JWTError, TokenValidationError) as e:
+        BACKCHANNEL_LOGOUTS.inc("invalid")
+        verify_logger.info("登出 Token 驗證錯誤: %s", e)
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail=f"Token 刷新失敗: {str(e)}"
+            detail=f"登出 Token 無效: {str(e)}",
+            headers=headers,
         )
+    
+    sid = claims.get("sid") if isinstance(claims.get("sid"), str) else None
+    revocation_index.revoke(sid, claims.get("sub"), claims["iat"])
+    BACKCHANNEL_LOGOUTS.inc("session" if sid else "subject")
+    verify_logger.info("Backchannel logout: sid=%s sub=%s", sid, claims.get("sub"))
+    return Response(status_code=status.HTTP_200_OK, headers=headers)
 
 # ============================================================================
 # 應用程式啟動點
@@ -706,11 +4684,27 @@ async def refresh_token(refresh_token: dict):
 if __name__ == "__main__":
     import uvicorn
     
-    # 直接執行時的開發模式配置
-    uvicorn.run(
-        app, 
-        host="0.0.0.0",    # 允許外部訪問
-        port=8000,          # API 服務端口
-        reload=True,        # 開發模式：自動重載
-        log_level="info"    # 日誌等級
-    )
\ No newline at end of file
+    if settings.workers > 1:
+        # 生產模式：多個 worker，並透過共用快取目錄共用公鑰與已驗證 Token
+        # （環境變數會傳遞給各 worker 程序）
+        if not settings.shared_cache_dir:
+            # 未指定時使用固定的私有目錄（SharedFileStore 以 0700 建立並檢查擁有者與權限），
+            # 重新啟動後仍沿用快照與撤銷紀錄
+            os.environ["SHARED_CACHE_DIR"] = os.path.join(os.environ.get("XDG_RUNTIME_DIR", "/run"), "keycloak-backend")
+        uvicorn.run(
+            "main:app",
+            host=settings.api_host,
+            port=settings.api_port,
+            workers=settings.workers,
+            log_level="info",
+            access_log=False,
+        )
+    else:
+        # 直接執行時的開發模式配置
+        uvicorn.run(
+            app, 
+            host=settings.api_host,  # 允許外部訪問（預設 0.0.0.0）
+            port=settings.api_port,  # API 服務端口
+            reload=True,        # 開發模式：自動重載
+            log_level="info"    # 日誌等級
+        )
\ No newline at end of file
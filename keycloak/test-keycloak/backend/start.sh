@@ -25,6 +25,9 @@ fi
 echo "📦 使用 uv 安裝依賴套件..."
 uv sync
 
+# 啟動模式: dev（預設，單一程序 + 熱重載）或 prod（多個 worker）
+MODE="${1:-dev}"
+
 # 啟動服務
 echo "🌟 啟動 FastAPI 伺服器..."
 echo "   後端 API 將運行在: http://localhost:8000"
@@ -32,4 +35,19 @@ echo "   API 文檔位於: http://localhost:8000/docs"
 echo "   按 Ctrl+C 停止服務"
 echo ""
 
-uv run uvicorn main:app --host 0.0.0.0 --port 8000 --reload
\ No newline at end of file
+if [[ "$MODE" == "prod" ]]; then
+    # worker 數預設等於 CPU 核心數
+    WORKERS="${WORKERS:-$(nproc 2>/dev/null || sysctl -n hw.ncpu 2>/dev/null || echo 1)}"
+    # 各 worker 透過共用快取目錄共用公鑰與已驗證 Token
+    # 未指定時使用固定的私有目錄（權限 0700），重新啟動後仍沿用快照與撤銷紀錄；
+    # 目錄的擁有者與權限由後端啟動時檢查
+    export SHARED_CACHE_DIR="${SHARED_CACHE_DIR:-${XDG_RUNTIME_DIR:-/run}/keycloak-backend}"
+    if ! mkdir -p -m 700 "$SHARED_CACHE_DIR"; then
+        echo "❌ 無法建立共用快取目錄 $SHARED_CACHE_DIR，請以 SHARED_CACHE_DIR 指定目前使用者可寫入的固定路徑"
+        exit 1
+    fi
+    echo "🏭 生產模式: $WORKERS 個 worker，共用快取目錄: $SHARED_CACHE_DIR"
+    uv run uvicorn main:app --host 0.0.0.0 --port 8000 --workers "$WORKERS" --no-access-log
+else
+    uv run uvicorn main:app --host 0.0.0.0 --port 8000 --reload
+fi
\ No newline at end of file
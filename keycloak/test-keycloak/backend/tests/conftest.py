@@ -0,0 +1,44 @@
+"""
+測試共用設定
+
+在本機啟動 benchmark.py 的模擬 Keycloak，並在匯入 main 之前設定環境變數
+（main 匯入時讀取一次設定），不需要真正的 Keycloak。
+"""
+
+import os
+import sys
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from benchmark import FakeKeycloak  # noqa: E402
+
+USER_COUNT = 250
+PAGE_SIZE = 40
+
+_keycloak = FakeKeycloak(user_count=USER_COUNT)
+os.environ.update({
+    "ENV_FILE": os.devnull,                                 # 不讀取開發者本機的 .env
+    "KEYCLOAK_URLS": _keycloak.start(),
+    "ADMIN_CLIENT_SECRET": "test-secret",
+    "ADMIN_PAGE_SIZE": str(PAGE_SIZE),
+    "ADMIN_PREFETCH_PAGES": "2",
+    "KEYCLOAK_REALMS": "sam-test,tenant-b",
+    "INTROSPECTION_MODE": "opaque",
+    "INTROSPECTION_CLIENT_SECRET": "test-secret",
+    "BATCH_VERIFY_SECRET": "batch-secret",
+})
+
+@pytest.fixture(scope="session")
+def keycloak() -> FakeKeycloak:
+    return _keycloak
+
+@pytest.fixture(scope="session")
+def client():
+    from fastapi.testclient import TestClient
+    import main
+
+    with TestClient(main.app) as test_client:
+        yield test_client
@@ -0,0 +1,86 @@
+"""管理員端點 /api/admin/users：串流分頁、first / max、JSON 與 NDJSON 格式、權限檢查"""
+
+import json
+
+import pytest
+
+from conftest import PAGE_SIZE, USER_COUNT
+
+@pytest.fixture(autouse=True)
+def reset_pages(keycloak):
+    keycloak.wait_idle()
+    keycloak.user_pages.clear()
+
+def _auth(keycloak, **claims) -> dict:
+    return {"Authorization": f"Bearer {keycloak.mint_token('tester', **claims)}"}
+
+@pytest.fixture
+def admin(keycloak) -> dict:
+    return _auth(keycloak, realm_access={"roles": ["admin"]})
+
+def test_lists_all_users_streamed_page_by_page(client, keycloak, admin):
+    response = client.get("/api/admin/users", headers=admin)
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/json"
+    assert "content-length" not in response.headers             # 串流回應，不預先組出完整內容
+    body = response.json()
+    assert body == {"first": 0, "users": keycloak.users, "count": USER_COUNT, "next": None}
+    # 逐頁向 Keycloak 取得，每頁最多 ADMIN_PAGE_SIZE 筆
+    assert all(size == PAGE_SIZE for _, size in keycloak.user_pages)
+    assert {first for first, _ in keycloak.user_pages} >= set(range(0, USER_COUNT, PAGE_SIZE))
+
+def test_first_and_max_select_a_window(client, keycloak, admin):
+    response = client.get("/api/admin/users", params={"first": 10, "max": 50}, headers=admin)
+
+    body = response.json()
+    assert body["users"] == keycloak.users[10:60]
+    assert body["count"] == 50
+    assert body["next"] == 60
+    # 最後一頁只請求剩下的筆數
+    assert sorted(keycloak.user_pages) == [(10, PAGE_SIZE), (50, 10)]
+
+def test_next_is_null_at_the_end(client, keycloak, admin):
+    response = client.get("/api/admin/users", params={"first": USER_COUNT - 10, "max": 50}, headers=admin)
+
+    body = response.json()
+    assert body["users"] == keycloak.users[-10:]
+    assert body["count"] == 10
+    assert body["next"] is None
+
+def test_first_past_the_end_is_empty(client, admin):
+    response = client.get("/api/admin/users", params={"first": USER_COUNT + 5}, headers=admin)
+
+    assert response.json() == {"first": USER_COUNT + 5, "users": [], "count": 0, "next": None}
+
+def test_search_is_passed_to_keycloak(client, keycloak, admin):
+    response = client.get("/api/admin/users", params={"search": "user0001"}, headers=admin)
+
+    assert [user["username"] for user in response.json()["users"]] == [f"user{i:05d}" for i in range(10, 20)]
+
+def test_ndjson_one_user_per_line(client, keycloak, admin):
+    response = client.get("/api/admin/users", params={"first": 35, "max": 20, "format": "ndjson"}, headers=admin)
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = response.text.splitlines()
+    assert [json.loads(line) for line in lines] == keycloak.users[35:55]
+
+def test_ndjson_all_users(client, keycloak, admin):
+    response = client.get("/api/admin/users", params={"format": "ndjson"}, headers=admin)
+
+    assert [json.loads(line) for line in response.text.splitlines()] == keycloak.users
+
+def test_unknown_format_is_rejected(client, admin):
+    assert client.get("/api/admin/users", params={"format": "xml"}, headers=admin).status_code == 422
+
+def test_realm_management_client_role_is_admin(client, keycloak):
+    headers = _auth(keycloak, resource_access={"realm-management": {"roles": ["view-users"]}})
+
+    assert client.get("/api/admin/users", params={"max": 1}, headers=headers).status_code == 200
+
+def test_non_admin_is_forbidden(client, keycloak):
+    response = client.get("/api/admin/users", headers=_auth(keycloak))
+
+    assert response.status_code == 403
+    assert keycloak.user_pages == []
@@ -0,0 +1,41 @@
+"""Claims：快取共用的 claims 不可被處理函數改動"""
+
+import pytest
+
+from main import Claims, dump_json
+
+PAYLOAD = {
+    "sub": "user-1",
+    "aud": ["account", "myclient"],
+    "realm_access": {"roles": ["user"]},
+    "resource_access": {"myclient": {"roles": ["viewer"]}},
+}
+
+def test_raw_payload_is_read_only():
+    claims = Claims(PAYLOAD)
+
+    with pytest.raises(TypeError):
+        claims.raw["sub"] = "someone-else"
+    with pytest.raises(TypeError):
+        claims.raw["realm_access"]["roles"] = ["admin"]
+    with pytest.raises(AttributeError):
+        claims.raw["aud"].append("admin-console")
+    assert claims.aud == ("account", "myclient")
+
+def test_client_roles_are_read_only():
+    claims = Claims(PAYLOAD)
+
+    with pytest.raises(TypeError):
+        claims.client_roles["realm-management"] = frozenset({"realm-admin"})
+    assert claims.client_roles["myclient"] == frozenset({"viewer"})
+
+def test_nested_values_are_frozen_once_on_access():
+    claims = Claims(PAYLOAD)
+
+    realm_access = claims.raw["realm_access"]
+    assert realm_access is claims.raw["realm_access"]
+    assert realm_access["roles"] == ("user",)
+    assert dict(claims.raw).keys() == PAYLOAD.keys()
+
+def test_read_only_payload_serializes_as_json():
+    assert dump_json(Claims(PAYLOAD).raw) == dump_json(PAYLOAD)
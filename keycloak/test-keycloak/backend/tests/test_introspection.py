@@ -0,0 +1,70 @@
+"""Token introspection：依 issuer 決定 realm、回應的 issuer 與 audience 檢查"""
+
+import pytest
+
+import main
+
+@pytest.fixture(autouse=True)
+def reset_introspected(keycloak):
+    keycloak.wait_idle()
+    keycloak.introspected.clear()
+
+@pytest.fixture
+def introspect(client):
+    """以新的 TokenIntrospector（不共用結果快取）在應用程式的事件迴圈查詢 Token"""
+    introspector = main.TokenIntrospector(
+        client_id="myclient", client_secret="test-secret", cache_ttl=30, negative_ttl=10,
+        max_cached=100, timeout=5,
+    )
+    return lambda token: client.portal.call(introspector.introspect, token)
+
+def _bearer(token: str) -> dict:
+    return {"Authorization": f"Bearer {token}"}
+
+def test_opaque_token_is_introspected_in_default_realm(client, keycloak):
+    response = client.get("/api/protected", headers=_bearer(keycloak.mint_opaque_token("alice")))
+
+    assert response.status_code == 200
+    assert keycloak.introspected == ["sam-test"]
+
+def test_opaque_token_for_another_audience_is_rejected(client, keycloak):
+    token = keycloak.mint_opaque_token("alice", aud="other-api")
+
+    assert client.get("/api/protected", headers=_bearer(token)).status_code == 401
+
+def test_unknown_opaque_token_is_rejected(client):
+    assert client.get("/api/protected", headers=_bearer("not-a-real-token")).status_code == 401
+
+def test_jwt_is_introspected_in_its_own_realm(keycloak, introspect):
+    token = keycloak.mint_token("bob", iss=f"{keycloak.url}/realms/tenant-b")
+
+    claims = introspect(token)
+
+    assert claims is not None and claims.sub == "bob"
+    assert keycloak.introspected == ["tenant-b"]
+
+def test_jwt_from_untrusted_realm_is_not_sent_upstream(keycloak, introspect):
+    token = keycloak.mint_token("mallory", iss=f"{keycloak.url}/realms/evil")
+
+    assert introspect(token) is None
+    assert keycloak.introspected == []
+
+def test_jwt_for_another_audience_is_inactive(keycloak, introspect):
+    token = keycloak.mint_token("bob", aud=["other-api"])
+
+    assert introspect(token) is None
+    assert keycloak.introspected == ["sam-test"]
+
+@pytest.mark.parametrize("body", [b"<html>502 Bad Gateway</html>", b'{"active": tr', b"[]"])
+def test_malformed_response_is_unavailable_and_not_cached(client, keycloak, body):
+    token = keycloak.mint_opaque_token("alice")
+    keycloak.introspect_body = body
+    try:
+        response = client.get("/api/protected", headers=_bearer(token))
+    finally:
+        keycloak.introspect_body = None
+
+    assert response.status_code == 401
+    assert response.json()["detail"].startswith("無法驗證 Token")
+    # 沒有負向快取：Keycloak 恢復後同一個 Token 立即可用
+    assert client.get("/api/protected", headers=_bearer(token)).status_code == 200
@@ -0,0 +1,30 @@
+"""parse_token：只接受恰好三段的 JWS compact 格式"""
+
+import base64
+import json
+
+import pytest
+from jose import JWTError
+
+from main import parse_token
+
+def _segment(value: dict) -> str:
+    return base64.urlsafe_b64encode(json.dumps(value).encode()).rstrip(b"=").decode()
+
+TOKEN = f"{_segment({'alg': 'RS256', 'kid': 'k1'})}.{_segment({'sub': 'user-1'})}.c2ln"
+
+def test_three_segments_parse():
+    parsed = parse_token(TOKEN)
+
+    assert parsed.header["kid"] == "k1"
+    assert parsed.claims["sub"] == "user-1"
+
+@pytest.mark.parametrize("token", [
+    TOKEN.rsplit(".", 1)[0],
+    f"{TOKEN}.extra",
+    # base64 解碼會略過 "."，多出的分隔符號若不先擋下仍可解出 claims
+    TOKEN.replace(".", "...", 1),
+])
+def test_other_segment_counts_are_rejected(token):
+    with pytest.raises(JWTError):
+        parse_token(token)
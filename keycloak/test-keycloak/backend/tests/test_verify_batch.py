@@ -0,0 +1,31 @@
+"""批次驗證 /api/verify/batch：共用密鑰與依 Token 數計費的速率限制"""
+
+import main
+
+SECRET = {"X-Batch-Verify-Secret": "batch-secret"}
+
+def test_requires_the_shared_secret(client, keycloak):
+    body = {"tokens": [keycloak.mint_token("alice")]}
+
+    assert client.post("/api/verify/batch", json=body).status_code == 401
+    assert client.post("/api/verify/batch", json=body, headers={"X-Batch-Verify-Secret": "wrong"}).status_code == 401
+
+def test_verifies_tokens_in_order(client, keycloak):
+    body = {"tokens": [keycloak.mint_token("alice"), "garbage", keycloak.mint_token("bob", lifetime=-60)]}
+
+    response = client.post("/api/verify/batch", json=body, headers=SECRET)
+
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [result["valid"] for result in results] == [True, False, False]
+    assert results[0]["claims"]["sub"] == "alice"
+    # 測試環境為 INTROSPECTION_MODE=opaque：非 JWT 格式的 Token 由 introspection 判定為無效
+    assert [result.get("error") for result in results[1:]] == ["inactive", "expired"]
+
+def test_limiter_charges_per_token():
+    limiter = main.RateLimiter(rate=1, burst=10, max_keys=10)
+
+    assert limiter.acquire("ip:gateway", cost=8) == 0
+    assert limiter.acquire("ip:gateway", cost=8) == 0          # 還有額度即允許，不足的部分記為負債
+    retry_after = limiter.acquire("ip:gateway")
+    assert 6 < retry_after <= 7                                # 要等負債補回（-6 → 1）